@@ -0,0 +1,130 @@
+"""
+First-pass rates and time to a valid diagram of a local llama.cpp model, with free-form output and with output
+constrained by the grammar of the interpreter. Each prompt is re-run until its diagram renders, up to a maximum
+number of runs, as by the re-run button of the UI. Requests are stored with their metrics in cmi_logs of a
+temporary directory.
+Run from the repository root: python -m benchmarks.diagram_grammar -m <model_file> [-i <int_id>] [-r <max_runs>] [-f <prompt_file>] [-e <int_api_endpoint>]
+"""
+
+import os
+import sys
+import getopt
+import tempfile
+import statistics
+from time import perf_counter_ns
+
+import cmi_llm_local.llm_runtime as llm_runtime
+import cmi_llm_local.llm_api_client as llm_api_client
+import cmi_interpreter.interpreter_runtime as interpreter_runtime
+import cmi_data_store.data_store as data_store
+import cmi_conversation.conversation_manager as conversation_manager
+
+# Runs of a prompt until its diagram is valid
+MAX_RUNS = 3
+
+PROMPTS = [
+    "Create a conceptual model of a library with books, authors, members and loans.",
+    "Create a conceptual model of an online shop with customers, orders, order items and products.",
+    "Create a conceptual model of a university with students, courses, lecturers and enrollments.",
+    "Create a process model of an order process: receive the order, check the stock, ship the goods and send the invoice.",
+    "Create a process model of a job application: receive the application, review it, invite to an interview and decide."
+]
+
+def print_usage():
+    print("Usage: python -m benchmarks.diagram_grammar -m <model_file> [-i <int_id>] [-r <max_runs>] [-f <prompt_file>] [-e <int_api_endpoint>]")
+    print("<int_id> =", " | ".join(interpreter_runtime.GRAMMAR_BY_ID.keys()), "(default: {})".format(interpreter_runtime.INT_PLANTWEB_GRAPHVIZ))
+    print("<prompt_file> = text file with one prompt per line (default: {} built-in prompts)".format(len(PROMPTS)))
+    sys.exit(1)
+
+def run_prompt(manager, prompt, max_runs):
+    """Runs a prompt until its diagram is valid; returns (source found, valid) of the first run, and runs and seconds until valid"""
+
+    context = [{llm_api_client.ROLE: llm_api_client.ROLE_US, llm_api_client.MSG: prompt, llm_api_client.MSG_FORMAT: llm_api_client.MSG_FORMAT_PROMPT}]
+    first_pass = None
+    t_submit = perf_counter_ns()
+    for run in range(1, max_runs + 1):
+        (items, item_function, t_start) = manager.enter_prompt(context, prompt)
+        response = "".join(manager.stream_llm_response(items, item_function, t_start, manager.request_metrics))
+        manager.record_llm_response(response, perf_counter_ns() - t_start)
+        source = manager.process_llm_response(response)
+        valid = False
+        if source:
+            try:
+                (int_input, int_output) = manager.execute_interpreter(source)
+                valid = int_output is not None
+            except Exception as e:
+                print("Interpreter failed:", e)
+        if first_pass is None:
+            first_pass = (source is not None, valid)
+        if valid:
+            return first_pass + (run, (perf_counter_ns() - t_submit) / 1e9)
+    return first_pass + (None, None)
+
+def print_results(mode, results, max_runs):
+    n = len(results)
+    valid = [r for r in results if r[2] is not None]
+    print("{}: {} prompts".format(mode, n))
+    print("  source found on first run: {}/{}".format(sum(r[0] for r in results), n))
+    print("  valid diagram on first run: {}/{}".format(sum(r[1] for r in results), n))
+    print("  valid diagram within {} runs: {}/{}".format(max_runs, len(valid), n))
+    if valid:
+        print("  runs until valid: mean {:.2f}".format(statistics.mean(r[2] for r in valid)))
+        print("  seconds until valid: mean {:.2f}, p50 {:.2f}".format(statistics.mean(r[3] for r in valid), statistics.median(r[3] for r in valid)))
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "m:i:r:f:e:h")
+    except getopt.GetoptError as err:
+        print(err)
+        print_usage()
+
+    model_file = None
+    int_id = interpreter_runtime.INT_PLANTWEB_GRAPHVIZ
+    prompts = PROMPTS
+    max_runs = MAX_RUNS
+    api_endpoints = {}
+    for opt, arg in opts:
+        if opt == "-m":
+            model_file = os.path.abspath(arg)
+        elif opt == "-i":
+            int_id = arg
+        elif opt == "-r":
+            max_runs = int(arg)
+        elif opt == "-f":
+            with open(arg, "r") as file:
+                prompts = [line.strip() for line in file if line.strip()]
+        elif opt == "-e":
+            api_endpoints[interpreter_runtime.INT_BPMN] = arg
+        else:
+            print_usage()
+    if model_file is None or int_id not in interpreter_runtime.GRAMMAR_BY_ID:
+        print_usage()
+
+    llm_id = llm_runtime.RUNTIME_LLAMA_CPP + "/" + os.path.basename(model_file)
+    llm_runtime.LLM_BY_ID[llm_id] = model_file
+    os.chdir(tempfile.mkdtemp(prefix="cmi-benchmark-"))
+    print("Storing conversations in", os.path.join(os.getcwd(), data_store.DIRECTORY))
+
+    store = data_store.DataStore()
+    store.create_conversation("Diagram grammar benchmark")
+    runtime = llm_runtime.LLMRuntime()
+    manager = conversation_manager.ConversationManager({}, api_endpoints, llm_api_client.LLMApiClient(), runtime, interpreter_runtime.InterpreterRuntime(), store)
+    manager.selected_llm_id = llm_id
+    manager.llm_parameters = llm_runtime.PARAMETER_DEFAULTS[llm_runtime.RUNTIME_LLAMA_CPP].copy()
+    runtime.load_llm_files(llm_id, manager.llm_parameters)
+    manager.selected_int_id = int_id
+    # the first option of each list, as selected by default in the UI
+    for (parameter, value) in manager.set_interpreter_parameters().items():
+        if isinstance(value, list):
+            manager.int_parameters[parameter] = value[0]
+
+    results = {}
+    for (mode, constrain) in [("free-form", False), ("grammar", True)]:
+        manager.constrain_output = constrain
+        results[mode] = [run_prompt(manager, prompt, max_runs) for prompt in prompts]
+    for (mode, mode_results) in results.items():
+        print_results(mode, mode_results, max_runs)
+    store.close()
+
+if __name__ == "__main__":
+    main()
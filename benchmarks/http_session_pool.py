@@ -0,0 +1,66 @@
+"""
+Latency of requests sent with a new connection each, as by requests.post, and with the pooled keep-alive sessions,
+against a local HTTP/1.1 server replying like BPMN-Auto-Layout.
+Run from the repository root: python -m benchmarks.http_session_pool [<requests>]
+"""
+
+import sys
+import time
+import statistics
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+import cmi_http.http_session_pool as http_session_pool
+
+# Requests per run after warm-up, runs per client, and bytes of the request body
+BENCHMARK_REQUESTS = 500
+BENCHMARK_WARM_UP_REQUESTS = 20
+BENCHMARK_RUNS = 3
+REQUEST_BYTES = 2000
+
+class DiagramHandler(BaseHTTPRequestHandler):
+    """Replies to a POST request with a small JSON document, keeping the connection alive"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"svg": "<svg/>"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run(post, url, n):
+    """Returns the median request duration in ms"""
+
+    data = b'x' * REQUEST_BYTES
+    for i in range(BENCHMARK_WARM_UP_REQUESTS):
+        post(url, data=data).json()
+    durations = []
+    for i in range(n):
+        t_start = time.perf_counter()
+        post(url, data=data).json()
+        durations.append(time.perf_counter() - t_start)
+    return statistics.median(durations) * 1e3
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else BENCHMARK_REQUESTS
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DiagramHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/process-diagram'.format(server.server_address[1])
+    print("Requests:", n, "per run,", BENCHMARK_RUNS, "runs,", REQUEST_BYTES, "bytes each")
+    for (name, post) in [("requests.post", requests.post), ("pooled session", http_session_pool.post)]:
+        medians = [run(post, url, n) for i in range(BENCHMARK_RUNS)]
+        print("{}: median per run {} ms".format(name, ", ".join("{:.2f}".format(m) for m in medians)))
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
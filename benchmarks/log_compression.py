@@ -0,0 +1,112 @@
+"""
+Write latency and disk footprint of stored conversations, uncompressed and gzip-compressed, for synthetic
+conversations of prompts, LLM responses with DOT source and SVG interpreter outputs. Records are written
+synchronously, so that the latency of each write is measured.
+Run from the repository root: python -m benchmarks.log_compression [<conversations>] [<turns>]
+"""
+
+import os
+import sys
+import random
+import tempfile
+import statistics
+from time import perf_counter_ns
+
+import cmi_data_store.data_store as data_store
+import cmi_data_store.artifact_store as artifact_store
+
+# Conversations stored per layout and turns of each conversation
+CONVERSATIONS = 20
+TURNS = 10
+
+# Nodes of the diagram of a turn, determining the sizes of the response and the SVG output
+DIAGRAM_NODES = 40
+
+WORDS = ["customer", "order", "product", "invoice", "payment", "shipment", "account", "supplier", "stock", "item"]
+
+class TimedDataStore(data_store.DataStore):
+    """Data store recording the duration of each journal append, message file and artifact write"""
+
+    def __init__(self, compression):
+        super().__init__(background_writer=False, compression=compression)
+        self.durations = {"append_file": [], "write_file": [], "put_artifact": []}
+
+    def append_file(self, path, text):
+        t_start = perf_counter_ns()
+        super().append_file(path, text)
+        self.durations["append_file"].append(perf_counter_ns() - t_start)
+
+    def write_file(self, path, text):
+        t_start = perf_counter_ns()
+        super().write_file(path, text)
+        self.durations["write_file"].append(perf_counter_ns() - t_start)
+
+    def put_artifact(self, data):
+        t_start = perf_counter_ns()
+        digest = super().put_artifact(data)
+        self.durations["put_artifact"].append(perf_counter_ns() - t_start)
+        return digest
+
+def create_turn(rng):
+    """Returns a prompt, an LLM response with DOT source, the source and an SVG output"""
+
+    nodes = [rng.choice(WORDS) + str(i) for i in range(DIAGRAM_NODES)]
+    edges = ["  {} -> {} [label=\"{}\"];".format(rng.choice(nodes), rng.choice(nodes), rng.choice(WORDS)) for i in nodes]
+    source = "digraph G {\n" + "\n".join(edges) + "\n}"
+    prompt = "Create a conceptual model with " + ", ".join(rng.sample(WORDS, 5)) + "."
+    response = "Here is the conceptual model:\n```dot\n" + source + "\n```\nThe model relates " + " and ".join(rng.sample(WORDS, 3)) + "."
+    shapes = ['<g class="node"><title>{0}</title><ellipse cx="{1}" cy="{2}" rx="54" ry="18" fill="none" stroke="black"/>'
+              '<text text-anchor="middle" x="{1}" y="{2}" font-size="14">{0}</text></g>'.format(n, rng.randint(0, 2000), rng.randint(0, 2000)) for n in nodes]
+    svg = '<?xml version="1.0" encoding="UTF-8"?>\n<svg xmlns="http://www.w3.org/2000/svg" width="2000pt" height="2000pt">\n' + "\n".join(shapes) + "\n</svg>"
+    return (prompt, response, source, svg)
+
+def get_size(directory):
+    """Returns the bytes of the files in a directory tree, and the bytes of the blocks allocated for them"""
+
+    (size, allocated) = (0, 0)
+    for (path, directories, files) in os.walk(directory):
+        for f in files:
+            stat = os.stat(os.path.join(path, f))
+            size += stat.st_size
+            allocated += stat.st_blocks * 512
+    return (size, allocated)
+
+def run(compression, conversations, turns):
+    """Stores the conversations in a temporary log directory, returns the write durations and bytes on disk"""
+
+    rng = random.Random(0)
+    store = TimedDataStore(compression)
+    for c in range(conversations):
+        store.create_conversation("How may I assist you today?")
+        for t in range(turns):
+            (prompt, response, source, svg) = create_turn(rng)
+            store.set_llm_configuration("Ollama/llama3", {"temperature": 0.2})
+            store.set_interpreter_configuration("Plantweb/Graphviz", {"Output format": "SVG"})
+            store.insert_prompt(prompt)
+            store.insert_llm_response(response, 1000000000)
+            store.insert_interpreter_input(source)
+            store.insert_interpreter_output(svg, 200000000)
+    store.close()
+    return (store.durations, get_size(data_store.DIRECTORY), get_size(os.path.join(data_store.DIRECTORY, artifact_store.ARTIFACT_DIRECTORY)))
+
+def main():
+    conversations = int(sys.argv[1]) if len(sys.argv) > 1 else CONVERSATIONS
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else TURNS
+    print("Conversations:", conversations, "with", turns, "turns each")
+    directory = os.getcwd()
+    sizes = {}
+    for (layout, compression) in [("uncompressed", False), ("compressed", True)]:
+        os.chdir(tempfile.mkdtemp(prefix="cmi-benchmark-"))
+        (durations, (size, allocated), (artifact_size, artifact_allocated)) = run(compression, conversations, turns)
+        os.chdir(directory)
+        sizes[layout] = (size, allocated)
+        print("{}: {:.2f} MB in files, {:.2f} MB allocated on disk; artifacts {:.2f} MB in files, {:.2f} MB allocated".format(
+            layout, size / 1e6, allocated / 1e6, artifact_size / 1e6, artifact_allocated / 1e6))
+        for (operation, d) in durations.items():
+            d = sorted(d)
+            print("  {}: {} writes, median {:.1f} us, p99 {:.1f} us".format(operation, len(d), statistics.median(d) / 1e3, d[int(len(d) * 0.99)] / 1e3))
+    print("Compressed: {:.1%} of the uncompressed bytes in files, {:.1%} of the allocated bytes".format(
+        sizes["compressed"][0] / sizes["uncompressed"][0], sizes["compressed"][1] / sizes["uncompressed"][1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Throughput of the NDJSON stream decoder on a synthetic Ollama stream, split into chunks of different sizes.
+Run from the repository root: python -m benchmarks.ndjson_decoder [<objects>]
+"""
+
+import sys
+import json
+import time
+import random
+
+from cmi_llm_local.ndjson_stream import NDJSONStreamDecoder
+
+# Objects of the synthetic stream, followed by a final object with a large context
+STREAM_OBJECTS = 200000
+FINAL_CONTEXT_TOKENS = 4000
+
+# Chunk sizes in bytes: single bytes, random sizes read from a socket, the whole stream
+CHUNK_SIZES = [("1-byte chunks", (1, 1)), ("random 1-64 KiB chunks", (1024, 65536)), ("one chunk", None)]
+
+# Bytes of the stream split into 1-byte chunks, up to the last complete object, limiting the time taken
+ONE_BYTE_MAX_BYTES = 2000000
+
+def create_stream(objects):
+    lines = [json.dumps({"model": "llama3", "created_at": "2024-01-01T00:00:00Z", "response": "tok%d " % i, "done": False}) for i in range(objects)]
+    lines.append(json.dumps({"done": True, "context": list(range(FINAL_CONTEXT_TOKENS)), "eval_duration": 1}))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+def split_stream(data, sizes):
+    if sizes is None:
+        return [data]
+    if sizes == (1, 1):
+        data = data[0:data.rindex(b"\n", 0, ONE_BYTE_MAX_BYTES) + 1]
+    chunks = []
+    i = 0
+    while i < len(data):
+        n = random.randint(*sizes)
+        chunks.append(data[i:i + n])
+        i += n
+    return chunks
+
+def main():
+    objects = int(sys.argv[1]) if len(sys.argv) > 1 else STREAM_OBJECTS
+    random.seed(0)
+    data = create_stream(objects)
+    print("Stream:", objects + 1, "objects,", round(len(data) / 1e6, 1), "MB")
+    for (name, sizes) in CHUNK_SIZES:
+        chunks = split_stream(data, sizes)
+        total = sum(len(c) for c in chunks)
+        t_start = time.perf_counter()
+        decoded = sum(1 for o in NDJSONStreamDecoder().iter_objects(chunks))
+        duration = time.perf_counter() - t_start
+        print("{}: {} objects, {:.1f} MB in {:.2f} s, {:.1f} MB/s".format(name, decoded, total / 1e6, duration, total / duration / 1e6))
+
+if __name__ == "__main__":
+    main()
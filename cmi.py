@@ -1,15 +1,29 @@
 import sys
 import getopt
-import streamlit as st
 import os
 from unittest import result
-from streamlit.web import cli as stweb
 
-import cmi_conversation.conversational_ui as conversational_ui
+# worker processes started with spawn, e.g., inference workers, re-import the main module as __mp_main__; they
+# neither import the web UI nor run the app code below
+if __name__ != "__mp_main__":
+    import streamlit as st
+    from streamlit.web import cli as stweb
+    import cmi_conversation.conversational_ui as conversational_ui
+
 import cmi_conversation.conversation_manager as conversation_manager
 import cmi_data_store.data_store as data_store
+import cmi_data_store.data_store_sqlite as data_store_sqlite
+import cmi_data_store.data_store_writer as data_store_writer
+import cmi_data_store.retention as retention
 import cmi_llm_local.llm_api_client as llm_api_client
+import cmi_llm_local.response_cache as response_cache
+import cmi_llm_local.context_window as context_window
 import cmi_llm_local.llm_runtime as llm_runtime
+import cmi_llm_local.llama_model_pool as llama_model_pool
+import cmi_llm_local.llama_state_cache as llama_state_cache
+import cmi_llm_local.inference_worker as inference_worker
+import cmi_llm_local.llm_metrics as llm_metrics
+import cmi_llm_local.llm_resilience as llm_resilience
 import cmi_interpreter.interpreter_runtime as interpreter_runtime
 
 CMI_TITLE = "CMI Test Environment"
@@ -20,15 +34,39 @@ streamlit_activated = False
 api_keys = {}
 api_endpoints = {}
 ui_port = 8501
+store_id = data_store.STORE_JSON
+store_compression = False
+writer_batch_size = data_store_writer.WRITER_BATCH_SIZE
+writer_queue_size = data_store_writer.WRITER_QUEUE_SIZE
+writer_fsync = data_store_writer.WRITER_FSYNC
+response_cache_ttl_s = None
+async_llm_streams = False
+context_window_strategy = None
+context_window_max_tokens = None
+ollama_api = llm_api_client.OLLAMA_API_GENERATE
+ollama_keep_alive = None
+resilience_parameters = None
+llama_memory_budget_bytes = llama_model_pool.LLAMA_POOL_MEMORY_BUDGET_BYTES
+llama_state_cache_bytes = None
+llama_state_spill_bytes = 0
+inference_workers = 0
 
 def print_usage():
     print(CMI_TITLE, CMI_VERSION)
     print("")
-    print("Usage: cmi.py [-h|--help] [-a|--api <api_id>:<api_key>[:api_endpoint]]* [-p|--port <ui_port>]")
+    print("Usage: cmi.py [-h|--help] [-a|--api <api_id>:<api_key>[:api_endpoint]]* [-p|--port <ui_port>] [-s|--store <store_id>] [-z|--compress-logs] [--store-writer <writer_spec>] [-c|--response-cache <ttl_s>] [-w|--context-window <strategy>[:<max_tokens>]] [--async-llm] [--ollama-chat] [--ollama-keep-alive <duration>] [--llm-resilience <resilience_spec>] [--llama-memory-budget <max_mb>] [--llama-state-cache <max_mb>[:<spill_max_mb>]] [--inference-workers <workers>] [--convert-logs] [--import-logs] [--collect-garbage] [--apply-retention <retention_spec>] [--llm-metrics]")
     print("")
 
     api_id_options = " | ".join(conversation_manager.API_ID_LIST)
     print("<api_id> =", api_id_options)
+    print("<store_id> =", " | ".join(data_store.STORE_IDS), "(default:", store_id + ")")
+    print("<writer_spec> = [<batch_size>]:[<queue_size>]:[<fsync>] (records written together, queued records before producers wait, empty values: {}:{}:{})".format(
+        data_store_writer.WRITER_BATCH_SIZE, data_store_writer.WRITER_QUEUE_SIZE, data_store_writer.WRITER_FSYNC))
+    print("<fsync> =", " | ".join(data_store_writer.FSYNC_MODES))
+    print("<strategy> =", " | ".join(context_window.CONTEXT_STRATEGIES))
+    print("<retention_spec> = [<compact_after_days>]:[<max_age_days>]:[<max_size_mb>] (size of conversations with their artifacts, without a SQLite database)")
+    print("<resilience_spec> = [<retries>]:[<connect_timeout_s>]:[<read_timeout_s>]:[<hedge_after_s>] (off by default, empty values: {}:{}:{}:)".format(
+        llm_resilience.RESILIENCE_RETRIES, llm_resilience.RESILIENCE_CONNECT_TIMEOUT_S, llm_resilience.RESILIENCE_READ_TIMEOUT_S))
     print("")
     
     print("Supported LLM Clients:")
@@ -52,8 +90,40 @@ def print_usage():
     print("  cmi.py -a OpenAI:INSERT_KEY -a Replicate:INSERT_KEY")
     print("- Run with a local Ollama endpoint:")
     print("  cmi.py -a Ollama::'http://127.0.0.1:11434/api'")
+    print("- Balance requests across several Ollama hosts, failing over to healthy hosts:")
+    print("  cmi.py -a Ollama::'http://host1:11434/api,http://host2:11434/api'")
     print("- Run with a local BPMN-Auto-Layout endpoint:")
     print("  cmi.py -a BPMN-Auto-Layout::'http://127.0.0.1:3000/process-diagram'")
+    print("- Convert JSON logs in", data_store.DIRECTORY, "to JSON lines journals:")
+    print("  cmi.py --convert-logs")
+    print("- Replay LLM responses for repeated prompts with the same model and parameters for up to one hour:")
+    print("  cmi.py -a OpenAI:INSERT_KEY -c 3600")
+    print("- Fit conversations into 8000 tokens, or less if the model context is smaller, sending only the latest model source:")
+    print("  cmi.py -a OpenAI:INSERT_KEY -w latest-source:8000")
+    print("- Run Ollama with the chat API, keeping models loaded for one hour after each request:")
+    print("  cmi.py -a Ollama::'http://127.0.0.1:11434/api' --ollama-chat --ollama-keep-alive 1h")
+    print("- Retry failed LLM requests up to 4 times, give up after 60 s without a token, send a second Ollama request if the first token takes over 5 s:")
+    print("  cmi.py -a Ollama::'http://127.0.0.1:11434/api' --llm-resilience 4::60:5")
+    print("- Keep llama.cpp models loaded by any session in up to 32 GB of memory, evicting the least recently used:")
+    print("  cmi.py --llama-memory-budget 32768")
+    print("- Restore llama.cpp states of earlier turns from 4 GB in memory and 20 GB on disk, evaluating only new prompt tokens:")
+    print("  cmi.py --llama-state-cache 4096:20480")
+    print("- Run llama.cpp models in 2 worker processes shared by all sessions, taking turns between sessions:")
+    print("  cmi.py --inference-workers 2")
+    print("- Stream LLM responses of all sessions with one async client, limiting concurrent streams per API:")
+    print("  cmi.py -a OpenAI:INSERT_KEY --async-llm")
+    print("- Store conversations with gzip-compressed journals, message files and artifacts:")
+    print("  cmi.py -z")
+    print("- Write stored records in batches of up to 256, syncing each batch to disk:")
+    print("  cmi.py --store-writer 256::batch")
+    print("- Store conversations in a SQLite database and import existing logs in", data_store.DIRECTORY + ":")
+    print("  cmi.py -s SQLite --import-logs")
+    print("- Remove stored interpreter inputs and outputs that are no longer referenced by a conversation:")
+    print("  cmi.py --collect-garbage")
+    print("- Compact conversations older than 1 day into daily archives, remove conversations older than 90 days:")
+    print("  cmi.py --apply-retention 1:90:")
+    print("- Print latency statistics of the stored LLM requests by model, e.g., time to first token, tokens per second and time to a valid diagram with and without grammar:")
+    print("  cmi.py --llm-metrics")
     print("")
 
     print("The web-based UI will be started at port <ui_port>, default:", ui_port)
@@ -96,6 +166,186 @@ def set_webui_port(port_spec):
         print("Web-UI port format error:", port_spec)
         sys.exit(1)
 
+def set_data_store(store_spec):
+    """Parses and sets the data store backend"""
+
+    global store_id
+
+    if store_spec in data_store.STORE_IDS:
+        print("Setting data store:", store_spec)
+        store_id = store_spec
+    else:
+        print("Data store format error:", store_spec)
+        sys.exit(1)
+
+def check_data_store():
+    """Exits if the data store options do not apply to the selected data store backend"""
+
+    if store_compression and store_id == data_store.STORE_SQLITE:
+        print("Data store compression is not supported by the data store:", store_id)
+        sys.exit(1)
+
+def create_data_store():
+    """Creates the selected data store backend"""
+
+    check_data_store()
+    if store_id == data_store.STORE_SQLITE:
+        return data_store_sqlite.SQLiteDataStore(writer_batch_size=writer_batch_size, writer_queue_size=writer_queue_size, writer_fsync=writer_fsync)
+    return data_store.DataStore(compression=store_compression, writer_batch_size=writer_batch_size, writer_queue_size=writer_queue_size, writer_fsync=writer_fsync)
+
+def set_data_store_writer(writer_spec):
+    """Parses the batch size, queue size and fsync policy of the background writer of the data store, empty values keep the defaults"""
+
+    global writer_batch_size, writer_queue_size, writer_fsync
+
+    values = writer_spec.split(":")
+    if len(values) > 3 or (len(values) == 3 and values[2] and values[2] not in data_store_writer.FSYNC_MODES):
+        print("Data store writer format error:", writer_spec)
+        sys.exit(1)
+    try:
+        if values[0]:
+            writer_batch_size = int(values[0])
+        if len(values) > 1 and values[1]:
+            writer_queue_size = int(values[1])
+    except ValueError:
+        print("Data store writer format error:", writer_spec)
+        sys.exit(1)
+    if len(values) == 3 and values[2]:
+        writer_fsync = values[2]
+    print("Setting data store writer:", writer_batch_size, writer_queue_size, writer_fsync)
+
+def set_response_cache(ttl_spec):
+    """Parses the time to live of cached LLM responses and enables the response cache"""
+
+    global response_cache_ttl_s
+
+    try:
+        response_cache_ttl_s = float(ttl_spec)
+    except ValueError:
+        print("Response cache TTL format error:", ttl_spec)
+        sys.exit(1)
+    print("Setting LLM response cache TTL [s]:", response_cache_ttl_s)
+
+def set_context_window(context_window_spec):
+    """Parses a context window strategy with an optional maximum number of tokens and enables the context window"""
+
+    global context_window_strategy, context_window_max_tokens
+
+    strategy_max_tokens = context_window_spec.split(":", 1)
+    if strategy_max_tokens[0] not in context_window.CONTEXT_STRATEGIES:
+        print("Context window format error:", context_window_spec)
+        sys.exit(1)
+    context_window_strategy = strategy_max_tokens[0]
+    if len(strategy_max_tokens) == 2 and strategy_max_tokens[1]:
+        try:
+            context_window_max_tokens = int(strategy_max_tokens[1])
+        except ValueError:
+            print("Context window format error:", context_window_spec)
+            sys.exit(1)
+    print("Setting context window:", context_window_strategy, context_window_max_tokens or "")
+
+def set_ollama_keep_alive(keep_alive_spec):
+    """Parses how long Ollama keeps a model loaded after a request: a duration such as 30m, seconds, or -1 for ever"""
+
+    global ollama_keep_alive
+
+    try:
+        ollama_keep_alive = int(keep_alive_spec)
+    except ValueError:
+        ollama_keep_alive = keep_alive_spec
+    print("Setting Ollama keep alive:", ollama_keep_alive)
+
+def set_resilience_policy(resilience_spec):
+    """Parses retries, timeouts and the hedging threshold of LLM requests, empty values keep the defaults"""
+
+    global resilience_parameters
+
+    resilience_parameters = {}
+    names = ["retries", "connect_timeout_s", "read_timeout_s", "hedge_after_s"]
+    values = resilience_spec.split(":")
+    if len(values) > len(names):
+        print("Resilience policy format error:", resilience_spec)
+        sys.exit(1)
+    try:
+        for (name, value) in zip(names, values):
+            if value:
+                resilience_parameters[name] = int(value) if name == "retries" else float(value)
+    except ValueError:
+        print("Resilience policy format error:", resilience_spec)
+        sys.exit(1)
+    print("Setting LLM resilience policy:", resilience_parameters)
+
+def set_llama_memory_budget(budget_spec):
+    """Parses the memory in MB that llama.cpp models loaded by all sessions may take"""
+
+    global llama_memory_budget_bytes
+
+    try:
+        llama_memory_budget_bytes = int(float(budget_spec) * 1024 * 1024)
+    except ValueError:
+        print("llama.cpp memory budget format error:", budget_spec)
+        sys.exit(1)
+    print("Setting llama.cpp memory budget [MB]:", budget_spec)
+
+def set_llama_state_cache(cache_spec):
+    """Parses the memory and optional disk space in MB for llama.cpp states and enables the state cache"""
+
+    global llama_state_cache_bytes, llama_state_spill_bytes
+
+    try:
+        sizes = [int(float(s) * 1024 * 1024) if s else 0 for s in cache_spec.split(":", 1)]
+    except ValueError:
+        print("llama.cpp state cache format error:", cache_spec)
+        sys.exit(1)
+    llama_state_cache_bytes = sizes[0]
+    if len(sizes) == 2:
+        llama_state_spill_bytes = sizes[1]
+    print("Setting llama.cpp state cache [MB]:", cache_spec)
+
+def set_inference_workers(workers_spec):
+    """Parses the number of worker processes running local LLMs"""
+
+    global inference_workers
+
+    try:
+        inference_workers = int(workers_spec)
+    except ValueError:
+        print("Inference workers format error:", workers_spec)
+        sys.exit(1)
+    print("Setting inference workers:", inference_workers)
+
+def apply_retention(retention_spec):
+    """Parses a retention policy and applies it to the logs of the selected data store"""
+
+    policy_parameters = retention_spec.split(":")
+    try:
+        policy_parameters = [float(p) if p else None for p in policy_parameters] + [None] * (3 - len(policy_parameters))
+    except ValueError:
+        print("Retention policy format error:", retention_spec)
+        sys.exit(1)
+    (compact_after_days, max_age_days, max_size_mb) = policy_parameters[0:3]
+    max_size_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb is not None else None
+
+    policy = retention.RetentionPolicy(compact_after_days, max_age_days, max_size_bytes)
+    store = create_data_store()
+    conversations = policy.apply(store)
+    store.close()
+    print("Retained", conversations, "conversations")
+
+def print_llm_metrics():
+    """Prints statistics of the metrics of the LLM requests stored in the selected data store by LLM"""
+
+    store = create_data_store()
+    aggregated = llm_metrics.aggregate_metrics(store.get_llm_metrics())
+    store.close()
+    for (llm, metrics) in aggregated.items():
+        print(llm, "-", metrics[llm_metrics.REQUESTS], "requests,", metrics[llm_metrics.CACHED_REQUESTS], "cached")
+        for metric in llm_metrics.AGGREGATED_METRICS:
+            if metric in metrics:
+                s = metrics[metric]
+                print("  {}: mean {:.4g}, p50 {:.4g}, p90 {:.4g}, p99 {:.4g}".format(
+                    metric, s[llm_metrics.MEAN], s[llm_metrics.P50], s[llm_metrics.P90], s[llm_metrics.P99]))
+
 def activate_streamlit():
     """Activates the Streamlit web UI if it has not been activated before"""
 
@@ -130,14 +380,36 @@ class CMI:
         if not self.conversational_ui:
 
             # LLM Local
-            self.llm_api_client = llm_api_client.LLMApiClient()
-            self.llm_runtime = llm_runtime.LLMRuntime()
+            cache = None
+            if response_cache_ttl_s is not None:
+                cache = response_cache.get_shared_cache(response_cache_ttl_s)
+            window = None
+            if context_window_strategy:
+                window = context_window.ContextWindow(context_window_strategy, context_window_max_tokens)
+            resilience = None
+            if resilience_parameters is not None:
+                resilience = llm_resilience.ResiliencePolicy(**resilience_parameters)
+            self.llm_api_client = llm_api_client.LLMApiClient(cache, async_llm_streams, window, ollama_api, ollama_keep_alive, resilience)
+            if inference_workers > 0:
+                worker_config = {
+                    "context_window_strategy": context_window_strategy,
+                    "context_window_max_tokens": context_window_max_tokens,
+                    "memory_budget_bytes": llama_memory_budget_bytes,
+                    "state_cache_bytes": llama_state_cache_bytes,
+                    "state_spill_bytes": llama_state_spill_bytes
+                }
+                self.llm_runtime = inference_worker.WorkerLLMRuntime(inference_worker.get_shared_pool(inference_workers, worker_config))
+            else:
+                state_cache = None
+                if llama_state_cache_bytes is not None:
+                    state_cache = llama_state_cache.get_shared_cache(llama_state_cache_bytes, llama_state_spill_bytes)
+                self.llm_runtime = llm_runtime.LLMRuntime(window, llama_model_pool.get_shared_pool(llama_memory_budget_bytes), state_cache)
 
             # Interpreter
             self.interpreter_runtime = interpreter_runtime.InterpreterRuntime()
             
             # Data Store
-            self.data_store = data_store.DataStore()
+            self.data_store = create_data_store()
 
             # Conversation
             self.conversation_manager = conversation_manager.ConversationManager(api_keys, api_endpoints, self.llm_api_client, self.llm_runtime, self.interpreter_runtime, self.data_store)
@@ -153,42 +425,97 @@ def parse_cli():
     """Parse command line interface options and arguments"""
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "a:p:h",
-            ["help", "api=", "port=", "streamlit-startup"])
+        opts, args = getopt.getopt(sys.argv[1:], "a:p:s:zc:w:h",
+            ["help", "api=", "port=", "store=", "compress-logs", "store-writer=", "response-cache=", "context-window=", "async-llm", "ollama-chat", "ollama-keep-alive=", "llm-resilience=", "llama-memory-budget=", "llama-state-cache=", "inference-workers=", "convert-logs", "import-logs", "collect-garbage", "apply-retention=", "llm-metrics", "streamlit-startup"])
 
     except getopt.GetoptError as err:
         print(err)
         print_usage()
 
     global streamlit_activated
+    global store_compression
+    global async_llm_streams
+    global ollama_api
         
     for opt, arg in opts:
         if opt in ("-a", "--api"):
             set_api_parameters(arg.strip())
         elif opt in ("-p", "--port"):
             set_webui_port(arg.strip())
+        elif opt in ("-s", "--store"):
+            set_data_store(arg.strip())
+        elif opt in ("--store-writer"):
+            set_data_store_writer(arg.strip())
+        elif opt in ("-c", "--response-cache"):
+            set_response_cache(arg.strip())
+        elif opt in ("-w", "--context-window"):
+            set_context_window(arg.strip())
+        elif opt in ("--async-llm"):
+            print("Setting async LLM streams")
+            async_llm_streams = True
+        elif opt in ("--ollama-chat"):
+            print("Setting Ollama chat API")
+            ollama_api = llm_api_client.OLLAMA_API_CHAT
+        elif opt in ("--ollama-keep-alive"):
+            set_ollama_keep_alive(arg.strip())
+        elif opt in ("--llm-resilience"):
+            set_resilience_policy(arg.strip())
+        elif opt in ("--llama-memory-budget"):
+            set_llama_memory_budget(arg.strip())
+        elif opt in ("--llama-state-cache"):
+            set_llama_state_cache(arg.strip())
+        elif opt in ("--inference-workers"):
+            set_inference_workers(arg.strip())
+        elif opt in ("-z", "--compress-logs"):
+            print("Setting data store compression")
+            store_compression = True
         elif opt in ("-h", "--help"):
             print_usage()
             sys.exit()
+        elif opt in ("--convert-logs"):
+            converted = data_store.convert_log_directory(data_store.DIRECTORY)
+            print("Converted", len(converted), "log files")
+            sys.exit()
+        elif opt in ("--import-logs"):
+            store = data_store_sqlite.SQLiteDataStore(background_writer=False)
+            imported = store.import_log_directory(data_store.DIRECTORY)
+            store.close()
+            print("Imported", imported, "conversations")
+            sys.exit()
+        elif opt in ("--collect-garbage"):
+            store = create_data_store()
+            (removed_files, removed_bytes) = store.collect_garbage()
+            store.close()
+            print("Removed", removed_files, "artifacts,", removed_bytes, "bytes")
+            sys.exit()
+        elif opt in ("--apply-retention"):
+            apply_retention(arg.strip())
+            sys.exit()
+        elif opt in ("--llm-metrics"):
+            print_llm_metrics()
+            sys.exit()
         elif opt in ("--streamlit-startup"):
             streamlit_activated = True
         else:
             print(CMI_TITLE, CMI_VERSION)
 
+    check_data_store()
 
-if SESSION_KEY_CMI in st.session_state:
-    # ongoing session
-    cmi = st.session_state[SESSION_KEY_CMI]
-else:
-    # initial startup
-    parse_cli()
-    if not streamlit_activated:
-        activate_streamlit()
-    cmi = CMI()
-    st.session_state[SESSION_KEY_CMI] = cmi
-    cmi.load_components()
-    cmi.conversation_manager.set_available_models()
-    cmi.conversation_manager.set_available_interpreters()
 
-# update the web UI
-cmi.conversational_ui.update_web_ui()
+if __name__ != "__mp_main__":
+    if SESSION_KEY_CMI in st.session_state:
+        # ongoing session
+        cmi = st.session_state[SESSION_KEY_CMI]
+    else:
+        # initial startup
+        parse_cli()
+        if not streamlit_activated:
+            activate_streamlit()
+        cmi = CMI()
+        st.session_state[SESSION_KEY_CMI] = cmi
+        cmi.load_components()
+        cmi.conversation_manager.set_available_interpreters()
+
+    # update the web UI, with models refreshed in the background since the last update
+    cmi.conversation_manager.set_available_models()
+    cmi.conversational_ui.update_web_ui()
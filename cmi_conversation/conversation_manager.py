@@ -1,11 +1,20 @@
 import sys
 import os
 import re
+import json
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from time import perf_counter_ns
+from types import MappingProxyType
 
 import cmi_llm_local.llm_api_client as llm_api_client
 import cmi_llm_local.llm_runtime as llm_runtime
+import cmi_llm_local.model_catalog as model_catalog
+import cmi_llm_local.llm_metrics as llm_metrics
 import cmi_interpreter.interpreter_runtime as interpreter_runtime
+import cmi_interpreter.source_matcher as source_matcher
 
 API_ID_LIST = llm_api_client.LLM_API_IDS + interpreter_runtime.INT_API_IDS
 INT_API_ID_LIST = interpreter_runtime.INT_API_IDS
@@ -17,6 +26,38 @@ INT_BY_ID_PRECONFIGURED = interpreter_runtime.INT_BY_ID
 LLM_UNSELECTED = '<Select Model>'
 INT_UNSELECTED = '<Select Interpreter>'
 
+# Events sent by fan-out workers as tuples (llm_id, event, value)
+FAN_OUT_TOKEN = "token"
+FAN_OUT_INT_RESULT = "int_result"
+FAN_OUT_ERROR = "error"
+FAN_OUT_DONE = "done"
+
+# Statistics of a fan-out worker
+FAN_OUT_RESPONSE = "response"
+FAN_OUT_SOURCE = "source"
+FAN_OUT_INT_INPUT = "int_input"
+FAN_OUT_INT_OUTPUT = "int_output"
+FAN_OUT_LLM_DURATION_NS = "llm_duration_ns"
+FAN_OUT_FIRST_TOKEN_NS = "first_token_ns"
+FAN_OUT_INT_DURATION_NS = "int_duration_ns"
+FAN_OUT_SUCCESS = "success"
+FAN_OUT_METRICS = "metrics"
+# error message of a failed LLM request, None otherwise
+FAN_OUT_FAILURE = "failure"
+
+# Default number of prompts of a batch run concurrently in independent batch mode
+BATCH_WORKERS = 4
+
+# Responses streamed to the end after the source was complete, used to estimate the savings of stopping early
+STREAM_TAIL_SAMPLES = 32
+
+def close_stream(items):
+    """Closes a response stream consumed only partially, which cancels the upstream request"""
+
+    close = getattr(items, "close", None)
+    if close:
+        close()
+
 class ConversationManager:
     """Manages the selected LLM and interpreter with parameters"""
 
@@ -25,11 +66,15 @@ class ConversationManager:
         self.api_keys = api_keys
         self.api_endpoints = api_endpoints
         self.available_models_loaded = False
+        self.available_models_version = None
         self.available_interpreters_loaded = False
         self.llm_api_client = llm_api_client
         self.llm_runtime = llm_runtime
         self.interpreter_runtime = interpreter_runtime
         self.data_store = data_store
+        # models queried from the APIs, shared by all sessions and refreshed in the background
+        self.model_catalog = model_catalog.get_shared_catalog(
+            lambda: self.llm_api_client.query_available_models(self.api_keys, self.api_endpoints), json.dumps(api_endpoints, sort_keys=True))
         self.conversational_ui = None
         self.selected_llm_id = LLM_UNSELECTED
         self.selected_int_id = INT_UNSELECTED
@@ -37,6 +82,20 @@ class ConversationManager:
         self.llm_parameters_default = None
         self.int_parameters = None
         self.int_parameters_default = None
+        self.fan_out_llm_ids = []
+        # stop LLM streams once the source for the interpreter is complete
+        self.stop_on_complete = False
+        # stream items and seconds after the source was complete in responses streamed to the end
+        self.stream_tails = deque(maxlen=STREAM_TAIL_SAMPLES)
+        # constrain the output of local LLMs by the grammar of the selected interpreter
+        self.constrain_output = False
+        # metrics of the last request entered, and of a response whose source is being rendered
+        self.request_metrics = None
+        self.diagram_metrics = None
+        # prompt whose diagram did not render yet, with the submit time of its first LLM run and the runs so far
+        self.diagram_prompt = None
+        self.diagram_t_submit = None
+        self.diagram_runs = 0
 
     def set_conversational_ui(self, conversational_ui):
         self.conversational_ui = conversational_ui
@@ -60,6 +119,34 @@ class ConversationManager:
 
         return False
     
+    def select_fan_out_llms(self, llm_ids):
+        """Selects LLMs a prompt is run against concurrently; with less than two LLMs, fan-out is disabled"""
+
+        self.fan_out_llm_ids = [llm_id for llm_id in llm_ids if llm_id in self.get_fan_out_llms()]
+
+    def is_fan_out_selected(self):
+        return len(self.fan_out_llm_ids) > 1
+
+    def get_fan_out_context_llm_id(self):
+        """Returns the LLM of a fan-out whose response continues the conversation: the selected LLM, or else the first"""
+
+        if self.selected_llm_id in self.fan_out_llm_ids:
+            return self.selected_llm_id
+        return self.fan_out_llm_ids[0]
+
+    def get_fan_out_llms(self):
+        """Returns the available LLMs that run through an API and can be run concurrently"""
+
+        return [llm_id for llm_id in self.available_models.keys() if self.get_llm_api_id(llm_id)]
+
+    def get_llm_api_id(self, llm_id):
+        """Returns the API of the given LLM, or None for LLMs of a local runtime"""
+
+        for api_id in LLM_API_ID_LIST:
+            if llm_id.startswith(api_id):
+                return api_id
+        return None
+
     def is_llm_selected(self):
         return self.selected_llm_id != LLM_UNSELECTED
     
@@ -67,12 +154,17 @@ class ConversationManager:
         return self.selected_int_id != INT_UNSELECTED
 
     def set_available_models(self):
-        """Sets available models from each API that is enabled by setting an API key or endpoint"""
+        """
+        Sets available models from each API that is enabled by setting an API key or endpoint, as immutable 
+        snapshot of the model catalog. The last known models are used while the catalog is refreshed, a newer 
+        snapshot is set on the next call.
+        """
 
-        if not self.available_models_loaded:
+        (catalog_models, version) = self.model_catalog.snapshot()
+        if not self.available_models_loaded or version != self.available_models_version:
             self.available_models_loaded = True
-            self.llm_api_client.query_available_models(self.api_keys, self.api_endpoints)
-            self.available_models = {LLM_UNSELECTED:''} | llm_api_client.LLM_BY_ID | llm_runtime.LLM_BY_ID
+            self.available_models_version = version
+            self.available_models = MappingProxyType({LLM_UNSELECTED:''} | llm_api_client.LLM_BY_ID | dict(catalog_models) | llm_runtime.LLM_BY_ID)
             self.conversational_ui.set_available_models(self.available_models)
 
     def set_available_interpreters(self):
@@ -189,11 +281,17 @@ class ConversationManager:
     def enter_prompt(self, context, prompt):
         """
         Executes a prompt string with the given context as message array.
-        Returns the response as tuple (items_wrapped, item_function) where item_function is a 
-        lambda function extracting the wrapped response items.
+        Returns the response as tuple (items_wrapped, item_function, t_start) where item_function is a 
+        lambda function extracting the wrapped response items, and t_start the time the request was started
+        in ns, as measured by perf_counter_ns.
         """
         print("Prompt:", prompt)
 
+        # re-runs of a prompt count towards the time until its diagram rendered
+        if prompt != self.diagram_prompt:
+            (self.diagram_prompt, self.diagram_t_submit, self.diagram_runs) = (prompt, None, 0)
+        self.diagram_runs += 1
+
         # store LLM configuration and prompt
         self.data_store.set_llm_configuration(self.selected_llm_id, self.llm_parameters)
         self.data_store.set_interpreter_configuration(self.selected_int_id, self.int_parameters)
@@ -206,7 +304,8 @@ class ConversationManager:
                 print("LLM parameters:", self.llm_parameters)
                 print("Interpreter parameters:", self.int_parameters)
                 t_start = perf_counter_ns()
-                (items_wrapped, item_function) = self.llm_api_client.request_run_prompt(context, prompt)
+                (items_wrapped, item_function) = self.llm_api_client.request_run_prompt(context, prompt, self.data_store.conversation_id, t_start)
+                self.request_metrics = self.llm_api_client.request_metrics
                 break
 
         # run prompt with a runtime
@@ -215,16 +314,254 @@ class ConversationManager:
 
                 print("LLM parameters:", self.llm_parameters)
                 print("Interpreter parameters:", self.int_parameters)
-                (items_wrapped, item_function) = self.llm_runtime.run_prompt(context)
+                grammar = None
+                if self.constrain_output and self.is_int_selected():
+                    grammar = self.interpreter_runtime.get_grammar()
+                    print("Constraining LLM output by the grammar for", self.selected_int_id)
+                t_start = perf_counter_ns()
+                self.request_metrics = llm_metrics.LLMRequestMetrics(t_start)
+                self.request_metrics.grammar = grammar is not None
+                (items_wrapped, item_function) = self.llm_runtime.run_prompt(context, prompt, self.request_metrics, grammar)
                 break
+
+        if self.diagram_t_submit is None:
+            self.diagram_t_submit = t_start
+        if self.request_metrics:
+            self.request_metrics.llm_runs = self.diagram_runs
         
         return (items_wrapped, item_function, t_start)
     
+    def stream_llm_response(self, items_wrapped, item_function, t_start, metrics=None):
+        """
+        Yields the text of the streamed response items, marked as tokens in the given request metrics. With an 
+        interpreter selected, the response is watched for the complete source; in stop-on-complete mode, the 
+        stream is then closed. Stream items (about one token each) and seconds after the source are logged as 
+        saved, or as could have been saved.
+        """
+
+        matcher = source_matcher.get_source_matcher(self.selected_int_id) if self.is_int_selected() else None
+        (items, items_complete, t_complete) = (0, None, None)
+        try:
+            for item in items_wrapped:
+                text = item_function(item)
+                items += 1
+                if metrics:
+                    metrics.add_token()
+                if matcher and items_complete is None and matcher.feed(text):
+                    (items_complete, t_complete) = (items, perf_counter_ns())
+                    if self.stop_on_complete:
+                        # text of the item after the source is dropped
+                        yield text[0:len(text) - (matcher.length - matcher.end)]
+                        break
+                yield text
+        finally:
+            close_stream(items_wrapped)
+
+        if items_complete is None:
+            return
+        # close a code block the source was streamed in
+        if self.stop_on_complete and matcher.text[0:matcher.end].count("```") % 2 == 1:
+            yield "\n```"
+        if self.stop_on_complete:
+            message = "Stopped LLM stream once the source was complete after {} items, {:.2f} s".format(items, (t_complete - t_start) / 1e9)
+            if self.stream_tails:
+                (tail_items, tail_s) = [sum(t) / len(self.stream_tails) for t in zip(*self.stream_tails)]
+                message += ", saved about {:.0f} items, {:.2f} s".format(tail_items, tail_s)
+            print(message)
+        else:
+            tail = (items - items_complete, (perf_counter_ns() - t_complete) / 1e9)
+            self.stream_tails.append(tail)
+            print("Source complete after {} of {} LLM stream items, stopping would have saved {} items, {:.2f} s".format(items_complete, items, *tail))
+
+    def create_llm_api_client(self, llm_id, llm_parameters=None):
+        """
+        Creates an LLM API client for the given LLM with the given or default parameters, sharing the response 
+        cache, the async client, the context window, the Ollama options and the resilience policy
+        """
+
+        client = llm_api_client.LLMApiClient(self.llm_api_client.response_cache, self.llm_api_client.async_client is not None, 
+                                             self.llm_api_client.context_window, self.llm_api_client.ollama_api, 
+                                             self.llm_api_client.ollama_keep_alive, self.llm_api_client.resilience_policy)
+        for api_id in LLM_API_ID_LIST:
+            if llm_id.startswith(api_id):
+                if llm_parameters is None:
+                    llm_parameters = llm_api_client.PARAMETER_DEFAULTS[api_id].copy()
+                api_key = self.api_keys.get(api_id, "")
+                api_endpoint = self.api_endpoints.get(api_id, "")
+                client.initialize_llm(llm_id, self.available_models[llm_id], llm_parameters, api_key, api_endpoint)
+                break
+        return client
+
+    def enter_prompt_fan_out(self, context, prompt, llm_ids):
+        """
+        Runs a prompt with the given context against several LLMs concurrently, one worker thread per LLM. 
+        Returns a queue of events (llm_id, event, value): streamed tokens, the interpreter result as tuple 
+        (int_input, int_output) as soon as the source code of a response is complete, and finally statistics.
+        """
+        print("Prompt (fan-out to {} LLMs):".format(len(llm_ids)), prompt)
+
+        self.data_store.set_interpreter_configuration(self.selected_int_id, self.int_parameters)
+        self.data_store.insert_prompt(prompt)
+
+        events = queue.Queue()
+        for llm_id in llm_ids:
+            client = self.create_llm_api_client(llm_id)
+            worker = threading.Thread(target=self.run_fan_out_worker, args=(client, llm_id, context, prompt, events, self.interpreter_runtime.copy()), daemon=True)
+            worker.start()
+        return events
+
+    def run_fan_out_worker(self, client, llm_id, context, prompt, events, interpreter, t_submit=None):
+        """
+        Streams the response of one LLM and runs the given interpreter runtime, a copy owned by the worker, once 
+        the source code is complete. Events are identified by the given LLM id or another key, e.g., the index of 
+        a prompt of a batch. Request metrics include the time queued since the given submit time.
+        """
+
+        stats = {
+            FAN_OUT_RESPONSE: "",
+            FAN_OUT_SOURCE: None,
+            FAN_OUT_INT_INPUT: None,
+            FAN_OUT_INT_OUTPUT: None,
+            FAN_OUT_LLM_DURATION_NS: 0,
+            FAN_OUT_FIRST_TOKEN_NS: None,
+            FAN_OUT_INT_DURATION_NS: 0,
+            FAN_OUT_SUCCESS: False,
+            FAN_OUT_METRICS: None,
+            FAN_OUT_FAILURE: None
+        }
+
+        # the response is parsed for the source once the matcher found it complete, not on each token
+        matcher = source_matcher.get_source_matcher(self.selected_int_id) if self.is_int_selected() else None
+        tokens = []
+        t_start = perf_counter_ns()
+        try:
+            (items_wrapped, item_function) = client.request_run_prompt(context, prompt, self.data_store.conversation_id, t_submit)
+            for token in self.stream_llm_response(items_wrapped, item_function, t_start, client.request_metrics):
+                if stats[FAN_OUT_FIRST_TOKEN_NS] is None:
+                    stats[FAN_OUT_FIRST_TOKEN_NS] = perf_counter_ns() - t_start
+                tokens.append(token)
+                events.put((llm_id, FAN_OUT_TOKEN, token))
+                if matcher and matcher.end is None and matcher.feed(token):
+                    source = self.process_llm_response("".join(tokens))
+                    if source:
+                        self.run_fan_out_interpreter(llm_id, source, stats, events, interpreter)
+            stats[FAN_OUT_RESPONSE] = "".join(tokens)
+            stats[FAN_OUT_LLM_DURATION_NS] = perf_counter_ns() - t_start
+            stats[FAN_OUT_METRICS] = client.request_metrics.get_record()
+
+            # source code not followed by the end of a code block is complete at the end of the response
+            if stats[FAN_OUT_SOURCE] is None and self.is_int_selected():
+                source = self.process_llm_response(stats[FAN_OUT_RESPONSE])
+                if source:
+                    self.run_fan_out_interpreter(llm_id, source, stats, events, interpreter)
+
+            stats[FAN_OUT_SUCCESS] = stats[FAN_OUT_INT_OUTPUT] is not None or not self.is_int_selected()
+        except Exception as e:
+            stats[FAN_OUT_RESPONSE] = "".join(tokens)
+            stats[FAN_OUT_LLM_DURATION_NS] = perf_counter_ns() - t_start
+            stats[FAN_OUT_FAILURE] = str(e)
+            events.put((llm_id, FAN_OUT_ERROR, str(e)))
+
+        events.put((llm_id, FAN_OUT_DONE, stats))
+
+    def run_fan_out_interpreter(self, llm_id, source, stats, events, interpreter):
+        stats[FAN_OUT_SOURCE] = source
+        t_start = perf_counter_ns()
+        (int_input_modified, int_output) = interpreter.run_syntax(source)
+        stats[FAN_OUT_INT_DURATION_NS] = perf_counter_ns() - t_start
+        stats[FAN_OUT_INT_INPUT] = int_input_modified
+        stats[FAN_OUT_INT_OUTPUT] = int_output
+        events.put((llm_id, FAN_OUT_INT_RESULT, (int_input_modified, int_output)))
+
+    def record_worker_result(self, stats):
+        """Stores the response and interpreter input and output of a worker"""
+
+        self.data_store.insert_llm_response(stats[FAN_OUT_RESPONSE], stats[FAN_OUT_LLM_DURATION_NS])
+        if stats[FAN_OUT_INT_INPUT] is not None:
+            self.data_store.insert_interpreter_input(stats[FAN_OUT_INT_INPUT])
+            self.data_store.insert_interpreter_output(stats[FAN_OUT_INT_OUTPUT] or "no output", stats[FAN_OUT_INT_DURATION_NS])
+        if stats[FAN_OUT_METRICS]:
+            self.data_store.insert_llm_metrics(stats[FAN_OUT_METRICS])
+
+    def record_fan_out_result(self, llm_id, stats):
+        """Stores the response, interpreter input and output and the statistics of one LLM of a fan-out"""
+
+        self.data_store.set_llm_configuration(llm_id, llm_api_client.PARAMETER_DEFAULTS[self.get_llm_api_id(llm_id)])
+        self.record_worker_result(stats)
+        self.data_store.insert_fan_out_result(llm_id, stats[FAN_OUT_LLM_DURATION_NS], stats[FAN_OUT_FIRST_TOKEN_NS], 
+                                              stats[FAN_OUT_INT_DURATION_NS], stats[FAN_OUT_SUCCESS])
+        # messages stored later belong to the LLM of the session again
+        self.data_store.set_llm_configuration(self.selected_llm_id, self.llm_parameters)
+
+    def is_batch_concurrent(self):
+        """Returns True if prompts of the selected LLM can be run concurrently, i.e., the LLM runs through an API"""
+
+        return self.get_llm_api_id(self.selected_llm_id) is not None
+
+    def enter_prompts_independent(self, context_init, prompts, workers=BATCH_WORKERS):
+        """
+        Runs prompts that do not depend on each other concurrently with the given number of workers, each 
+        prompt with the given initial context only. Returns a queue of events (index, event, value) as in 
+        fan-out mode, where index is the position of the prompt.
+        """
+        print("Prompts (independent batch with {} workers):".format(workers), len(prompts))
+
+        events = queue.Queue()
+        executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="cmi-batch")
+        for (i, prompt) in enumerate(prompts):
+            context = context_init + [{llm_api_client.ROLE: llm_api_client.ROLE_US, llm_api_client.MSG: prompt, llm_api_client.MSG_FORMAT: llm_api_client.MSG_FORMAT_PROMPT}]
+            client = self.create_llm_api_client(self.selected_llm_id, self.llm_parameters)
+            executor.submit(self.run_fan_out_worker, client, i, context, prompt, events, self.interpreter_runtime.copy(), perf_counter_ns())
+        executor.shutdown(wait=False)
+        return events
+
+    def record_batch_result(self, prompt, stats):
+        """Stores the prompt, response and interpreter input and output of a prompt of an independent batch"""
+
+        self.data_store.set_llm_configuration(self.selected_llm_id, self.llm_parameters)
+        self.data_store.set_interpreter_configuration(self.selected_int_id, self.int_parameters)
+        self.data_store.insert_prompt(prompt)
+        self.record_worker_result(stats)
+
     def record_llm_response(self, llm_response, execution_duration):
         """
-        Stores an LLM response and the execution time. 
+        Stores an LLM response and the execution time with the metrics of its request. If the response contains 
+        source for the selected interpreter, the metrics are stored once the source was rendered.
         """
         self.data_store.insert_llm_response(llm_response, execution_duration)
+        if self.diagram_metrics:
+            # e.g., the interpreter failed
+            self.record_diagram(False)
+        if self.request_metrics:
+            if self.is_int_selected():
+                self.request_metrics.source_found = self.process_llm_response(llm_response) is not None
+            if self.request_metrics.source_found:
+                self.diagram_metrics = self.request_metrics
+            else:
+                self.insert_request_metrics(self.request_metrics)
+            self.request_metrics = None
+
+    def record_diagram(self, valid):
+        """Stores the metrics of the response whose source was rendered, with the time to a valid diagram"""
+
+        metrics = self.diagram_metrics
+        self.diagram_metrics = None
+        metrics.diagram_valid = valid
+        if valid:
+            metrics.diagram_ns = perf_counter_ns() - self.diagram_t_submit
+            print("Diagram valid after {} LLM runs, {:.2f} s".format(metrics.llm_runs, metrics.diagram_ns / 1e9))
+            self.diagram_prompt = None
+        self.insert_request_metrics(metrics)
+
+    def insert_request_metrics(self, metrics):
+        record = metrics.get_record()
+        print("LLM metrics:", record)
+        self.data_store.insert_llm_metrics(record)
+
+    def get_llm_metrics(self, llm=None, since=None):
+        """Returns statistics of the metrics of stored LLM requests by LLM, see llm_metrics.aggregate_metrics"""
+
+        return llm_metrics.aggregate_metrics(self.data_store.get_llm_metrics(llm, since))
 
     def process_llm_response(self, llm_response):
         """
@@ -268,8 +605,15 @@ class ConversationManager:
         output = None
 
         t_start = perf_counter_ns()
-        (int_input_modified, int_output) = self.interpreter_runtime.run_syntax(int_input)
+        try:
+            (int_input_modified, int_output) = self.interpreter_runtime.run_syntax(int_input)
+        except Exception:
+            if self.diagram_metrics:
+                self.record_diagram(False)
+            raise
         t_stop = perf_counter_ns()
+        if self.diagram_metrics:
+            self.record_diagram(bool(int_output))
 
         self.data_store.set_interpreter_configuration(self.selected_int_id, self.int_parameters)
         self.data_store.insert_interpreter_input(int_input_modified)
@@ -286,11 +630,11 @@ class ConversationManager:
         return (int_input_modified, output)
 
     def clear_chat_history(self, init_message):
-        self.llm_api_client.clear_returned_context()
+        self.llm_api_client.clear_returned_context(self.data_store.conversation_id)
         self.llm_runtime.clear_returned_context()
         self.data_store.create_conversation(init_message)
 
     def remove_last_message(self):
-        self.llm_api_client.clear_returned_context()
+        # contexts returned by Ollama are kept per dialogue, the context of the remaining dialogue is continued
         self.llm_runtime.clear_returned_context()
         self.data_store.insert_message("Last message removed")
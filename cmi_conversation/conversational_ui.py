@@ -9,6 +9,7 @@ import streamlit as st
 from streamlit.web import cli as stweb
 
 import cmi_conversation.conversation_manager as conversation_manager
+import cmi_llm_local.llm_resilience as llm_resilience
 
 SESSION_KEY_MESSAGES = "messages/"
 SESSION_KEY_CONTEXT_IDS = "context_ids/"
@@ -22,6 +23,11 @@ SESSION_KEY_NEXT_PROMPT_APPEND = "prompt/message/append"
 
 SESSION_KEY_NEXT_INT_INPUT = "int/input"
 
+SESSION_KEY_BATCH_INDEPENDENT = "batch/independent"
+SESSION_KEY_BATCH_WORKERS = "batch/workers"
+SESSION_KEY_STOP_ON_COMPLETE = "llm/stop_on_complete"
+SESSION_KEY_CONSTRAIN_OUTPUT = "llm/constrain_output"
+
 ROLE = "role"
 ROLE_AS = "assistant"
 ROLE_US = "user"
@@ -35,9 +41,13 @@ MSG_FORMAT_PROMPT = "pr"
 MSG_FORMAT_RESPONSE_LLM = "re/llm"
 MSG_FORMAT_RESPONSE_LLM_TXT = "re/llm/txt"
 MSG_FORMAT_RESPONSE_LLM_CODE = "re/llm/code"
+MSG_FORMAT_RESPONSE_LLM_ERR = "re/llm/err"
 MSG_FORMAT_RESPONSE_INT = "re/int"
 MSG_FORMAT_RESPONSE_INT_TXT = "re/int/txt"
 MSG_FORMAT_RESPONSE_INT_IMG = "re/int/img"
+MSG_DISPLAY_ONLY = "display_only"
+# LLM of a response of a fan-out, shown with the response
+MSG_LLM = "llm"
 MSG_RERUN_LLM = "rerun/llm"
 MSG_RERUN_INT = "rerun/int"
 
@@ -135,11 +145,11 @@ class ConversationalUI:
         def hide_file_uploader():
             st.session_state["show_file_uploader"] = False
 
-        def insert_llm_response(llm_response, source, allow_rerun=True, placeholder=None):
+        def insert_llm_response(llm_response, source, allow_rerun=True, placeholder=None, llm_id=None):
             if placeholder is None:
                 with st.expander("LLM Response", expanded=False):
                     placeholder = st.empty()
-                    placeholder.markdown(llm_response)
+                    placeholder.markdown(f"**{llm_id}**  \n" + llm_response if llm_id else llm_response)
                             
             self.message_id += 1
 
@@ -184,14 +194,15 @@ class ConversationalUI:
                     # get reponse items and un-wrap using the provided function
                     items_wrapped = []
                     item_function = lambda item: item
+                    placeholder = None
                     try:
                         (items_wrapped, item_function, t_start) = self.conversation_manager.enter_prompt(context, prompt)
                         with st.expander("LLM Response", expanded=True):
                             #rerun_text = st.text_area("Edit:", height=400, value=llm_response)
                             #st.text("")
                             placeholder = st.empty()
-                            for item in items_wrapped:
-                                llm_response += item_function(item)
+                            for text in self.conversation_manager.stream_llm_response(items_wrapped, item_function, t_start, self.conversation_manager.request_metrics):
+                                llm_response += text
                                 placeholder.markdown(llm_response + "▌")
                             t_stop = perf_counter_ns()
                             execution_duration = (t_stop-t_start)
@@ -201,7 +212,9 @@ class ConversationalUI:
                         st.session_state[SESSION_KEY_MESSAGES][-1][SRC] = source
                         # show response
                         insert_llm_response(llm_response, source, placeholder=placeholder)
-                    except requests.exceptions.ChunkedEncodingError as e:
+                    except (requests.exceptions.ChunkedEncodingError, llm_resilience.LLMStreamError) as e:
+                        if placeholder is None:
+                            placeholder = st.empty()
                         placeholder.markdown(e)
                         st.button("Retry", on_click=remove_responses_and_rerun_llm, key="retry/llm/placeholder/error")
 
@@ -211,6 +224,93 @@ class ConversationalUI:
 
             return (llm_response, execution_duration)
 
+        # Execute prompt with several LLMs concurrently, streaming each response into its own column
+        def run_llm_fan_out(prompt):
+            llm_ids = self.conversation_manager.fan_out_llm_ids
+            context = st.session_state[SESSION_KEY_MESSAGES]
+
+            with st.chat_message(ROLE_AS):
+                columns = st.columns(len(llm_ids))
+                placeholders = {}
+                for (llm_id, column) in zip(llm_ids, columns):
+                    column.caption(llm_id)
+                    placeholders[llm_id] = (column.empty(), column.empty())
+
+                responses = {llm_id: "" for llm_id in llm_ids}
+                results = {}
+                with st.spinner(f"Running Inference: {len(llm_ids)} models ..."):
+                    events = self.conversation_manager.enter_prompt_fan_out(context, prompt, llm_ids)
+                    while len(results) < len(llm_ids):
+                        (llm_id, event, value) = events.get()
+                        (response_placeholder, int_placeholder) = placeholders[llm_id]
+                        if event == conversation_manager.FAN_OUT_TOKEN:
+                            responses[llm_id] += value
+                            response_placeholder.markdown(responses[llm_id] + "▌")
+                        elif event == conversation_manager.FAN_OUT_INT_RESULT:
+                            (int_input, int_output) = value
+                            if int_output:
+                                int_placeholder.image(int_output)
+                            else:
+                                int_placeholder.write("No interpreter result")
+                        elif event == conversation_manager.FAN_OUT_ERROR:
+                            int_placeholder.error(value, icon='⚠️')
+                        elif event == conversation_manager.FAN_OUT_DONE:
+                            response_placeholder.markdown(responses[llm_id])
+                            results[llm_id] = value
+
+            # store and append responses to session state in the order of the selected models; only the response of
+            # the LLM selected for the session, or else of the first model, continues the conversation
+            context_llm_id = self.conversation_manager.get_fan_out_context_llm_id()
+            for llm_id in llm_ids:
+                stats = results[llm_id]
+                self.conversation_manager.record_fan_out_result(llm_id, stats)
+                message = {ROLE: ROLE_AS, MSG: stats[conversation_manager.FAN_OUT_RESPONSE], MSG_LLM: llm_id,
+                           MSG_FORMAT: MSG_FORMAT_RESPONSE_LLM_TXT, SRC: stats[conversation_manager.FAN_OUT_SOURCE]}
+                if llm_id != context_llm_id:
+                    message[MSG_DISPLAY_ONLY] = True
+                st.session_state[SESSION_KEY_MESSAGES].append(message)
+                if stats[conversation_manager.FAN_OUT_INT_INPUT] is not None:
+                    if stats[conversation_manager.FAN_OUT_INT_OUTPUT]:
+                        session_storage_int_response(stats[conversation_manager.FAN_OUT_INT_INPUT], int_output=stats[conversation_manager.FAN_OUT_INT_OUTPUT])
+                    else:
+                        session_storage_int_response(stats[conversation_manager.FAN_OUT_INT_INPUT], text_message="No interpreter result")
+
+        # Execute independent prompts concurrently and append results in the original order
+        def run_batch_independent(prompts, workers):
+            context_init = st.session_state[SESSION_KEY_MESSAGES][0:1]
+            results = {}
+
+            with st.chat_message(ROLE_AS):
+                progress = st.progress(0.0)
+                with st.spinner(f"Running Inference: {len(prompts)} prompts with {workers} workers ..."):
+                    events = self.conversation_manager.enter_prompts_independent(context_init, prompts, workers)
+                    while len(results) < len(prompts):
+                        (i, event, value) = events.get()
+                        if event == conversation_manager.FAN_OUT_DONE:
+                            results[i] = value
+                            progress.progress(len(results) / len(prompts), text=f"{len(results)} of {len(prompts)} prompts")
+                        elif event == conversation_manager.FAN_OUT_ERROR:
+                            print("Batch prompt", i, "failed:", value)
+
+            for (i, prompt) in enumerate(prompts):
+                stats = results[i]
+                if stats[conversation_manager.FAN_OUT_FAILURE] is not None:
+                    # failed prompts are shown with their error, but neither stored nor part of the context
+                    st.session_state[SESSION_KEY_MESSAGES].append({ ROLE: ROLE_US, MSG: prompt, MSG_FORMAT: MSG_FORMAT_PROMPT, MSG_DISPLAY_ONLY: True })
+                    st.session_state[SESSION_KEY_MESSAGES].append({ ROLE: ROLE_AS, MSG: "LLM request failed: " + stats[conversation_manager.FAN_OUT_FAILURE], 
+                                                                    MSG_FORMAT: MSG_FORMAT_RESPONSE_LLM_ERR, MSG_DISPLAY_ONLY: True })
+                    continue
+                self.conversation_manager.record_batch_result(prompt, stats)
+                st.session_state[SESSION_KEY_MESSAGES].append({ ROLE: ROLE_US, MSG: prompt, MSG_FORMAT: MSG_FORMAT_PROMPT })
+                message = {ROLE: ROLE_AS, MSG: stats[conversation_manager.FAN_OUT_RESPONSE], 
+                           MSG_FORMAT: MSG_FORMAT_RESPONSE_LLM_TXT, SRC: stats[conversation_manager.FAN_OUT_SOURCE]}
+                st.session_state[SESSION_KEY_MESSAGES].append(message)
+                if stats[conversation_manager.FAN_OUT_INT_INPUT] is not None:
+                    if stats[conversation_manager.FAN_OUT_INT_OUTPUT]:
+                        session_storage_int_response(stats[conversation_manager.FAN_OUT_INT_INPUT], int_output=stats[conversation_manager.FAN_OUT_INT_OUTPUT])
+                    else:
+                        session_storage_int_response(stats[conversation_manager.FAN_OUT_INT_INPUT], text_message="No interpreter result")
+
         # Add interpreter output to session state
         def session_storage_int_response(int_input, int_output=None, text_message=None):
             if text_message:
@@ -297,6 +397,13 @@ class ConversationalUI:
 
                 # batch execution: split batch prompt in multiple prompts
                 prompts = prompt.split("\n\\PROMPT\n")
+
+                # independent batch: prompts do not depend on earlier turns and run concurrently
+                if len(prompts) > 1 and st.session_state.get(SESSION_KEY_BATCH_INDEPENDENT) and self.conversation_manager.is_batch_concurrent():
+                    st.session_state[MSG_RERUN_LLM] = False
+                    run_batch_independent(prompts, st.session_state[SESSION_KEY_BATCH_WORKERS])
+                    st.rerun()
+
                 for prompt in prompts:
 
                     if not st.session_state[MSG_RERUN_LLM]:
@@ -307,6 +414,11 @@ class ConversationalUI:
                             st.write(prompt)
                     st.session_state[MSG_RERUN_LLM] = False
 
+                    # run llms concurrently, including the interpreter
+                    if self.conversation_manager.is_fan_out_selected():
+                        run_llm_fan_out(prompt)
+                        continue
+
                     # run llm
                     (llm_response, llm_execution_duration) = run_llm(prompt)
                     self.conversation_manager.record_llm_response(llm_response, llm_execution_duration)
@@ -404,6 +516,14 @@ class ConversationalUI:
                         llm_param_binding[p] = st.sidebar.number_input(p, key=SESSION_KEY_LLM_UI_INPUT + p)
 
 
+            # Fan-out: run each prompt against several models concurrently
+            fan_out_llms = st.sidebar.multiselect(
+                'Compare models (fan-out)',
+                sorted(self.conversation_manager.get_fan_out_llms()),
+                key='selected_fan_out_llms',
+                help="Runs each prompt against all selected models concurrently, instead of the selected model.")
+            self.conversation_manager.select_fan_out_llms(fan_out_llms)
+
             st.subheader('Interpreter Settings')
 
             # Interpreter selection
@@ -466,6 +586,22 @@ class ConversationalUI:
                 st.session_state["file_uploader_visible"] = False
                 #st.rerun()
 
+            # Stop streaming once the source for the interpreter is complete
+            self.conversation_manager.stop_on_complete = st.sidebar.toggle('Stop when source is complete', key=SESSION_KEY_STOP_ON_COMPLETE,
+                              help="Closes the LLM response once the diagram source for the interpreter is complete, e.g., at @enduml.")
+
+            # Grammar-constrained decoding with local models
+            self.conversation_manager.constrain_output = st.sidebar.toggle('Constrain output to diagram syntax', key=SESSION_KEY_CONSTRAIN_OUTPUT,
+                              help="Lets a local model only generate the source for the interpreter (PlantUML, DOT or BPMN XML) by a grammar. Requires a llama.cpp model.")
+
+            # Batch mode for prompts separated by \PROMPT lines: a sequential conversation or independent prompts
+            st.sidebar.toggle('Independent batch prompts', key=SESSION_KEY_BATCH_INDEPENDENT,
+                              help="Runs prompts of a batch concurrently, each without earlier turns as context. Requires a model running through an API.")
+            if SESSION_KEY_BATCH_WORKERS not in st.session_state.keys():
+                st.session_state[SESSION_KEY_BATCH_WORKERS] = conversation_manager.BATCH_WORKERS
+            st.sidebar.number_input('Batch workers', min_value=1, max_value=64, step=1, key=SESSION_KEY_BATCH_WORKERS,
+                                    disabled=not st.session_state[SESSION_KEY_BATCH_INDEPENDENT])
+
             st.subheader('Conversation Context')
             st.sidebar.button('Start new conversation', on_click=clear_chat_history, use_container_width=True)
             st.sidebar.button('Remove last prompt and response', on_click=remove_last_prompt_and_response, use_container_width=True)
@@ -488,7 +624,9 @@ class ConversationalUI:
                         allow_rerun = False
                         if c >= len(st.session_state[SESSION_KEY_MESSAGES]) - 2 and not st.session_state[MSG_RERUN_LLM]:
                             allow_rerun = True
-                        insert_llm_response(message[MSG], message[SRC], allow_rerun=allow_rerun)
+                        insert_llm_response(message[MSG], message[SRC], allow_rerun=allow_rerun, llm_id=message.get(MSG_LLM))
+                    if message[MSG_FORMAT] == MSG_FORMAT_RESPONSE_LLM_ERR:
+                        st.error(message[MSG], icon='⚠️')
                     if message[MSG_FORMAT] == MSG_FORMAT_RESPONSE_INT_IMG:
                         int_input = None
                         if SRC in message.keys():
@@ -0,0 +1,114 @@
+import os
+import hashlib
+
+import cmi_data_store.data_store_writer as data_store_writer
+
+ARTIFACT_DIRECTORY = "artifacts"
+
+# Key of a reference to an artifact stored in place of the artifact in a log record
+ARTIFACT = "artifact"
+
+DIGEST_ALGORITHM = "sha256"
+
+def get_digest(data):
+    """Returns the content digest of text data"""
+
+    return DIGEST_ALGORITHM + ":" + hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def get_reference(digest):
+    """Returns a reference to an artifact as stored in log records"""
+
+    return {ARTIFACT: digest}
+
+def get_referenced_digest(value):
+    """Returns the digest if the given log record value is an artifact reference, otherwise None"""
+
+    if isinstance(value, dict) and ARTIFACT in value.keys():
+        return value[ARTIFACT]
+    return None
+
+class ArtifactStore:
+    """
+    Stores interpreter inputs and outputs once per content in files named by their digest. Identical artifacts,
+    e.g., of re-runs and regenerated diagrams, are deduplicated.
+    """
+
+    def __init__(self, directory, compression=False):
+        self.directory = directory
+        self.compression = compression
+        # paths of artifacts stored or handed to the writer by digest, checked before use as files may be removed
+        # by garbage collection in another process
+        self.paths = {}
+
+    def get_path(self, digest, extension=""):
+        """Returns the file path of an artifact: <directory>/<first two hex digits>/<hex digest><extension>"""
+
+        hex_digest = digest.split(":", 1)[-1]
+        return os.path.join(self.directory, hex_digest[0:2], hex_digest + extension)
+
+    def find_path(self, digest):
+        """Returns the file path of a stored artifact with any extension, or None"""
+
+        path = self.get_path(digest)
+        directory = os.path.dirname(path)
+        name = os.path.basename(path)
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if filename == name or filename.startswith(name + "."):
+                    return os.path.join(directory, filename)
+        return None
+
+    def put(self, data, extension, write_file):
+        """
+        Stores text data if no artifact with the same content exists, using the given function to write the file.
+        Returns the digest.
+        """
+
+        digest = get_digest(data)
+        path = self.paths.get(digest)
+        if path and os.path.isfile(path):
+            return digest
+
+        path = self.find_path(digest)
+        if not path:
+            if self.compression:
+                extension += data_store_writer.COMPRESSED_EXTENSION
+            path = self.get_path(digest, extension)
+            write_file(path, data)
+        self.paths[digest] = path
+        return digest
+
+    def get(self, digest):
+        """Returns the text data of an artifact, or None if it does not exist"""
+
+        path = self.find_path(digest)
+        if not path:
+            return None
+        with data_store_writer.open_file(path, 'r') as f:
+            return f.read()
+
+    def collect_garbage(self, referenced_digests):
+        """Removes artifacts not in the given referenced digests. Returns the number of removed files and bytes."""
+
+        referenced = set(d.split(":", 1)[-1] for d in referenced_digests)
+        (removed_files, removed_bytes) = (0, 0)
+
+        if not os.path.isdir(self.directory):
+            return (removed_files, removed_bytes)
+
+        for prefix in sorted(os.listdir(self.directory)):
+            prefix_directory = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_directory):
+                continue
+            for filename in os.listdir(prefix_directory):
+                hex_digest = filename.split(".", 1)[0]
+                if hex_digest not in referenced:
+                    path = os.path.join(prefix_directory, filename)
+                    removed_bytes += os.path.getsize(path)
+                    removed_files += 1
+                    os.remove(path)
+                    self.paths.pop(DIGEST_ALGORITHM + ":" + hex_digest, None)
+            if not os.listdir(prefix_directory):
+                os.rmdir(prefix_directory)
+
+        return (removed_files, removed_bytes)
@@ -3,6 +3,19 @@ import json
 import time
 import datetime as dt
 import uuid
+import io
+import gzip
+import zipfile
+import contextlib
+
+try:
+    # locks shared between processes, e.g., sessions and the retention policy
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import cmi_data_store.data_store_writer as data_store_writer
+import cmi_data_store.artifact_store as artifact_store
 
 CONVERSATION = "conversation"
 
@@ -21,24 +34,267 @@ INT_OUTPUT = "int_output"
 MESSAGE = "message"
 INIT_MESSAGE = "init_message"
 EXEC_DURATION_S = "execution_duration_s"
+FAN_OUT = "fan_out"
+FIRST_TOKEN_S = "first_token_s"
+INT_DURATION_S = "int_duration_s"
+SUCCESS = "success"
+LLM_METRICS = "llm_metrics"
 
 MESSAGE_ID = "message_id"
 TIMESTAMP = "timestamp"
 
 DIRECTORY = "cmi_logs"
 
+# Data store backends selectable at startup
+STORE_JSON = "JSON"
+STORE_SQLITE = "SQLite"
+
+STORE_IDS = [
+    STORE_JSON, STORE_SQLITE
+]
+
+# Conversation logs are journals with one JSON record per line, each record appended to one of the lists
+JOURNAL_EXTENSION = ".jsonl"
+JOURNAL_EXTENSIONS = [JOURNAL_EXTENSION, JOURNAL_EXTENSION + data_store_writer.COMPRESSED_EXTENSION]
+LOG_FILE_EXTENSIONS = JOURNAL_EXTENSIONS + [".json"]
+JOURNAL_KEY = "key"
+JOURNAL_DATA = "data"
+LOG_FILE_KEYS = [LLM_CONFIG_LIST, INT_CONFIG_LIST, CONVERSATION]
+
+# Conversations compacted into one archive per day, archive members are <conversation_id>/<file>
+ARCHIVE_DIRECTORY = "archive"
+ARCHIVE_EXTENSION = ".zip"
+
+# Manifest locating each conversation by id as directory or archive relative to the log directory
+MANIFEST_FILE = "manifest.jsonl"
+MANIFEST_CONVERSATION_ID = "conversation_id"
+MANIFEST_LOCATION = "location"
+MANIFEST_LOCK_EXTENSION = ".lock"
+
+# Marker in a conversation directory while a data store writes the conversation, holding the process id
+OPEN_MARKER_FILE = ".open"
+
+# Seconds after the last write a marker is considered stale, e.g., left by an abandoned session of a running server,
+# and seconds between refreshes of the marker's modification time while writing
+OPEN_MARKER_TTL_S = 6 * 3600
+OPEN_MARKER_REFRESH_S = 300
+
+def open_log_file(log_file, archive_file=None):
+    """Opens a log file for reading as text, decompressed if needed, from the file system or as archive member"""
+
+    if not archive_file:
+        return data_store_writer.open_file(log_file, 'r')
+
+    archive = zipfile.ZipFile(archive_file, 'r')
+    f = archive.open(log_file, 'r')
+    if log_file.endswith(data_store_writer.COMPRESSED_EXTENSION):
+        f = gzip.GzipFile(fileobj=f)
+    return io.TextIOWrapper(f, encoding='utf-8')
+
+def iter_log_records(log_file, archive_file=None):
+    """
+    Iterates over the records of a conversation log file as (key, data) tuples. Journals (.jsonl, .jsonl.gz) are 
+    read and decompressed line by line, JSON files (.json) are loaded. Archived log files are read as archive member.
+    """
+
+    if log_file.endswith(tuple(JOURNAL_EXTENSIONS)):
+        with open_log_file(log_file, archive_file) as f:
+            try:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.decoder.JSONDecodeError:
+                        # a partially written last line, e.g., after an interrupted write
+                        print("Skipping incomplete journal record in", log_file)
+                        continue
+                    yield (record[JOURNAL_KEY], record[JOURNAL_DATA])
+            except EOFError:
+                # a partially written last gzip member
+                print("Skipping incomplete compressed journal records in", log_file)
+    else:
+        with open_log_file(log_file, archive_file) as f:
+            file_data = json.load(f)
+        for key in file_data.keys():
+            for data in file_data[key]:
+                yield (key, data)
+
+def read_log_file(log_file, archive_file=None):
+    """
+    Reads a conversation log file and returns its lists of LLM configurations, interpreter configurations 
+    and conversation messages.
+    """
+
+    c = {key: [] for key in LOG_FILE_KEYS}
+    for (key, data) in iter_log_records(log_file, archive_file):
+        c.setdefault(key, []).append(data)
+    return c
+
+def get_referenced_artifacts(log_file, archive_file=None):
+    """Returns the digests of artifacts referenced by the messages of a conversation log file"""
+
+    digests = set()
+    for (log_key, data) in iter_log_records(log_file, archive_file):
+        if log_key != CONVERSATION:
+            continue
+        for key in [INT_INPUT, INT_OUTPUT]:
+            digest = artifact_store.get_referenced_digest(data.get(key))
+            if digest:
+                digests.add(digest)
+    return digests
+
+def get_log_files(directory=DIRECTORY):
+    """Returns the log files (journals or JSON files) of all conversations in the given directory"""
+
+    log_files = []
+    if not os.path.isdir(directory):
+        return log_files
+    for conversation_id in sorted(os.listdir(directory)):
+        for extension in LOG_FILE_EXTENSIONS:
+            log_file = os.path.join(directory, conversation_id, conversation_id + extension)
+            if os.path.isfile(log_file):
+                log_files.append(log_file)
+                break
+    return log_files
+
+def get_archived_log_files(directory=DIRECTORY):
+    """Returns the log files of all archived conversations in the given directory as (member, archive) tuples"""
+
+    log_files = []
+    archive_directory = os.path.join(directory, ARCHIVE_DIRECTORY)
+    if not os.path.isdir(archive_directory):
+        return log_files
+    for filename in sorted(os.listdir(archive_directory)):
+        if filename.endswith(ARCHIVE_EXTENSION):
+            archive_file = os.path.join(archive_directory, filename)
+            with zipfile.ZipFile(archive_file, 'r') as archive:
+                for member in archive.namelist():
+                    (conversation_id, _, name) = member.partition("/")
+                    if name in [conversation_id + extension for extension in LOG_FILE_EXTENSIONS]:
+                        log_files.append((member, archive_file))
+    return log_files
+
+@contextlib.contextmanager
+def lock_manifest(directory=DIRECTORY):
+    """Holds an exclusive lock on the manifest, shared by all processes appending to or rewriting it"""
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, MANIFEST_FILE + MANIFEST_LOCK_EXTENSION), 'a') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def append_manifest_record(record, directory=DIRECTORY):
+    """Appends a record to the manifest while holding the manifest lock"""
+
+    with lock_manifest(directory):
+        data_store_writer.write_text(os.path.join(directory, MANIFEST_FILE), record, 'a')
+
+def is_conversation_open(conversation_directory):
+    """
+    Returns whether a running data store writes the conversation of a directory, by its open marker, written to
+    within the TTL by a running process
+    """
+
+    marker_file = os.path.join(conversation_directory, OPEN_MARKER_FILE)
+    try:
+        if time.time() - os.path.getmtime(marker_file) > OPEN_MARKER_TTL_S:
+            return False
+        with open(marker_file, 'r') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        return False
+    if os.name != "posix":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def refresh_open_marker(conversation_directory, pid):
+    """Sets the modification time of an open marker to now, writing the marker again if it was removed"""
+
+    marker_file = os.path.join(conversation_directory, OPEN_MARKER_FILE)
+    try:
+        os.utime(marker_file)
+    except FileNotFoundError:
+        data_store_writer.write_text(marker_file, str(pid), 'w')
+
+def remove_open_marker(conversation_directory):
+    try:
+        os.remove(os.path.join(conversation_directory, OPEN_MARKER_FILE))
+    except FileNotFoundError:
+        pass
+
+def get_manifest_record(conversation_id, location):
+    """Returns a manifest record with the location of a conversation relative to the log directory, None if removed"""
+
+    return json.dumps({MANIFEST_CONVERSATION_ID: conversation_id, MANIFEST_LOCATION: location, TIMESTAMP: int(time.time())}) + "\n"
+
+def convert_log_file(json_log_file, remove=False):
+    """Converts a JSON log file (.json) into a journal (.jsonl) next to it and returns the journal path."""
+
+    c = read_log_file(json_log_file)
+    journal_file = os.path.splitext(json_log_file)[0] + JOURNAL_EXTENSION
+
+    # replay records in message order, configurations before the message they apply to
+    records = []
+    for key in LOG_FILE_KEYS:
+        for data in c[key]:
+            records.append((data.get(MESSAGE_ID, 0), LOG_FILE_KEYS.index(key), key, data))
+    records.sort(key=lambda r: (r[0], r[1]))
+
+    with open(journal_file, 'w') as f:
+        for (_, _, key, data) in records:
+            f.write(json.dumps({JOURNAL_KEY: key, JOURNAL_DATA: data}) + "\n")
+
+    if remove:
+        os.remove(json_log_file)
+
+    return journal_file
+
+def convert_log_directory(directory=DIRECTORY, remove=False):
+    """Converts all JSON log files of conversations in the given directory into journals."""
+
+    converted = []
+    for conversation_id in sorted(os.listdir(directory)):
+        json_log_file = os.path.join(directory, conversation_id, conversation_id + ".json")
+        if os.path.isfile(json_log_file):
+            print("Converting log file", json_log_file)
+            converted.append(convert_log_file(json_log_file, remove))
+    return converted
+
 class DataStore:
     """
     Stores selected LLMs and interpreters with parameter configurations and messages of a conversation in a 
-    JSON file with a current timestamp.
+    JSON lines journal with a current timestamp.
     """
 
-    def __init__(self):
+    def __init__(self, background_writer=True, compression=False, writer_batch_size=data_store_writer.WRITER_BATCH_SIZE,
+                 writer_queue_size=data_store_writer.WRITER_QUEUE_SIZE, writer_fsync=data_store_writer.WRITER_FSYNC):
         print("Load Data Store ...")
+        # journals, message files and artifacts are optionally gzip-compressed
+        self.compression = compression
+        # records are handed to the background writer thread shared by all data stores, or written synchronously;
+        # the writer is started with the parameters of the first data store
+        self.writer = data_store_writer.get_shared_writer(writer_batch_size, writer_queue_size, writer_fsync) if background_writer else None
+        # interpreter inputs and outputs are stored once per content and referenced by digest
+        self.artifact_store = artifact_store.ArtifactStore(os.path.join(DIRECTORY, artifact_store.ARTIFACT_DIRECTORY), compression)
         self.directory = None
         self.log_file = None
         self.timestamp = None
         self.conversation_id = ""
+        self.conversation_registered = False
+        self.t_marker_refresh = 0
         self.init_message = ""
         self.message_id = 0
         self.last_llm = ""
@@ -46,33 +302,118 @@ class DataStore:
         self.last_int = ""
         self.last_int_config = ""
 
-    def initialize_log_file(self):
-        """Creates a new file."""
-        c = {
-            LLM_CONFIG_LIST: [],
-            INT_CONFIG_LIST: [],
-            CONVERSATION: []
-        }
+    def append_file(self, path, text):
+        """Append text to a file, through the background writer if enabled"""
 
-        os.makedirs(self.directory, exist_ok=True)
-        with open(self.log_file, 'w') as f:
-            json.dump(c, f, indent=4)
+        if self.writer:
+            self.writer.append(path, text)
+        else:
+            data_store_writer.write_text(path, text, 'a')
 
-    def write_log_file(self, key, data):
-        """Write data to the JSON file. In the file's data, open key and append the given data to it."""
+    def write_file(self, path, text):
+        """Write text to a new file, through the background writer if enabled"""
 
-        if not os.path.isfile(self.log_file):
-            self.initialize_log_file()
+        if self.writer:
+            self.writer.write(path, text)
+        else:
+            data_store_writer.write_text(path, text, 'w')
 
-        with open(self.log_file, 'r+') as f:
-            file_data = json.load(f)
-            file_data[key].append(data)
-            f.seek(0)
-            json.dump(file_data, f, indent=4)
+    def flush(self):
+        """Blocks until all records handed to the background writer are written"""
+
+        if self.writer:
+            self.writer.flush()
+
+    def close(self):
+        """Writes all pending records; the shared background writer is stopped on exit"""
+
+        self.release_conversation()
+        self.flush()
+
+    def write_log_file(self, key, data):
+        """Append data as a record for the given key to the journal, without reading previous records."""
+
+        if not self.conversation_registered:
+            self.register_conversation()
+        elif time.monotonic() - self.t_marker_refresh >= OPEN_MARKER_REFRESH_S:
+            self.t_marker_refresh = time.monotonic()
+            if self.writer:
+                self.writer.call(refresh_open_marker, self.directory, os.getpid())
+            else:
+                refresh_open_marker(self.directory, os.getpid())
+
+        record = json.dumps({JOURNAL_KEY: key, JOURNAL_DATA: data})
+        self.append_file(self.log_file, record + "\n")
+
+    def register_conversation(self):
+        """Adds the directory of the current conversation to the manifest and marks it open until released"""
+
+        self.conversation_registered = True
+        self.t_marker_refresh = time.monotonic()
+        data_store_writer.write_text(os.path.join(self.directory, OPEN_MARKER_FILE), str(os.getpid()), 'w')
+        record = get_manifest_record(self.conversation_id, self.conversation_id)
+        if self.writer:
+            self.writer.call(append_manifest_record, record)
+        else:
+            append_manifest_record(record)
+
+    def release_conversation(self):
+        """Removes the open marker of the current conversation once its pending records are written"""
+
+        if self.conversation_registered:
+            self.conversation_registered = False
+            if self.writer:
+                self.writer.call(remove_open_marker, self.directory)
+            else:
+                remove_open_marker(self.directory)
+
+    def read_log_file(self, resolve_artifacts=False):
+        """Returns the current view of the conversation with configurations and messages, optionally with artifacts."""
+
+        self.flush()
+        if not self.log_file or not os.path.isfile(self.log_file):
+            return {key: [] for key in LOG_FILE_KEYS}
+        c = read_log_file(self.log_file)
+        if resolve_artifacts:
+            self.resolve_artifacts(c)
+        return c
+
+    def resolve_artifacts(self, c):
+        """Replaces artifact references in the messages of a conversation by the artifacts"""
+
+        for data in c[CONVERSATION]:
+            for key in [INT_INPUT, INT_OUTPUT]:
+                digest = artifact_store.get_referenced_digest(data.get(key))
+                if digest:
+                    data[key] = self.get_artifact(digest)
+        return c
+
+    def put_artifact(self, data):
+        """Stores an interpreter input or output unless it is stored already and returns its digest"""
+
+        return self.artifact_store.put(data, self.get_file_extension(data), self.write_file)
+
+    def get_artifact(self, digest):
+        self.flush()
+        return self.artifact_store.get(digest)
+
+    def collect_garbage(self):
+        """Removes artifacts not referenced by any conversation. Returns the number of removed files and bytes."""
+
+        self.flush()
+        referenced = set()
+        for log_file in get_log_files(DIRECTORY):
+            referenced |= get_referenced_artifacts(log_file)
+        for (log_file, archive_file) in get_archived_log_files(DIRECTORY):
+            referenced |= get_referenced_artifacts(log_file, archive_file)
+        return self.artifact_store.collect_garbage(referenced)
 
     def get_timestamp(self):
         return dt.datetime.now().strftime("%y%m%d-%H%M%S")
 
+    def get_compressed_extension(self):
+        return data_store_writer.COMPRESSED_EXTENSION if self.compression else ""
+
     def get_file_extension(self, data):
         if data.startswith("<?xml") and data.find("<svg") > -1:
             return ".svg"
@@ -84,34 +425,16 @@ class DataStore:
     def write_llm_prompt(self, id, prompt):
         """Write data given to the LLM to a file."""
 
-        filename = "cmi-" + self.get_timestamp() + "-" + str(id) + "-llm-prompt.txt"
+        filename = "cmi-" + self.get_timestamp() + "-" + str(id) + "-llm-prompt.txt" + self.get_compressed_extension()
 
-        with open(os.path.join(self.directory, filename), 'w') as f:
-            f.write(prompt)
+        self.write_file(os.path.join(self.directory, filename), prompt)
 
     def write_llm_response(self, id, response):
         """Write data returned by the LLM to a file."""
 
-        filename = "cmi-" + self.get_timestamp() + "-" + str(id) + "-llm-response.txt"
-
-        with open(os.path.join(self.directory, filename), 'w') as f:
-            f.write(response)
-
-    def write_interpreter_input(self, id, input):
-        """Write data given to the interpreter to a file."""
-
-        filename = "cmi-" + self.get_timestamp() + "-" + str(id) + "-int-input" + self.get_file_extension(input)
-
-        with open(os.path.join(self.directory, filename), 'w') as f:
-            f.write(input)
-
-    def write_interpreter_output(self, id, output):
-        """Write data returned by the interpreter to a file."""
-
-        filename = "cmi-" + self.get_timestamp() + "-" + str(id) + "-int-output" + self.get_file_extension(output)
+        filename = "cmi-" + self.get_timestamp() + "-" + str(id) + "-llm-response.txt" + self.get_compressed_extension()
 
-        with open(os.path.join(self.directory, filename), 'w') as f:
-            f.write(output)
+        self.write_file(os.path.join(self.directory, filename), response)
 
     def reset_configuration(self, init_message):
         """Reset the LLM configuration LLM and interpreter."""
@@ -127,9 +450,10 @@ class DataStore:
             self.last_int_config = ""
 
     def create_conversation(self, init_message):
-        """Create a new JSON file with current timestamp for storing a new conversation."""
+        """Create a new journal with current timestamp for storing a new conversation."""
         
         self.init_message = init_message
+        self.release_conversation()
 
         self.message_id = 0
         self.last_llm = ""
@@ -138,9 +462,10 @@ class DataStore:
         self.last_int_config = ""
 
         self.conversation_id = "cmi-" + self.get_timestamp()
+        self.conversation_registered = False
 
         self.directory = os.path.join(DIRECTORY, self.conversation_id)
-        self.log_file = os.path.join(DIRECTORY, self.conversation_id, self.conversation_id + ".json")
+        self.log_file = os.path.join(DIRECTORY, self.conversation_id, self.conversation_id + JOURNAL_EXTENSION + self.get_compressed_extension())
 
     def set_llm_configuration(self, selected_llm, llm_config):
         """Store the selected LLM with configuration parameters"""
@@ -219,31 +544,29 @@ class DataStore:
         self.write_llm_response(self.message_id, response)
 
     def insert_interpreter_input(self, input):
-        """Store an interpreter input as part of the current conversaion"""
+        """Store an interpreter input as artifact referenced in the current conversaion"""
 
         self.message_id += 1
         c = {
             TIMESTAMP: int(time.time()),
             MESSAGE_ID: self.message_id, 
-            INT_INPUT: input
+            INT_INPUT: artifact_store.get_reference(self.put_artifact(input))
         }
 
         self.write_log_file(CONVERSATION, c)
-        self.write_interpreter_input(self.message_id, input)
 
     def insert_interpreter_output(self, output, execution_duration_ns):
-        """Store an interpreter output as part of the current conversaion"""
+        """Store an interpreter output as artifact referenced in the current conversaion"""
 
         self.message_id += 1
         c = {
             TIMESTAMP: int(time.time()),
             MESSAGE_ID: self.message_id, 
-            EXEC_DURATION_S: execution_duration_ns/1e+10,
-            INT_OUTPUT: output
+            EXEC_DURATION_S: execution_duration_ns/1e+9,
+            INT_OUTPUT: artifact_store.get_reference(self.put_artifact(output))
         }
 
         self.write_log_file(CONVERSATION, c)
-        self.write_interpreter_output(self.message_id, output)
 
     def insert_message(self, message):
         """Stores an arbitrary message"""
@@ -256,3 +579,52 @@ class DataStore:
         }
 
         self.write_log_file(CONVERSATION, c)
+
+    def insert_llm_metrics(self, metrics):
+        """Stores the latency metrics of the request of the last LLM response with the current LLM"""
+
+        c = {
+            TIMESTAMP: int(time.time()),
+            MESSAGE_ID: self.message_id,
+            LLM_METRICS: {LLM: self.last_llm} | metrics
+        }
+
+        self.write_log_file(CONVERSATION, c)
+
+    def get_llm_metrics(self, llm=None, since=None):
+        """
+        Returns the metrics of LLM requests of all conversations, including archived ones, as list of dicts with 
+        timestamp, filtered by LLM prefix and UNIX timestamp
+        """
+
+        self.flush()
+        log_files = [(log_file, None) for log_file in get_log_files(DIRECTORY)] + get_archived_log_files(DIRECTORY)
+        metrics = []
+        for (log_file, archive_file) in log_files:
+            for (key, data) in iter_log_records(log_file, archive_file):
+                if key != CONVERSATION or LLM_METRICS not in data.keys():
+                    continue
+                m = data[LLM_METRICS]
+                if llm and not str(m.get(LLM)).startswith(llm):
+                    continue
+                if since is not None and data[TIMESTAMP] < since:
+                    continue
+                metrics.append({TIMESTAMP: data[TIMESTAMP]} | m)
+        return metrics
+
+    def insert_fan_out_result(self, llm, execution_duration_ns, first_token_ns, int_duration_ns, success):
+        """Stores latency and success of one LLM a prompt was run against concurrently with other LLMs"""
+
+        c = {
+            TIMESTAMP: int(time.time()),
+            MESSAGE_ID: self.message_id,
+            FAN_OUT: {
+                LLM: llm,
+                EXEC_DURATION_S: execution_duration_ns/1e+9,
+                FIRST_TOKEN_S: first_token_ns/1e+9 if first_token_ns is not None else None,
+                INT_DURATION_S: int_duration_ns/1e+9,
+                SUCCESS: success
+            }
+        }
+
+        self.write_log_file(CONVERSATION, c)
@@ -0,0 +1,393 @@
+import os
+import re
+import gzip
+import json
+import sqlite3
+import zipfile
+import threading
+
+import cmi_data_store.data_store as data_store
+import cmi_data_store.artifact_store as artifact_store
+import cmi_data_store.data_store_writer as data_store_writer
+import cmi_data_store.retention as retention
+
+DATABASE_FILE = os.path.join(data_store.DIRECTORY, "cmi.sqlite")
+
+# Message kinds by the key holding the message content in a conversation record
+MESSAGE_KINDS = [
+    data_store.INIT_MESSAGE, data_store.PROMPT, data_store.RESPONSE,
+    data_store.INT_INPUT, data_store.INT_OUTPUT, data_store.MESSAGE, data_store.FAN_OUT, data_store.LLM_METRICS
+]
+
+# Configuration kinds by the key of the configuration list
+CONFIG_KINDS = {
+    data_store.LLM_CONFIG_LIST: (data_store.LLM, data_store.LLM_CONFIG),
+    data_store.INT_CONFIG_LIST: (data_store.INT, data_store.INT_CONFIG)
+}
+
+# Files written next to the log file: cmi-<timestamp>-<message_id>-<kind>.<extension>
+ARTIFACT_FILENAME = re.compile(r"cmi-\d{6}-\d{6}-(\d+)-([a-z-]+)\.\w+(\.gz)?$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS configurations (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT,
+    configuration TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    llm TEXT,
+    interpreter TEXT,
+    execution_duration_s REAL,
+    content TEXT
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL,
+    message_id INTEGER,
+    kind TEXT,
+    filename TEXT NOT NULL,
+    content TEXT
+);
+CREATE TABLE IF NOT EXISTS artifact_contents (
+    digest TEXT PRIMARY KEY,
+    extension TEXT,
+    content TEXT
+);
+CREATE INDEX IF NOT EXISTS configurations_conversation ON configurations (conversation_id, message_id);
+CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, message_id);
+CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+CREATE INDEX IF NOT EXISTS messages_llm ON messages (llm, timestamp);
+CREATE INDEX IF NOT EXISTS messages_interpreter ON messages (interpreter, timestamp);
+CREATE INDEX IF NOT EXISTS messages_execution_duration ON messages (kind, execution_duration_s);
+CREATE INDEX IF NOT EXISTS artifacts_conversation ON artifacts (conversation_id, message_id);
+"""
+
+class SQLiteDataStore(data_store.DataStore):
+    """
+    Stores selected LLMs and interpreters with parameter configurations, messages and files of all conversations
+    in a SQLite database, indexed for queries across conversations.
+    """
+
+    def __init__(self, database_file=DATABASE_FILE, background_writer=True, writer_batch_size=data_store_writer.WRITER_BATCH_SIZE,
+                 writer_queue_size=data_store_writer.WRITER_QUEUE_SIZE, writer_fsync=data_store_writer.WRITER_FSYNC):
+        super().__init__(background_writer, writer_batch_size=writer_batch_size, writer_queue_size=writer_queue_size, writer_fsync=writer_fsync)
+        print("Load SQLite Data Store:", database_file)
+        self.database_file = database_file
+        directory = os.path.dirname(database_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # the connection is shared by the writer thread and queries, access is serialized by the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database_file, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    def execute(self, statement, parameters=()):
+        with self.lock:
+            self.connection.execute(statement, parameters)
+            self.connection.commit()
+
+    def submit(self, statement, parameters):
+        """Execute an insert through the background writer if enabled"""
+
+        if self.writer:
+            self.writer.call(self.execute, statement, parameters)
+        else:
+            self.execute(statement, parameters)
+
+    def write_log_file(self, key, data):
+        """Insert a configuration or a conversation message as row"""
+
+        self.submit(*self.get_insert(self.conversation_id, key, data, self.last_llm, self.last_int))
+
+    def write_file(self, path, text):
+        """Insert a file written for a message as artifact"""
+
+        filename = os.path.basename(path)
+        (message_id, kind) = (self.message_id, None)
+        match = ARTIFACT_FILENAME.match(filename)
+        if match:
+            (message_id, kind) = (int(match.group(1)), match.group(2))
+        self.submit(
+            "INSERT INTO artifacts (conversation_id, message_id, kind, filename, content) VALUES (?, ?, ?, ?, ?)",
+            (self.conversation_id, message_id, kind, filename, text))
+
+    def put_artifact(self, data):
+        """Stores an interpreter input or output unless it is stored already and returns its digest"""
+
+        # stored unless a row exists, also after rows were removed by another process
+        digest = artifact_store.get_digest(data)
+        self.submit(
+            "INSERT OR IGNORE INTO artifact_contents (digest, extension, content) VALUES (?, ?, ?)",
+            (digest, self.get_file_extension(data), data))
+        return digest
+
+    def get_artifact(self, digest):
+        self.flush()
+        with self.lock:
+            row = self.connection.execute("SELECT content FROM artifact_contents WHERE digest = ?", (digest,)).fetchone()
+        return row["content"] if row else None
+
+    def collect_garbage(self):
+        """Removes artifacts not referenced by any message. Returns the number of removed rows and bytes."""
+
+        self.flush()
+        condition = """digest NOT IN (
+            SELECT json_extract(content, '$.""" + artifact_store.ARTIFACT + """') FROM messages
+            WHERE kind IN (?, ?) AND json_valid(content))"""
+        parameters = (data_store.INT_INPUT, data_store.INT_OUTPUT)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM artifact_contents WHERE " + condition, parameters).fetchone()
+            self.connection.execute("DELETE FROM artifact_contents WHERE " + condition, parameters)
+            self.connection.commit()
+        return (row[0], row[1])
+
+    def get_insert(self, conversation_id, key, data, llm, interpreter):
+        """Returns the insert statement with parameters for a configuration or message record"""
+
+        timestamp = data.get(data_store.TIMESTAMP, 0)
+        message_id = data.get(data_store.MESSAGE_ID, 0)
+
+        if key in CONFIG_KINDS.keys():
+            (name_key, config_key) = CONFIG_KINDS[key]
+            return (
+                "INSERT INTO configurations (conversation_id, message_id, timestamp, kind, name, configuration) VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, message_id, timestamp, name_key, data.get(name_key), json.dumps(data.get(config_key))))
+
+        kind = data_store.MESSAGE
+        for k in MESSAGE_KINDS:
+            if k in data.keys():
+                kind = k
+                break
+        content = data.get(kind)
+        if not isinstance(content, str):
+            content = json.dumps(content)
+
+        return (
+            "INSERT INTO messages (conversation_id, message_id, timestamp, kind, llm, interpreter, execution_duration_s, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (conversation_id, message_id, timestamp, kind, llm, interpreter, data.get(data_store.EXEC_DURATION_S), content))
+
+    def read_log_file(self, resolve_artifacts=False):
+        """Returns the current view of the conversation with configurations and messages, optionally with artifacts."""
+
+        self.flush()
+        c = {key: [] for key in data_store.LOG_FILE_KEYS}
+        with self.lock:
+            for row in self.connection.execute(
+                    "SELECT * FROM configurations WHERE conversation_id = ? ORDER BY id", (self.conversation_id,)):
+                (name_key, config_key) = (data_store.LLM, data_store.LLM_CONFIG)
+                list_key = data_store.LLM_CONFIG_LIST
+                if row["kind"] == data_store.INT:
+                    (name_key, config_key) = (data_store.INT, data_store.INT_CONFIG)
+                    list_key = data_store.INT_CONFIG_LIST
+                c[list_key].append({
+                    data_store.TIMESTAMP: row["timestamp"],
+                    data_store.MESSAGE_ID: row["message_id"],
+                    name_key: row["name"],
+                    config_key: json.loads(row["configuration"])
+                })
+            for row in self.connection.execute(
+                    "SELECT * FROM messages WHERE conversation_id = ? ORDER BY id", (self.conversation_id,)):
+                m = {
+                    data_store.TIMESTAMP: row["timestamp"],
+                    data_store.MESSAGE_ID: row["message_id"]
+                }
+                if row["execution_duration_s"] is not None:
+                    m[data_store.EXEC_DURATION_S] = row["execution_duration_s"]
+                m[row["kind"]] = row["content"]
+                if row["kind"] in [data_store.INT_INPUT, data_store.INT_OUTPUT] and row["content"].startswith("{"):
+                    m[row["kind"]] = json.loads(row["content"])
+                c[data_store.CONVERSATION].append(m)
+        if resolve_artifacts:
+            self.resolve_artifacts(c)
+        return c
+
+    def query_messages(self, kind=None, llm=None, interpreter=None, since=None, until=None, min_duration_s=None, max_duration_s=None):
+        """
+        Returns messages of all conversations as list of rows, filtered by message kind (e.g., int_output), LLM or
+        interpreter prefix, UNIX timestamp range, and execution duration.
+        """
+
+        self.flush()
+        conditions = []
+        parameters = []
+        if kind:
+            conditions.append("kind = ?")
+            parameters.append(kind)
+        if llm:
+            conditions.append("llm LIKE ?")
+            parameters.append(llm + "%")
+        if interpreter:
+            conditions.append("interpreter LIKE ?")
+            parameters.append(interpreter + "%")
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("timestamp < ?")
+            parameters.append(until)
+        if min_duration_s is not None:
+            conditions.append("execution_duration_s >= ?")
+            parameters.append(min_duration_s)
+        if max_duration_s is not None:
+            conditions.append("execution_duration_s <= ?")
+            parameters.append(max_duration_s)
+
+        statement = "SELECT * FROM messages"
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        statement += " ORDER BY timestamp, id"
+
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(statement, parameters)]
+
+    def get_llm_metrics(self, llm=None, since=None):
+        """Returns the metrics of LLM requests of all conversations as list of dicts with timestamp"""
+
+        metrics = []
+        for row in self.query_messages(kind=data_store.LLM_METRICS, llm=llm, since=since):
+            metrics.append({data_store.TIMESTAMP: row["timestamp"]} | json.loads(row["content"]))
+        return metrics
+
+    def is_conversation_imported(self, conversation_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT 1 FROM messages WHERE conversation_id = ? UNION SELECT 1 FROM configurations WHERE conversation_id = ? LIMIT 1",
+                (conversation_id, conversation_id)).fetchone()
+        return row is not None
+
+    def get_log_directory_conversations(self, directory=data_store.DIRECTORY):
+        """
+        Returns the conversations of a log directory as list of (conversation_id, log_file, archive_file) tuples:
+        conversation directories and, located by the manifest, conversations compacted into daily archives
+        """
+
+        conversations = {}
+        for conversation_id in sorted(os.listdir(directory)):
+            if os.path.isdir(os.path.join(directory, conversation_id)):
+                conversations[conversation_id] = None
+        for (conversation_id, location) in retention.read_manifest(directory).items():
+            if location.endswith(data_store.ARCHIVE_EXTENSION):
+                conversations.setdefault(conversation_id, location)
+
+        located = []
+        for conversation_id in sorted(conversations.keys()):
+            if conversations[conversation_id] is None:
+                conversation_directory = os.path.join(directory, conversation_id)
+                for extension in data_store.LOG_FILE_EXTENSIONS:
+                    log_file = os.path.join(conversation_directory, conversation_id + extension)
+                    if os.path.isfile(log_file):
+                        located.append((conversation_id, log_file, None))
+                        break
+            else:
+                location = retention.locate_conversation(conversation_id, directory)
+                if location:
+                    located.append((conversation_id,) + location)
+                else:
+                    print("Archived conversation not found:", conversation_id)
+        return located
+
+    def read_message_files(self, conversation_id, log_file, archive_file=None):
+        """Returns the files written next to a log file, in a directory or an archive, as list of (filename, text) tuples"""
+
+        files = []
+        if not archive_file:
+            conversation_directory = os.path.dirname(log_file)
+            for filename in sorted(os.listdir(conversation_directory)):
+                if ARTIFACT_FILENAME.match(filename):
+                    with data_store_writer.open_file(os.path.join(conversation_directory, filename), 'r') as f:
+                        files.append((filename, f.read()))
+            return files
+
+        with zipfile.ZipFile(archive_file, 'r') as archive:
+            for member in sorted(archive.namelist()):
+                (member_conversation_id, _, filename) = member.partition("/")
+                if member_conversation_id == conversation_id and ARTIFACT_FILENAME.match(filename):
+                    data = archive.read(member)
+                    if filename.endswith(data_store_writer.COMPRESSED_EXTENSION):
+                        data = gzip.decompress(data)
+                    files.append((filename, data.decode('utf-8')))
+        return files
+
+    def import_log_directory(self, directory=data_store.DIRECTORY):
+        """
+        Imports conversations with their files and referenced artifacts from a log directory, including archived 
+        conversations. Returns the number of imported conversations.
+        """
+
+        self.flush()
+        imported = 0
+        artifacts = artifact_store.ArtifactStore(os.path.join(directory, artifact_store.ARTIFACT_DIRECTORY))
+
+        for (conversation_id, log_file, archive_file) in self.get_log_directory_conversations(directory):
+            if self.is_conversation_imported(conversation_id):
+                continue
+
+            print("Importing conversation", conversation_id)
+            c = data_store.read_log_file(log_file, archive_file)
+            inserts = []
+
+            # LLM and interpreter in effect for each message, from the configuration records
+            configurations = []
+            for key in CONFIG_KINDS.keys():
+                for data in c[key]:
+                    configurations.append((data.get(data_store.MESSAGE_ID, 0), key, data))
+                    inserts.append(self.get_insert(conversation_id, key, data, None, None))
+            configurations.sort(key=lambda r: r[0])
+
+            (llm, interpreter, i) = ("", "", 0)
+            for data in c[data_store.CONVERSATION]:
+                message_id = data.get(data_store.MESSAGE_ID, 0)
+                while i < len(configurations) and configurations[i][0] <= message_id:
+                    (_, key, config) = configurations[i]
+                    if key == data_store.LLM_CONFIG_LIST:
+                        llm = str(config.get(data_store.LLM))
+                    else:
+                        interpreter = str(config.get(data_store.INT))
+                    i += 1
+                inserts.append(self.get_insert(conversation_id, data_store.CONVERSATION, data, llm, interpreter))
+
+                # interpreter inputs and outputs stored once per content
+                for key in [data_store.INT_INPUT, data_store.INT_OUTPUT]:
+                    digest = artifact_store.get_referenced_digest(data.get(key))
+                    if not digest:
+                        continue
+                    content = artifacts.get(digest)
+                    if content is None:
+                        print("Referenced artifact not found:", digest)
+                        continue
+                    inserts.append((
+                        "INSERT OR IGNORE INTO artifact_contents (digest, extension, content) VALUES (?, ?, ?)",
+                        (digest, self.get_file_extension(content), content)))
+
+            for (filename, text) in self.read_message_files(conversation_id, log_file, archive_file):
+                match = ARTIFACT_FILENAME.match(filename)
+                inserts.append((
+                    "INSERT INTO artifacts (conversation_id, message_id, kind, filename, content) VALUES (?, ?, ?, ?, ?)",
+                    (conversation_id, int(match.group(1)), match.group(2), filename, text)))
+
+            with self.lock:
+                for (statement, parameters) in inserts:
+                    self.connection.execute(statement, parameters)
+                self.connection.commit()
+            imported += 1
+
+        return imported
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,187 @@
+import os
+import gzip
+import queue
+import threading
+import atexit
+
+# Number of queued records written together with one open/write per file
+WRITER_BATCH_SIZE = 64
+
+# Maximum number of queued records; when the queue is full, producers wait (backpressure)
+WRITER_QUEUE_SIZE = 1024
+
+# fsync policy: never, after each combined write of a batch, or after each record
+FSYNC_NEVER = "never"
+FSYNC_BATCH = "batch"
+FSYNC_ALWAYS = "always"
+FSYNC_MODES = [FSYNC_NEVER, FSYNC_BATCH, FSYNC_ALWAYS]
+
+WRITER_FSYNC = FSYNC_NEVER
+
+# Files with this extension are written and read gzip-compressed
+COMPRESSED_EXTENSION = ".gz"
+
+OP_APPEND = "append"
+OP_WRITE = "write"
+OP_CALL = "call"
+OP_FLUSH = "flush"
+OP_STOP = "stop"
+
+# Process-wide writer shared by all data stores
+shared_writer = None
+shared_lock = threading.Lock()
+
+def get_shared_writer(batch_size=WRITER_BATCH_SIZE, queue_size=WRITER_QUEUE_SIZE, fsync=WRITER_FSYNC):
+    """Returns the process-wide background writer, started on first use with the given parameters and closed on exit"""
+
+    global shared_writer
+    with shared_lock:
+        if shared_writer is None:
+            shared_writer = DataStoreWriter(batch_size, queue_size, fsync)
+            atexit.register(shared_writer.close)
+    return shared_writer
+
+def open_file(path, mode):
+    """
+    Opens a text file, compressed if the path ends with the compressed extension. Appending to a compressed file
+    adds a gzip member, readers decompress all members as one stream.
+    """
+
+    if path.endswith(COMPRESSED_EXTENSION):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode)
+
+def write_text(path, text, mode, fsync=False):
+    """Writes ('w') or appends ('a') text to a file, compressed if the path ends with the compressed extension"""
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, mode + 'b') as f:
+        if path.endswith(COMPRESSED_EXTENSION):
+            f.write(gzip.compress(text.encode('utf-8')))
+        else:
+            f.write(text.encode('utf-8'))
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+class DataStoreWriter:
+    """
+    Writes records handed over by the data store in a background thread. Records are queued and written in
+    batches, appends to the same file are combined into one write. Records are written in the order they were
+    handed over. Queued records are flushed on shutdown, records handed over later are written synchronously.
+    """
+
+    def __init__(self, batch_size=WRITER_BATCH_SIZE, queue_size=WRITER_QUEUE_SIZE, fsync=WRITER_FSYNC):
+        print("Load Data Store Writer ...")
+        self.batch_size = max(1, batch_size)
+        self.fsync = fsync
+        self.queue = queue.Queue(maxsize=queue_size)
+        # serializes producers with stopping, so that no record is queued after the stop
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="cmi-data-store-writer", daemon=True)
+        self.thread.start()
+
+    def append(self, path, text):
+        """Queue text to be appended to the file at the given path"""
+        self.put((OP_APPEND, path, text))
+
+    def write(self, path, text):
+        """Queue text to be written to a new file at the given path"""
+        self.put((OP_WRITE, path, text))
+
+    def call(self, function, *args):
+        """Queue a function to be called in the writer thread, e.g., for database inserts"""
+        self.put((OP_CALL, function, args))
+
+    def put(self, record):
+        """Queue a record, waiting while the queue is full (backpressure). Once stopping, write synchronously."""
+
+        with self.lock:
+            if not self.stopping:
+                self.queue.put(record)
+                return
+        # after the records queued before the stop
+        self.thread.join()
+        self.write_batch([record])
+
+    def flush(self, timeout_s=None):
+        """Blocks until all records queued before this call are written. Returns False on timeout."""
+
+        done = threading.Event()
+        with self.lock:
+            if not self.stopping:
+                self.queue.put((OP_FLUSH, done, None))
+                return done.wait(timeout_s)
+        self.thread.join(timeout_s)
+        return not self.thread.is_alive()
+
+    def close(self):
+        """Flushes all queued records and stops the writer thread"""
+
+        with self.lock:
+            if not self.stopping:
+                self.stopping = True
+                self.queue.put((OP_STOP, None, None))
+        self.thread.join()
+
+    def run(self):
+        """Writer thread: takes records from the queue and writes them in batches"""
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            records = [r for r in batch if r[0] not in (OP_FLUSH, OP_STOP)]
+            self.write_batch(records)
+
+            stop = False
+            for (op, arg, _) in batch:
+                if op == OP_FLUSH:
+                    arg.set()
+                elif op == OP_STOP:
+                    stop = True
+                self.queue.task_done()
+            if stop:
+                return
+
+    def write_batch(self, records):
+        """
+        Writes the given records. Consecutive appends to the same file are combined into one write, keeping their 
+        order, unless each record is synced. Pending appends are written before any other record, so that, e.g., 
+        database inserts are not committed before journal lines handed over earlier.
+        """
+
+        appends = {}
+        for (op, arg, data) in records:
+            if op == OP_APPEND and self.fsync != FSYNC_ALWAYS:
+                appends.setdefault(arg, []).append(data)
+                continue
+            self.write_appends(appends)
+            self.write_record(op, arg, data)
+        self.write_appends(appends)
+
+    def write_appends(self, appends):
+        for path in appends.keys():
+            self.write_record(OP_APPEND, path, "".join(appends[path]))
+        appends.clear()
+
+    def write_record(self, op, arg, data):
+        try:
+            if op == OP_APPEND:
+                self.write_file(arg, data, 'a')
+            elif op == OP_WRITE:
+                self.write_file(arg, data, 'w')
+            elif op == OP_CALL:
+                arg(*data)
+        except Exception as e:
+            print("Data store writer error:", e)
+
+    def write_file(self, path, text, mode):
+        write_text(path, text, mode, self.fsync != FSYNC_NEVER)
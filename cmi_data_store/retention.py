@@ -0,0 +1,357 @@
+import os
+import json
+import shutil
+import zipfile
+import datetime as dt
+
+import cmi_data_store.data_store as data_store
+import cmi_data_store.artifact_store as artifact_store
+
+# Default policy: compact conversations older than one day, keep everything else
+RETENTION_COMPACT_AFTER_DAYS = 1
+RETENTION_MAX_AGE_DAYS = None
+RETENTION_MAX_SIZE_BYTES = None
+
+def get_conversation_datetime(conversation_id, path):
+    """Returns the start of a conversation from its id (cmi-<yymmdd>-<HHMMSS>) or the modification time of its path"""
+
+    try:
+        return dt.datetime.strptime(conversation_id[4:17], "%y%m%d-%H%M%S")
+    except ValueError:
+        return dt.datetime.fromtimestamp(os.path.getmtime(path))
+
+def get_size(path):
+    """Returns the size of a file or of all files in a directory in bytes"""
+
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for (root, _, files) in os.walk(path):
+        for filename in files:
+            size += os.path.getsize(os.path.join(root, filename))
+    return size
+
+def merge_journal(archived, current):
+    """
+    Returns the journal of a conversation appended to after it was archived: the current journal if it still
+    starts with the archived one, e.g., when it could not be removed after compaction, or both concatenated.
+    Compressed journals are concatenated as gzip members.
+    """
+
+    if current.startswith(archived):
+        return current
+    return archived + current
+
+def read_manifest(directory=data_store.DIRECTORY):
+    """Returns the location of each conversation by id from the manifest, relative to the log directory"""
+
+    locations = {}
+    manifest_file = os.path.join(directory, data_store.MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return locations
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue
+            if record[data_store.MANIFEST_LOCATION] is None:
+                locations.pop(record[data_store.MANIFEST_CONVERSATION_ID], None)
+            else:
+                locations[record[data_store.MANIFEST_CONVERSATION_ID]] = record[data_store.MANIFEST_LOCATION]
+    return locations
+
+def locate_conversation(conversation_id, directory=data_store.DIRECTORY):
+    """
+    Returns the log file of a conversation as tuple (log_file, archive_file), where archive_file is None for
+    conversations not compacted, or None if the conversation is unknown. The manifest is used instead of the tree.
+    """
+
+    location = read_manifest(directory).get(conversation_id)
+    if not location:
+        return None
+
+    path = os.path.join(directory, location)
+    if location.endswith(data_store.ARCHIVE_EXTENSION):
+        with zipfile.ZipFile(path, 'r') as archive:
+            names = archive.namelist()
+        for extension in data_store.LOG_FILE_EXTENSIONS:
+            member = conversation_id + "/" + conversation_id + extension
+            if member in names:
+                return (member, path)
+    else:
+        for extension in data_store.LOG_FILE_EXTENSIONS:
+            log_file = os.path.join(path, conversation_id + extension)
+            if os.path.isfile(log_file):
+                return (log_file, None)
+    return None
+
+class RetentionPolicy:
+    """
+    Compacts conversation directories of the log directory into one archive per day and removes conversations
+    by age and total size. The size includes the artifacts referenced by conversations, but not a SQLite
+    database. Conversations open in a running data store are neither compacted nor removed. Conversations are
+    located by id with the manifest.
+    """
+
+    def __init__(self, compact_after_days=RETENTION_COMPACT_AFTER_DAYS, max_age_days=RETENTION_MAX_AGE_DAYS, max_size_bytes=RETENTION_MAX_SIZE_BYTES, directory=data_store.DIRECTORY):
+        self.compact_after_days = compact_after_days
+        self.max_age_days = max_age_days
+        self.max_size_bytes = max_size_bytes
+        self.directory = directory
+        self.archive_directory = os.path.join(directory, data_store.ARCHIVE_DIRECTORY)
+
+    def get_conversation_directories(self):
+        """Returns conversation directories as list of (conversation_id, datetime) tuples, oldest first"""
+
+        conversations = []
+        for conversation_id in os.listdir(self.directory):
+            path = os.path.join(self.directory, conversation_id)
+            if conversation_id.startswith("cmi-") and os.path.isdir(path):
+                conversations.append((conversation_id, get_conversation_datetime(conversation_id, path)))
+        return sorted(conversations, key=lambda c: c[1])
+
+    def get_archive_file(self, day):
+        return os.path.join(self.archive_directory, "cmi-" + day.strftime("%y%m%d") + data_store.ARCHIVE_EXTENSION)
+
+    def compact(self, now):
+        """Moves conversation directories older than the compaction age into the archive of their day"""
+
+        manifest = []
+        if self.compact_after_days is None:
+            return manifest
+
+        threshold = now - dt.timedelta(days=self.compact_after_days)
+        os.makedirs(self.archive_directory, exist_ok=True)
+
+        conversations_by_archive = {}
+        for (conversation_id, started) in self.get_conversation_directories():
+            if started >= threshold:
+                continue
+            if data_store.is_conversation_open(os.path.join(self.directory, conversation_id)):
+                print("Skipping open conversation", conversation_id)
+                continue
+            conversations_by_archive.setdefault(self.get_archive_file(started), []).append(conversation_id)
+
+        for (archive_file, conversation_ids) in conversations_by_archive.items():
+            location = os.path.relpath(archive_file, self.directory)
+            written = self.write_archive(archive_file, conversation_ids)
+            for conversation_id in conversation_ids:
+                path = os.path.join(self.directory, conversation_id)
+                files = self.get_conversation_files(conversation_id)
+                if any(written.get(member) != os.path.getsize(file) for (member, file) in files.items()):
+                    # e.g., written to during compaction, merged by the next compaction
+                    print("Conversation", conversation_id, "changed during compaction, kept")
+                    continue
+                shutil.rmtree(path)
+                manifest.append(data_store.get_manifest_record(conversation_id, location))
+                print("Compacted conversation", conversation_id, "into", location)
+
+        return manifest
+
+    def get_conversation_files(self, conversation_id):
+        """Returns the files of a conversation directory by archive member <conversation_id>/<file>"""
+
+        path = os.path.join(self.directory, conversation_id)
+        files = {}
+        for filename in sorted(os.listdir(path)):
+            if filename != data_store.OPEN_MARKER_FILE:
+                files[conversation_id + "/" + filename] = os.path.join(path, filename)
+        return files
+
+    def write_archive(self, archive_file, conversation_ids):
+        """
+        Writes the files of conversation directories into an archive, which is replaced by a new archive once all
+        files are verified in it. Journals archived before, e.g., of a conversation appended to after an earlier
+        compaction, are merged with the current ones, other files are replaced. Returns the size of the current
+        file of each archived member, empty if the archive was not replaced.
+        """
+
+        files = {}
+        for conversation_id in conversation_ids:
+            files.update(self.get_conversation_files(conversation_id))
+
+        # uncompressed size of each member written, and the size of its current file
+        expected = {}
+        written = {}
+        archive_file_new = archive_file + ".new"
+        with zipfile.ZipFile(archive_file_new, 'w', compression=zipfile.ZIP_DEFLATED) as archive_new:
+            archived = {}
+            if os.path.isfile(archive_file):
+                with zipfile.ZipFile(archive_file, 'r') as archive:
+                    for info in archive.infolist():
+                        if info.filename not in files:
+                            data = archive.read(info)
+                            archive_new.writestr(info, data)
+                            expected[info.filename] = len(data)
+                        elif info.filename.endswith(tuple(data_store.JOURNAL_EXTENSIONS)):
+                            archived[info.filename] = archive.read(info)
+            for (member, path) in files.items():
+                with open(path, 'rb') as f:
+                    data = f.read()
+                written[member] = len(data)
+                if member in archived:
+                    data = merge_journal(archived[member], data)
+                archive_new.writestr(member, data)
+                expected[member] = len(data)
+
+        with zipfile.ZipFile(archive_file_new, 'r') as archive_new:
+            sizes = {info.filename: info.file_size for info in archive_new.infolist()}
+            valid = archive_new.testzip() is None and sizes == expected
+        if not valid:
+            os.remove(archive_file_new)
+            print("Archive not verified, not compacted:", archive_file)
+            return {}
+        os.replace(archive_file_new, archive_file)
+        return written
+
+    def get_units(self):
+        """Returns removable units as list of (path, datetime, conversation_ids) tuples, oldest first"""
+
+        units = []
+        for (conversation_id, started) in self.get_conversation_directories():
+            units.append((os.path.join(self.directory, conversation_id), started, [conversation_id]))
+
+        if os.path.isdir(self.archive_directory):
+            for filename in os.listdir(self.archive_directory):
+                if not filename.endswith(data_store.ARCHIVE_EXTENSION):
+                    continue
+                archive_file = os.path.join(self.archive_directory, filename)
+                with zipfile.ZipFile(archive_file, 'r') as archive:
+                    conversation_ids = sorted(set(name.split("/", 1)[0] for name in archive.namelist()))
+                # an archive holds the conversations of one day and is removed after its last conversation
+                started = get_conversation_datetime(filename, archive_file)
+                if conversation_ids:
+                    started = get_conversation_datetime(conversation_ids[-1], archive_file)
+                units.append((archive_file, started, conversation_ids))
+
+        return sorted(units, key=lambda u: u[1])
+
+    def get_referenced_artifacts(self, path, conversation_ids):
+        """Returns the digests of the artifacts referenced by the conversations of a directory or an archive"""
+
+        digests = set()
+        if os.path.isdir(path):
+            for extension in data_store.LOG_FILE_EXTENSIONS:
+                log_file = os.path.join(path, conversation_ids[0] + extension)
+                if os.path.isfile(log_file):
+                    digests |= data_store.get_referenced_artifacts(log_file)
+                    break
+        else:
+            with zipfile.ZipFile(path, 'r') as archive:
+                names = archive.namelist()
+            for conversation_id in conversation_ids:
+                for extension in data_store.LOG_FILE_EXTENSIONS:
+                    member = conversation_id + "/" + conversation_id + extension
+                    if member in names:
+                        digests |= data_store.get_referenced_artifacts(member, path)
+                        break
+        return digests
+
+    def remove(self, now):
+        """
+        Removes conversations older than the maximum age, then the oldest ones while the conversations with the
+        artifacts they reference exceed the maximum size. An artifact counts as freed once no remaining
+        conversation references it, it is removed by the garbage collection following the policy.
+        """
+
+        manifest = []
+        all_units = self.get_units()
+        units = [u for u in all_units if not (os.path.isdir(u[0]) and data_store.is_conversation_open(u[0]))]
+
+        removed = []
+        if self.max_age_days is not None:
+            threshold = now - dt.timedelta(days=self.max_age_days)
+            removed = [u for u in units if u[1] < threshold]
+            units = [u for u in units if u[1] >= threshold]
+
+        if self.max_size_bytes is not None:
+            # artifacts by the number of conversation units referencing them, open conversations included
+            artifacts = artifact_store.ArtifactStore(os.path.join(self.directory, artifact_store.ARTIFACT_DIRECTORY))
+            digests_by_path = {}
+            references = {}
+            for (path, _, conversation_ids) in all_units:
+                digests_by_path[path] = self.get_referenced_artifacts(path, conversation_ids)
+                for digest in digests_by_path[path]:
+                    references[digest] = references.get(digest, 0) + 1
+            artifact_sizes = {}
+            for digest in references.keys():
+                artifact_path = artifacts.find_path(digest)
+                artifact_sizes[digest] = os.path.getsize(artifact_path) if artifact_path else 0
+
+            sizes = {u[0]: get_size(u[0]) for u in all_units}
+            total_size = sum(sizes.values()) + sum(artifact_sizes.values())
+
+            def drop(path):
+                freed = sizes[path]
+                for digest in digests_by_path[path]:
+                    references[digest] -= 1
+                    if references[digest] == 0:
+                        freed += artifact_sizes[digest]
+                return freed
+
+            for (path, _, _) in removed:
+                total_size -= drop(path)
+            while units and total_size > self.max_size_bytes:
+                unit = units.pop(0)
+                total_size -= drop(unit[0])
+                removed.append(unit)
+
+        for (path, _, conversation_ids) in removed:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.isfile(path):
+                os.remove(path)
+            for conversation_id in conversation_ids:
+                manifest.append(data_store.get_manifest_record(conversation_id, None))
+            print("Removed", os.path.relpath(path, self.directory), "with", len(conversation_ids), "conversations")
+
+        return manifest
+
+    def compact_manifest(self, records):
+        """
+        Rewrites the manifest with one record per remaining conversation, including the given new records. The
+        manifest is locked, so that conversations registered meanwhile by running data stores are kept.
+        """
+
+        manifest_file = os.path.join(self.directory, data_store.MANIFEST_FILE)
+        with data_store.lock_manifest(self.directory):
+            if records:
+                with open(manifest_file, 'a') as f:
+                    f.writelines(records)
+
+            locations = read_manifest(self.directory)
+            # conversations written before the manifest existed
+            for (conversation_id, _) in self.get_conversation_directories():
+                if conversation_id not in locations:
+                    locations[conversation_id] = conversation_id
+
+            manifest_file_new = manifest_file + ".new"
+            with open(manifest_file_new, 'w') as f:
+                for conversation_id in sorted(locations.keys()):
+                    f.write(data_store.get_manifest_record(conversation_id, locations[conversation_id]))
+            os.replace(manifest_file_new, manifest_file)
+
+    def apply(self, store=None, now=None):
+        """
+        Applies the policy to the log directory. With a data store, artifacts no longer referenced are removed.
+        Returns the number of conversations in the manifest.
+        """
+
+        if store:
+            store.flush()
+        if now is None:
+            now = dt.datetime.now()
+
+        records = self.compact(now)
+        records += self.remove(now)
+        self.compact_manifest(records)
+
+        if store:
+            (removed_files, removed_bytes) = store.collect_garbage()
+            print("Removed", removed_files, "artifacts,", removed_bytes, "bytes")
+
+        return len(read_manifest(self.directory))
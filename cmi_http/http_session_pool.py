@@ -0,0 +1,63 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Connections kept alive per endpoint, shared by all sessions of the process
+HTTP_POOL_SIZE = 10
+
+# Timeouts in seconds for establishing a connection and between received bytes of a response
+HTTP_CONNECT_TIMEOUT_S = 10.0
+HTTP_READ_TIMEOUT_S = 300.0
+
+class HTTPSessionPool:
+    """Shares one keep-alive HTTP session with a connection pool per endpoint (scheme, host and port)"""
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, connect_timeout_s=HTTP_CONNECT_TIMEOUT_S, read_timeout_s=HTTP_READ_TIMEOUT_S):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout_s, read_timeout_s)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, url):
+        """Returns the session for the endpoint of the given URL, creating it on first use"""
+
+        parts = urlsplit(url)
+        endpoint = (parts.scheme, parts.netloc)
+        with self.lock:
+            session = self.sessions.get(endpoint)
+            if session is None:
+                print("Creating HTTP connection pool:", parts.scheme + "://" + parts.netloc)
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+                session.mount(parts.scheme + "://" + parts.netloc, adapter)
+                self.sessions[endpoint] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        """Sends a request with the session of the endpoint, with the pool timeouts unless a timeout is given"""
+
+        kwargs.setdefault('timeout', self.timeout)
+        return self.get_session(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+# Process-wide pool, reused across all Streamlit sessions
+HTTP_SESSION_POOL = HTTPSessionPool()
+
+def get(url, **kwargs):
+    return HTTP_SESSION_POOL.get(url, **kwargs)
+
+def post(url, **kwargs):
+    return HTTP_SESSION_POOL.post(url, **kwargs)
@@ -2,9 +2,12 @@ import sys
 import requests
 import re
 import uuid
+import copy
 
 from plantweb.render import render, render_file
 
+import cmi_http.http_session_pool as http_session_pool
+
 INT_BPMN = "BPMN-Auto-Layout"
 INT_PLANTWEB = "Plantweb"
 
@@ -93,11 +96,64 @@ SYNTAX_MATCH_CODE_BLOCK = {
 
 SYNTAX_MATCH_CODE_WORD= r'`(.*?)`'
 
+# Grammars (GBNF) constraining the output of local LLMs to the source for an interpreter, matched by SYNTAX_MATCH
+GRAMMAR_PLANTUML = r'''
+root ::= "@startuml\n" line* "@enduml"
+line ::= ([^@\n] [^\n]*)? "\n"
+'''
+
+# the graph is named by one character as expected by SYNTAX_MATCH
+GRAMMAR_GRAPHVIZ = r'''
+root ::= "digraph G {\n" stmt* "}"
+stmt ::= ws (subgraph | edge | node | attr) ";"? "\n"
+subgraph ::= "subgraph" (" " id)? " {\n" stmt* ws "}"
+edge ::= id (ws "->" ws id)+ attrs?
+node ::= id attrs?
+attr ::= ("graph" | "node" | "edge") attrs | name ws "=" ws id
+attrs ::= ws "[" ws pair ("," ws pair)* ws "]"
+pair ::= name ws "=" ws id
+id ::= name | number | string
+name ::= [a-zA-Z_] [a-zA-Z0-9_]*
+number ::= "-"? [0-9]+ ("." [0-9]+)?
+string ::= "\"" ([^"\\\n] | "\\" [^\n])* "\""
+ws ::= [ \t]*
+'''
+
+# flow nodes of a BPMN process, the closing tag of an element is generated for each
+GRAMMAR_BPMN_FLOW_NODES = [
+    "startEvent", "endEvent", "intermediateCatchEvent", "intermediateThrowEvent", "boundaryEvent",
+    "task", "userTask", "serviceTask", "scriptTask", "manualTask", "sendTask", "receiveTask", "businessRuleTask",
+    "exclusiveGateway", "parallelGateway", "inclusiveGateway", "eventBasedGateway"
+]
+
+GRAMMAR_BPMN_XML = r'''
+root ::= "<bpmn:definitions" attrs ">\n" process "</bpmn:definitions>"
+process ::= ws "<bpmn:process" attrs ">\n" (ws element "\n")* ws "</bpmn:process>\n"
+element ::= flow | node
+flow ::= "<bpmn:sequenceFlow" attrs ("/>" | ">" (ws-nl condition)? ws-nl "</bpmn:sequenceFlow>")
+condition ::= "<bpmn:conditionExpression" attrs ">" text "</bpmn:conditionExpression>"
+node ::= ''' + " | ".join("node-" + n for n in GRAMMAR_BPMN_FLOW_NODES) + r'''
+''' + "".join('node-{0} ::= "<bpmn:{0}" attrs ("/>" | ">" ref* ws-nl "</bpmn:{0}>")\n'.format(n) for n in GRAMMAR_BPMN_FLOW_NODES) + r'''
+ref ::= ws-nl ("<bpmn:incoming>" name "</bpmn:incoming>" | "<bpmn:outgoing>" name "</bpmn:outgoing>")
+attrs ::= ([ \n\t]+ name "=\"" text "\"")* ws
+name ::= [a-zA-Z_] [a-zA-Z0-9_:.-]*
+text ::= [^"<&\n]*
+ws-nl ::= "\n"? ws
+ws ::= [ \t]*
+'''
+
+GRAMMAR_BY_ID = {
+    INT_BPMN_XML: GRAMMAR_BPMN_XML,
+    INT_PLANTWEB_PLANTUML: GRAMMAR_PLANTUML,
+    INT_PLANTWEB_GRAPHVIZ: GRAMMAR_GRAPHVIZ
+}
+
 class InterpreterRuntime:
     """Runs a supported interpreter based on the output of a LLM and returns a rendering of the result"""
 
     def __init__(self):
         print("Load Interpreter Runtime ...")
+        self.selected_interpreter = None
 
     def initialize_interpreter(self, selected_int, int_parameters, api_key, api_endpoint):
         """Sets interpreter parameters"""
@@ -113,7 +169,20 @@ class InterpreterRuntime:
         if api_endpoint:
             self.api_endpoint = api_endpoint
 
-    def execute_plantweb(self, int_input, plantweb_int_engine, plantweb_output_format, plantweb_use_cache):
+    def copy(self):
+        """Returns a runtime of the selected interpreter with a copy of its parameters, e.g., for a worker thread"""
+
+        runtime = copy.copy(self)
+        if getattr(self, "int_parameters", None) is not None:
+            runtime.int_parameters = dict(self.int_parameters)
+        return runtime
+
+    def get_grammar(self):
+        """Returns the grammar (GBNF) constraining LLM output to the source for the selected interpreter, or None"""
+
+        return GRAMMAR_BY_ID.get(self.selected_interpreter)
+
+    def execute_plantweb(self, int_input, plantweb_int_engine, plantweb_output_format=None, plantweb_use_cache=None):
         """Run Plantweb interpreter with the given API"""
 
         print("Interpreter Input:\n", int_input[:20], "...", sep="")
@@ -208,7 +277,7 @@ class InterpreterRuntime:
             data = int_input.encode('utf-8')
             headers = {'Content-Type': 'text/plain'}
             print(f"Sending request to {self.api_endpoint} ...")
-            response = requests.post(self.api_endpoint, data=data, headers=headers)
+            response = http_session_pool.post(self.api_endpoint, data=data, headers=headers)
 
             # https://github.com/MaxVidgof/bpmn-auto-layout
             # Example:
@@ -254,10 +323,10 @@ class InterpreterRuntime:
         if result and len(result) > 1:
             result_format = result[1]
 
-        # Decode SVG output using UTF-8
+        # Decode SVG output using UTF-8, returned with the input like any other output, as unpacked by the callers
         if result_format and result_format.lower() == "svg":
             if result_output and not isinstance(result_output, str):
-                return result_output.decode('utf-8')
+                return (int_input, result_output.decode('utf-8'))
 
         return (int_input, result_output)
 
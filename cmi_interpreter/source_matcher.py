@@ -0,0 +1,149 @@
+import re
+
+import cmi_interpreter.interpreter_runtime as interpreter_runtime
+
+# Characters kept from the previous chunk once the start of the source is found, so that end markers split
+# across chunks are found
+MARKER_OVERLAP = 32
+
+# Wildcard of a pattern of interpreter_runtime.SYNTAX_MATCH between the start and the end of the source, e.g.,
+# .*? of (.startuml.*?.enduml), or (.*?) of ```(.*?)```
+SOURCE_WILDCARD = re.compile(r'\(?\.\*\??\)?')
+
+class StreamedText:
+    """
+    Text streamed in chunks, joined only when read. Until the start of the source is found, the whole text is
+    searched, as a start marker may be longer than any chunk. Then, markers are searched in a window of the latest
+    chunk and a short overlap with the text before, so that each chunk is scanned about once.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+        self.window = ""
+        self.window_start = 0
+        self.start = None
+
+    @property
+    def text(self):
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+    def add_text(self, text):
+        self.chunks.append(text)
+        if self.start is None:
+            self.length += len(text)
+            (self.window, self.window_start) = (self.text, 0)
+            return
+        overlap = self.window[-MARKER_OVERLAP:]
+        self.window_start = self.length - len(overlap)
+        self.window = overlap + text
+        self.length += len(text)
+
+    def search(self, pattern, position=0):
+        """Returns the start and end of the first match at or after the given position in the window, or None"""
+
+        match = pattern.search(self.window, max(position - self.window_start, 0))
+        if not match:
+            return None
+        return (self.window_start + match.start(), self.window_start + match.end())
+
+class MarkerMatcher(StreamedText):
+    """
+    Detects in incrementally streamed text when source code between a start and an end marker is complete.
+    After the start, each chunk is scanned once, including a short overlap with the previous chunk.
+    """
+
+    def __init__(self, start_pattern, end_pattern):
+        super().__init__()
+        self.start_pattern = re.compile(start_pattern, flags=re.DOTALL)
+        self.end_pattern = re.compile(end_pattern, flags=re.DOTALL)
+        self.start_end = None
+        self.end = None
+
+    def feed(self, text):
+        """Adds streamed text, returns True once the source is complete"""
+
+        if self.end is not None:
+            return True
+        self.add_text(text)
+        if self.start is None:
+            match = self.search(self.start_pattern)
+            if match:
+                (self.start, self.start_end) = match
+        if self.start is not None:
+            match = self.search(self.end_pattern, self.start_end)
+            if match:
+                self.end = match[1]
+        return self.end is not None
+
+class BraceMatcher(StreamedText):
+    """
+    Detects in incrementally streamed text when a block opened by a start pattern ending with a brace is
+    complete, by balancing braces outside of quoted strings, e.g., the graph of the DOT language
+    """
+
+    def __init__(self, start_pattern):
+        super().__init__()
+        self.start_pattern = re.compile(start_pattern, flags=re.DOTALL)
+        self.end = None
+        self.depth = 0
+        self.quoted = False
+        self.escaped = False
+
+    def feed(self, text):
+        """Adds streamed text, returns True once the block is complete"""
+
+        if self.end is not None:
+            return True
+        position = self.length
+        self.add_text(text)
+        if self.start is None:
+            match = self.search(self.start_pattern)
+            if not match:
+                return False
+            (self.start, position) = match
+            self.depth = 1
+
+        for i in range(position - self.window_start, len(self.window)):
+            c = self.window[i]
+            if self.escaped:
+                self.escaped = False
+            elif c == '\\':
+                self.escaped = True
+            elif c == '"':
+                self.quoted = not self.quoted
+            elif not self.quoted:
+                if c == '{':
+                    self.depth += 1
+                elif c == '}':
+                    self.depth -= 1
+                    if self.depth == 0:
+                        self.end = self.window_start + i + 1
+                        break
+        return self.end is not None
+
+def split_syntax_match(pattern):
+    """Returns the start and end patterns of the source matched by a pattern of interpreter_runtime.SYNTAX_MATCH"""
+
+    (start, end) = SOURCE_WILDCARD.split(pattern, maxsplit=1)
+    # the group enclosing the source, e.g., (<bpmn(:definitions)?.*?/bpmn(:definitions)?>), is not matched by itself
+    if start.count('(') > start.count(')'):
+        start = start[1:]
+    while end.count(')') > end.count('('):
+        end = end[0:end.rindex(')')]
+    return (start, end)
+
+def get_source_matcher(int_id):
+    """
+    Returns a new matcher detecting when the source for the given interpreter is complete in a streamed response,
+    as matched by interpreter_runtime.SYNTAX_MATCH, or in a code block for other interpreters
+    """
+
+    pattern = interpreter_runtime.SYNTAX_MATCH.get(int_id, interpreter_runtime.SYNTAX_MATCH_CODE_BLOCK[interpreter_runtime.INT_PLANTWEB_DITAA])
+    (start, end) = split_syntax_match(pattern)
+    # a block closed by a brace, e.g., the graph of the DOT language, is complete when its braces are balanced
+    if end == r'\}':
+        return BraceMatcher(start)
+    return MarkerMatcher(start, end)
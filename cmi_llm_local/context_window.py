@@ -0,0 +1,235 @@
+import re
+import threading
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+import cmi_llm_local.dialogue_builder as dialogue_builder
+
+# Strategies to fit a conversation into the token budget
+CONTEXT_SLIDING_WINDOW = "window"
+CONTEXT_LATEST_SOURCE = "latest-source"
+CONTEXT_SUMMARIZE = "summarize"
+
+CONTEXT_STRATEGIES = [
+    CONTEXT_SLIDING_WINDOW, CONTEXT_LATEST_SOURCE, CONTEXT_SUMMARIZE
+]
+
+# Context size in tokens by LLM id prefix, unless set by an LLM parameter
+CONTEXT_SIZES = {
+    'OpenAI/gpt-4o': 128000,
+    'OpenAI/gpt-4-turbo': 128000,
+    'OpenAI/gpt-4-0125': 128000,
+    'OpenAI/gpt-4-0613': 8192,
+    'OpenAI/gpt-3.5-turbo': 16385,
+    'Replicate/mixtral': 32768,
+    'Replicate/llama3': 8192,
+    'Replicate/llama2': 4096,
+    'Ollama': 2048,
+    'Llama.cpp': 4096
+}
+CONTEXT_SIZE_DEFAULT = 4096
+
+# LLM parameters setting the context size and the maximum number of response tokens
+CONTEXT_SIZE_PARAMETERS = ["n_ctx", "num_ctx"]
+RESPONSE_TOKENS_PARAMETERS = ["max_new_tokens", "n_tokens_max", "max_tokens", "num_predict"]
+
+# Tokens reserved for the response if not set by an LLM parameter
+RESPONSE_TOKENS_DEFAULT = 1024
+
+# Tokens added per message for roles and separators
+MESSAGE_TOKENS = 4
+
+# Number of most recent messages never summarized
+SUMMARIZE_KEEP_MESSAGES = 4
+SUMMARY_LINE_LENGTH = 160
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_FORMAT = "re/llm/txt"
+SOURCE_OMITTED = "```\n(earlier model source omitted, see latest version below)\n```"
+
+# Model source in a response: code blocks, PlantUML and BPMN XML
+SOURCE_MATCH = r'```.*?```|@startuml.*?@enduml|<bpmn(?::definitions)?.*?/bpmn(?::definitions)?>'
+
+TOKEN_MATCH = r'\w+|[^\w\s]'
+
+def count_tokens_approx(text):
+    """Returns the approximate number of tokens of a text: one per punctuation character, one per 4 word characters"""
+
+    return sum(1 + (len(t) - 1) // 4 for t in re.findall(TOKEN_MATCH, text))
+
+def get_tokenizer(llm_id, llm_api_id=None):
+    """
+    Returns a function counting the tokens of a text for the given LLM. OpenAI models are counted with tiktoken if
+    it is installed and its encoding is available, other models approximately.
+    """
+
+    if tiktoken and llm_id.startswith('OpenAI') and llm_api_id:
+        try:
+            encoding = tiktoken.encoding_for_model(llm_api_id)
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception:
+            pass
+    return count_tokens_approx
+
+def get_context_size(llm_id, llm_parameters):
+    """Returns the context size in tokens of an LLM from its parameters or the known context sizes"""
+
+    for p in CONTEXT_SIZE_PARAMETERS:
+        if llm_parameters and p in llm_parameters:
+            return int(llm_parameters[p])
+    for (prefix, size) in CONTEXT_SIZES.items():
+        if llm_id.lower().startswith(prefix.lower()):
+            return size
+    return CONTEXT_SIZE_DEFAULT
+
+def get_response_tokens(llm_parameters):
+    """Returns the number of tokens reserved for the response from the LLM parameters"""
+
+    for p in RESPONSE_TOKENS_PARAMETERS:
+        if llm_parameters and p in llm_parameters and llm_parameters[p] and int(llm_parameters[p]) > 0:
+            return int(llm_parameters[p])
+    return RESPONSE_TOKENS_DEFAULT
+
+def summarize_message(message):
+    """Returns one summary line of a message: its first line of text outside model source"""
+
+    text = re.sub(SOURCE_MATCH, " (model source) ", message[dialogue_builder.MSG], flags=re.DOTALL)
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    line = lines[0] if lines else ""
+    if len(line) > SUMMARY_LINE_LENGTH:
+        line = line[0:SUMMARY_LINE_LENGTH] + " ..."
+    return "- " + message[dialogue_builder.ROLE] + ": " + line
+
+class ContextWindow:
+    """
+    Fits the messages of a conversation into a token budget before they are sent to an LLM. The budget is the
+    context size of the LLM less the tokens reserved for the response, optionally limited to a maximum. Messages
+    are trimmed by the selected strategy, falling back to dropping the oldest messages, always keeping the
+    initial message and the prompt.
+    """
+
+    def __init__(self, strategy=CONTEXT_SLIDING_WINDOW, max_tokens=None):
+        print("Load Context Window:", strategy, max_tokens or "")
+        self.strategy = strategy
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+        # totals of all fitted dialogues
+        self.tokens_sent = 0
+        self.tokens_saved = 0
+
+    def get_budget(self, llm_id, llm_parameters):
+        """Returns the number of dialogue tokens available for the given LLM and parameters"""
+
+        context_size = get_context_size(llm_id, llm_parameters)
+        response_tokens = get_response_tokens(llm_parameters)
+        if response_tokens >= context_size:
+            print("Context window: response tokens", response_tokens, "exceed the context size", context_size, "of", llm_id)
+            response_tokens = context_size // 2
+        budget = context_size - response_tokens
+        if self.max_tokens:
+            budget = min(budget, self.max_tokens)
+        return budget
+
+    def count(self, messages, count_tokens):
+        """Returns the number of tokens of the messages included in a dialogue"""
+
+        tokens = 0
+        for message in messages:
+            if dialogue_builder.include_message(message):
+                tokens += MESSAGE_TOKENS + count_tokens(message[dialogue_builder.ROLE] + ": " + message[dialogue_builder.MSG])
+        return tokens
+
+    def fit(self, context, llm_id, llm_parameters, count_tokens=count_tokens_approx):
+        """
+        Returns the context fitted into the token budget. The context is returned unchanged if it fits, so that
+        dialogues can still be extended incrementally.
+        """
+
+        budget = self.get_budget(llm_id, llm_parameters)
+        tokens = self.count(context, count_tokens)
+        if tokens <= budget or len(context) <= 2:
+            self.add_totals(tokens, 0)
+            return context
+
+        fitted = context
+        if self.strategy == CONTEXT_LATEST_SOURCE:
+            fitted = self.omit_earlier_source(fitted)
+        elif self.strategy == CONTEXT_SUMMARIZE:
+            fitted = self.summarize(fitted, budget, count_tokens)
+        fitted = self.slide(fitted, budget, count_tokens)
+
+        tokens_fitted = self.count(fitted, count_tokens)
+        self.add_totals(tokens_fitted, tokens - tokens_fitted)
+        print("Context window ({}): {} of {} tokens sent, {} saved, budget {}".format(
+            self.strategy, tokens_fitted, tokens, tokens - tokens_fitted, budget))
+        return fitted
+
+    def add_totals(self, tokens_sent, tokens_saved):
+        with self.lock:
+            self.tokens_sent += tokens_sent
+            self.tokens_saved += tokens_saved
+
+    def omit_earlier_source(self, context):
+        """Replaces the model source of all but the latest response containing source by a placeholder"""
+
+        latest = None
+        for i in range(len(context) - 1, -1, -1):
+            message = context[i]
+            if dialogue_builder.include_message(message) and message[dialogue_builder.ROLE] == dialogue_builder.ROLE_AS:
+                if re.search(SOURCE_MATCH, message[dialogue_builder.MSG], flags=re.DOTALL):
+                    latest = i
+                    break
+
+        fitted = []
+        for (i, message) in enumerate(context):
+            if latest is not None and i < latest:
+                if dialogue_builder.include_message(message) and message[dialogue_builder.ROLE] == dialogue_builder.ROLE_AS:
+                    text = re.sub(SOURCE_MATCH, SOURCE_OMITTED, message[dialogue_builder.MSG], flags=re.DOTALL)
+                    if text != message[dialogue_builder.MSG]:
+                        message = message | {dialogue_builder.MSG: text}
+            fitted.append(message)
+        return fitted
+
+    def summarize(self, context, budget, count_tokens):
+        """
+        Replaces the oldest messages after the initial message by one summary message with a line per message,
+        summarizing as few messages as needed to fit the budget
+        """
+
+        last = len(context) - SUMMARIZE_KEEP_MESSAGES
+        if last <= 1:
+            return context
+
+        message_tokens = [self.count([m], count_tokens) for m in context]
+        tokens = sum(message_tokens)
+        fitted = context
+        lines = []
+        for k in range(1, last):
+            if dialogue_builder.include_message(context[k]):
+                lines.append(summarize_message(context[k]))
+            tokens -= message_tokens[k]
+            summary = {
+                dialogue_builder.ROLE: dialogue_builder.ROLE_AS,
+                dialogue_builder.MSG: SUMMARY_PREFIX + "\n".join(lines),
+                dialogue_builder.MSG_FORMAT: SUMMARY_FORMAT
+            }
+            fitted = [context[0], summary] + context[k + 1:]
+            if tokens + self.count([summary], count_tokens) <= budget:
+                break
+        return fitted
+
+    def slide(self, context, budget, count_tokens):
+        """Drops the oldest messages after the initial message until the context fits the budget"""
+
+        message_tokens = [self.count([m], count_tokens) for m in context]
+        tokens = sum(message_tokens)
+        first = 1
+        while tokens > budget and first < len(context) - 1:
+            tokens -= message_tokens[first]
+            first += 1
+        if first == 1:
+            return context
+        return context[0:1] + context[first:]
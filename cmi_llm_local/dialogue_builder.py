@@ -0,0 +1,91 @@
+ROLE = "role"
+ROLE_AS = "assistant"
+ROLE_US = "user"
+
+MSG = "message"
+MSG_FORMAT = "format"
+MSG_FORMAT_RESPONSE_INT = "re/int"
+# messages only displayed, e.g., the responses of a fan-out other than the one continuing the conversation
+MSG_DISPLAY_ONLY = "display_only"
+
+def include_message(message):
+    """
+    Returns True for user and assistant messages to be included in the prompt, including generated code,
+    not including interpreter output and messages only displayed
+    """
+
+    if MSG_FORMAT in message.keys() and ROLE in message.keys() and not message.get(MSG_DISPLAY_ONLY):
+        if message[MSG_FORMAT] != MSG_FORMAT_RESPONSE_INT:
+            return message[ROLE] == ROLE_US or message[ROLE] == ROLE_AS
+    return False
+
+def format_text_message(separator):
+    """Returns a function formatting a message as '<role>: <message><separator>'"""
+    return lambda message: message[ROLE] + ": " + message[MSG] + separator
+
+def format_chat_message(message):
+    """Formats a message as chat message of the OpenAI API"""
+    return {"role": message[ROLE], "content": message[MSG]}
+
+class DialogueBuilder:
+    """
+    Builds the dialogue of a conversation from its message list, as text or as list of chat messages. Formatted
+    segments are cached per message; for a list extended by new messages, only the new messages are formatted.
+    Cached segments are invalidated from the first message that was removed or replaced, e.g., by a re-run.
+    """
+
+    def __init__(self, format_message, header="", as_text=True):
+        self.format_message = format_message
+        self.header = header
+        self.as_text = as_text
+        # messages with their formatted segment, None for messages not included
+        self.messages = []
+        self.segments = []
+        # for text dialogues, the text of all segments and the text length after each message
+        self.text = ""
+        self.text_lengths = []
+
+    def get_common_length(self, context):
+        """Returns the number of leading messages of the context that are cached unchanged"""
+
+        n = min(len(context), len(self.messages))
+        i = 0
+        while i < n and context[i] is self.messages[i][0] and context[i].get(MSG) is self.messages[i][1]:
+            i += 1
+        return i
+
+    def invalidate(self, i):
+        """Removes cached segments from the message at the given position"""
+
+        del self.messages[i:]
+        del self.segments[i:]
+        if self.as_text:
+            self.text = self.text[0:self.text_lengths[i - 1]] if i > 0 else ""
+            del self.text_lengths[i:]
+
+    def build(self, context):
+        """Returns the dialogue for the given message list, as text or as list of chat messages"""
+
+        i = self.get_common_length(context)
+        if i < len(self.messages):
+            self.invalidate(i)
+
+        new_segments = []
+        for message in context[i:]:
+            segment = self.format_message(message) if include_message(message) else None
+            self.messages.append((message, message.get(MSG)))
+            self.segments.append(segment)
+            if self.as_text:
+                if segment:
+                    new_segments.append(segment)
+                self.text_lengths.append((self.text_lengths[-1] if self.text_lengths else 0) + (len(segment) if segment else 0))
+
+        if self.as_text:
+            if new_segments:
+                self.text += "".join(new_segments)
+            return self.header + self.text
+
+        return [segment for segment in self.segments if segment is not None]
+
+    def clear(self):
+        self.invalidate(0)
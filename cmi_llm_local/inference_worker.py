@@ -0,0 +1,333 @@
+import uuid
+import queue
+import threading
+import time
+import multiprocessing
+import multiprocessing.connection
+from time import perf_counter
+from collections import OrderedDict, deque
+
+import cmi_llm_local.llm_runtime as llm_runtime
+import cmi_llm_local.llama_model_pool as llama_model_pool
+import cmi_llm_local.llama_state_cache as llama_state_cache
+import cmi_llm_local.context_window as context_window
+
+# Messages from worker processes
+JOB_STARTED = "started"
+JOB_TOKEN = "token"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+
+# Cancelled job ids remembered by a worker, for cancellations arriving before or after a job ran
+WORKER_CANCELLED_IDS = 256
+
+# Seconds between checks that the worker processes are alive
+WORKER_CHECK_INTERVAL_S = 1.0
+
+# Process-wide pool shared by all sessions
+shared_pool = None
+shared_lock = threading.Lock()
+
+def get_shared_pool(workers=1, worker_config=None):
+    """Returns the process-wide pool of inference worker processes, started on first use"""
+
+    global shared_pool
+    with shared_lock:
+        if shared_pool is None:
+            shared_pool = InferenceWorkerPool(workers, worker_config)
+    return shared_pool
+
+def run_worker(worker_id, job_queue, control_queue, results, worker_config):
+    """
+    Runs jobs with a local LLM runtime in a worker process until a job None is received, streaming the text of
+    each generated token to the results connection. Job ids received on the control queue are cancelled.
+    """
+
+    config = worker_config or {}
+    window = None
+    if config.get("context_window_strategy"):
+        window = context_window.ContextWindow(config["context_window_strategy"], config.get("context_window_max_tokens"))
+    model_pool = llama_model_pool.LlamaModelPool(config.get("memory_budget_bytes", llama_model_pool.LLAMA_POOL_MEMORY_BUDGET_BYTES))
+    state_cache = None
+    if config.get("state_cache_bytes") is not None:
+        state_cache = llama_state_cache.LlamaStateCache(config["state_cache_bytes"], config.get("state_spill_bytes", 0))
+    runtime = llm_runtime.LLMRuntime(window, model_pool, state_cache)
+    cancelled = deque(maxlen=WORKER_CANCELLED_IDS)
+
+    def is_cancelled(job_id):
+        try:
+            while True:
+                cancelled.append(control_queue.get_nowait())
+        except queue.Empty:
+            pass
+        return job_id in cancelled
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        (job_id, llm_id, llm_parameters, context, prompt, grammar) = job
+        if is_cancelled(job_id):
+            results.send((JOB_DONE, job_id, worker_id, True))
+            continue
+        results.send((JOB_STARTED, job_id, worker_id, None))
+        try:
+            runtime.load_llm_files(llm_id, llm_parameters)
+            (items, item_function) = runtime.run_prompt(context, prompt, grammar=grammar)
+            stopped = False
+            for item in items:
+                if is_cancelled(job_id):
+                    stopped = True
+                    items.close()
+                    break
+                results.send((JOB_TOKEN, job_id, worker_id, item_function(item)))
+            results.send((JOB_DONE, job_id, worker_id, stopped))
+        except Exception as e:
+            results.send((JOB_ERROR, job_id, worker_id, "{}: {}".format(type(e).__name__, e)))
+
+class InferenceJob:
+    """
+    A prompt run by a worker process, iterated as the text of the generated tokens. Closing the job, e.g., when
+    the consumer stops early, cancels it, whether queued or running.
+    """
+
+    def __init__(self, pool, session_id, job):
+        self.pool = pool
+        self.session_id = session_id
+        self.job = job
+        self.job_id = job[0]
+        self.tokens = queue.Queue()
+        self.worker_id = None
+        self.request_metrics = None
+        self.t_submit = perf_counter()
+        self.t_start = None
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        (kind, value) = self.tokens.get()
+        if kind == JOB_TOKEN:
+            return value
+        self.done = True
+        if kind == JOB_ERROR:
+            raise RuntimeError("Inference worker failed: " + value)
+        raise StopIteration
+
+    def close(self):
+        """Cancels the job"""
+
+        if not self.done:
+            self.done = True
+            self.pool.cancel(self)
+
+class InferenceWorkerPool:
+    """
+    Runs local LLMs in worker processes, so that CPU inference neither holds the GIL of the UI process nor blocks
+    its sessions. Jobs are queued per session and dispatched round-robin across sessions to idle workers, so that
+    one session submitting many prompts does not delay the others. Generated tokens are streamed back through a
+    pipe per worker read by a dispatcher thread, which also restarts worker processes that died, failing their
+    jobs; a new pipe keeps a worker killed while writing from blocking or corrupting the messages of its successor.
+    """
+
+    def __init__(self, workers=1, worker_config=None):
+        print("Load Inference Worker Pool:", workers, "workers")
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.worker_config = worker_config
+        self.lock = threading.Lock()
+        self.queued = OrderedDict()
+        self.jobs = {}
+        self.idle = []
+        self.job_queues = [None] * workers
+        self.control_queues = [None] * workers
+        self.result_connections = [None] * workers
+        self.processes = [None] * workers
+        # totals for queue metrics
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.max_queued = 0
+        self.queue_s = 0.0
+        self.restarted = 0
+        for worker_id in range(workers):
+            self.start_worker(worker_id)
+        threading.Thread(target=self.run_dispatcher, name="cmi-inference-dispatcher", daemon=True).start()
+
+    def start_worker(self, worker_id):
+        """Starts the process of a worker, with new queues for its jobs and cancellations and a new results pipe, idle"""
+
+        job_queue = self.mp_context.Queue()
+        control_queue = self.mp_context.Queue()
+        (result_connection, results) = self.mp_context.Pipe(duplex=False)
+        process = self.mp_context.Process(target=run_worker, args=(worker_id, job_queue, control_queue, results, self.worker_config),
+                                          name="cmi-inference-worker-" + str(worker_id), daemon=True)
+        process.start()
+        # with the sending end owned by the worker only, the pipe reports end of file once the worker exits
+        results.close()
+        if self.result_connections[worker_id] is not None:
+            self.result_connections[worker_id].close()
+        self.job_queues[worker_id] = job_queue
+        self.control_queues[worker_id] = control_queue
+        self.result_connections[worker_id] = result_connection
+        self.processes[worker_id] = process
+        self.idle.append(worker_id)
+
+    def check_workers(self):
+        """Fails the jobs of worker processes that died, e.g., killed when out of memory, and restarts them"""
+
+        failed = []
+        with self.lock:
+            for (worker_id, process) in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                print("Inference worker", worker_id, "died with exit code", process.exitcode, "- restarting")
+                for job in [j for j in self.jobs.values() if j.worker_id == worker_id]:
+                    del self.jobs[job.job_id]
+                    self.completed += 1
+                    failed.append(job)
+                self.restarted += 1
+                self.start_worker(worker_id)
+            self.dispatch()
+        for job in failed:
+            job.tokens.put((JOB_ERROR, "worker process died"))
+
+    def submit(self, session_id, llm_id, llm_parameters, context, prompt, request_metrics=None, grammar=None):
+        """Queues a prompt of a session, returns the job streaming its response"""
+
+        job = InferenceJob(self, session_id, (uuid.uuid4().hex, llm_id, dict(llm_parameters), list(context), prompt, grammar))
+        job.request_metrics = request_metrics
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self.queued.setdefault(session_id, deque()).append(job)
+            self.submitted += 1
+            depth = self.get_queue_depth()
+            self.max_queued = max(self.max_queued, depth)
+            self.dispatch()
+        print("Inference job queued:", job.job_id[0:8], "queue depth", depth)
+        return job
+
+    def get_queue_depth(self):
+        return sum(len(jobs) for jobs in self.queued.values())
+
+    def dispatch(self):
+        """Assigns queued jobs to idle workers, taking turns between sessions"""
+
+        while self.idle and self.queued:
+            (session_id, jobs) = self.queued.popitem(last=False)
+            job = jobs.popleft()
+            if jobs:
+                self.queued[session_id] = jobs
+            job.worker_id = self.idle.pop(0)
+            self.job_queues[job.worker_id].put(job.job)
+
+    def cancel(self, job):
+        """Cancels a queued job, or a running job once the worker notices"""
+
+        with self.lock:
+            self.cancelled += 1
+            jobs = self.queued.get(job.session_id)
+            if jobs and job in jobs:
+                jobs.remove(job)
+                if not jobs:
+                    del self.queued[job.session_id]
+                del self.jobs[job.job_id]
+                return
+            worker_id = job.worker_id
+        if worker_id is not None:
+            self.control_queues[worker_id].put(job.job_id)
+
+    def run_dispatcher(self):
+        """Routes messages of the workers to their jobs, restarting workers that died"""
+
+        t_check = time.monotonic()
+        while True:
+            if time.monotonic() - t_check >= WORKER_CHECK_INTERVAL_S:
+                self.check_workers()
+                t_check = time.monotonic()
+            with self.lock:
+                connections = {c: worker_id for (worker_id, c) in enumerate(self.result_connections)}
+            for connection in multiprocessing.connection.wait(list(connections), timeout=WORKER_CHECK_INTERVAL_S):
+                try:
+                    self.route(connection.recv())
+                except (EOFError, OSError):
+                    # the worker exited, restarted once its process is reaped
+                    self.processes[connections[connection]].join(WORKER_CHECK_INTERVAL_S)
+                    t_check = 0
+
+    def route(self, message):
+        """Passes a message of a worker to its job, dispatching a queued job once the worker becomes idle"""
+
+        (kind, job_id, worker_id, value) = message
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if kind == JOB_STARTED and job:
+                job.t_start = perf_counter()
+                self.started += 1
+                self.queue_s += job.t_start - job.t_submit
+            elif kind in (JOB_DONE, JOB_ERROR) and job:
+                # messages of jobs already failed by a restart of their worker are dropped
+                del self.jobs[job_id]
+                self.completed += 1
+                self.idle.append(worker_id)
+                self.dispatch()
+        if job is None:
+            return
+        if kind == JOB_STARTED:
+            if job.request_metrics:
+                job.request_metrics.mark_request()
+        else:
+            job.tokens.put((kind, value))
+
+    def get_metrics(self):
+        """Returns the queue metrics as dict"""
+
+        with self.lock:
+            return {
+                "workers": len(self.processes),
+                "busy": len(self.processes) - len(self.idle),
+                "queued": self.get_queue_depth(),
+                "max_queued": self.max_queued,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "restarted": self.restarted,
+                "mean_queue_s": round(self.queue_s / self.started, 3) if self.started else None
+            }
+
+class WorkerLLMRuntime:
+    """
+    Runs local LLMs of one session in the worker processes of the shared pool, with the interface of LLMRuntime.
+    Responses are streamed as text.
+    """
+
+    def __init__(self, pool):
+        print("Load Worker LLM Runtime ...")
+        self.pool = pool
+        self.session_id = uuid.uuid4().hex
+        self.selected_llm = None
+        self.llm_parameters = None
+
+    def load_llm_files(self, selected_llm, llm_parameters):
+        """Selects the LLM, loaded by the worker running the next job"""
+
+        if selected_llm in llm_runtime.LLM_BY_ID:
+            self.selected_llm = selected_llm
+            self.llm_parameters = llm_parameters
+
+    def run_prompt(self, context, prompt, request_metrics=None, grammar=None):
+        """
+        Queues the prompt, the last message of the context. Returns the response as tuple (items_wrapped,
+        item_function); the request is marked in the given metrics once a worker starts it. The output is
+        constrained by the grammar (GBNF), if given.
+        """
+
+        job = self.pool.submit(self.session_id, self.selected_llm, self.llm_parameters, context, prompt, request_metrics, grammar)
+        print("Inference workers:", self.pool.get_metrics())
+        return (job, lambda item: item)
+
+    def clear_returned_context(self):
+        pass
@@ -0,0 +1,154 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+from llama_cpp import Llama, LlamaGrammar
+
+# Memory in bytes that loaded models may take before unused models are evicted, least recently used first
+LLAMA_POOL_MEMORY_BUDGET_BYTES = 16 * 1024 * 1024 * 1024
+
+# Process-wide pool shared by all sessions
+shared_pool = None
+shared_lock = threading.Lock()
+
+def get_shared_pool(memory_budget_bytes=LLAMA_POOL_MEMORY_BUDGET_BYTES):
+    """Returns the process-wide pool of loaded llama.cpp models, created on first use"""
+
+    global shared_pool
+    with shared_lock:
+        if shared_pool is None:
+            shared_pool = LlamaModelPool(memory_budget_bytes)
+    return shared_pool
+
+def get_key(model_path, n_ctx, n_threads=None):
+    """Returns the key of a loaded model by its file and load-time parameters"""
+
+    return (os.path.abspath(model_path), n_ctx, n_threads)
+
+class LlamaModel:
+    """A model loaded into the pool, with the lock serializing its inference"""
+
+    def __init__(self, key, llama, size_bytes, load_s):
+        self.key = key
+        self.llama = llama
+        self.size_bytes = size_bytes
+        self.load_s = load_s
+        self.refs = 0
+        self.lock = threading.Lock()
+        # grammars parsed for this model by GBNF text, used while holding the lock
+        self.grammars = {}
+
+    def stream(self, create_items):
+        """Yields the items created by the given function while holding the model, released when done or closed early"""
+
+        with self.lock:
+            yield from create_items()
+
+    def get_grammar(self, grammar):
+        """Returns the parsed grammar for a GBNF text, parsed once per model"""
+
+        if grammar not in self.grammars:
+            self.grammars[grammar] = LlamaGrammar.from_string(grammar, verbose=False)
+        return self.grammars[grammar]
+
+class LlamaModelPool:
+    """
+    Shares loaded llama.cpp models across sessions, keyed by model file and load-time parameters. Models are
+    memory-mapped and reference counted. Once the models exceed the memory budget, unreferenced models are
+    evicted, least recently used first. The memory of a model is estimated by the size of its file.
+    """
+
+    def __init__(self, memory_budget_bytes=LLAMA_POOL_MEMORY_BUDGET_BYTES):
+        print("Load llama.cpp Model Pool:", memory_budget_bytes // (1024 * 1024), "MB")
+        self.memory_budget_bytes = memory_budget_bytes
+        self.models = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        # totals for load metrics
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        self.load_s = 0.0
+
+    def acquire(self, model_path, n_ctx, n_threads=None):
+        """Returns the loaded model for the file and parameters, loading it if needed; release it when no longer used"""
+
+        key = get_key(model_path, n_ctx, n_threads)
+        while True:
+            with self.lock:
+                model = self.models.get(key)
+                if model:
+                    model.refs += 1
+                    self.models.move_to_end(key)
+                    self.hits += 1
+                    return model
+                loading = self.loading.get(key)
+                if loading is None:
+                    loading = self.loading[key] = threading.Event()
+                    break
+            # loaded by another session
+            loading.wait()
+
+        try:
+            model = self.load(key)
+        finally:
+            with self.lock:
+                del self.loading[key]
+                loading.set()
+
+        with self.lock:
+            model.refs += 1
+            self.models[key] = model
+            self.evict()
+        return model
+
+    def load(self, key):
+        (model_path, n_ctx, n_threads) = key
+        size_bytes = os.path.getsize(model_path)
+        print("Loading llama.cpp model:", model_path, "({} MB)".format(size_bytes // (1024 * 1024)))
+        t_start = time.perf_counter()
+        llama = Llama(model_path=model_path, n_ctx=n_ctx, n_threads=n_threads, use_mmap=True)
+        load_s = time.perf_counter() - t_start
+        with self.lock:
+            self.loads += 1
+            self.load_s += load_s
+        print("Loaded llama.cpp model in {:.2f} s:".format(load_s), model_path)
+        return LlamaModel(key, llama, size_bytes, load_s)
+
+    def release(self, model):
+        """Releases a model acquired before, it may be evicted once no longer used"""
+
+        with self.lock:
+            model.refs -= 1
+            self.evict()
+
+    def evict(self):
+        """Evicts unreferenced models, least recently used first, until the models fit the memory budget"""
+
+        size_bytes = sum(m.size_bytes for m in self.models.values())
+        for key in list(self.models.keys()):
+            if size_bytes <= self.memory_budget_bytes:
+                break
+            model = self.models[key]
+            if model.refs > 0:
+                continue
+            del self.models[key]
+            size_bytes -= model.size_bytes
+            self.evictions += 1
+            print("Evicted llama.cpp model:", key[0])
+        if size_bytes > self.memory_budget_bytes:
+            print("llama.cpp models in use exceed the memory budget:", size_bytes // (1024 * 1024), "MB")
+
+    def get_metrics(self):
+        """Returns the load metrics as dict"""
+
+        with self.lock:
+            return {
+                "models": len(self.models),
+                "size_mb": sum(m.size_bytes for m in self.models.values()) // (1024 * 1024),
+                "loads": self.loads,
+                "hits": self.hits,
+                "evictions": self.evictions,
+                "load_s": round(self.load_s, 3)
+            }
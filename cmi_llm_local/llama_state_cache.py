@@ -0,0 +1,162 @@
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+STATE_DIRECTORY = os.path.join("cmi_cache", "llama_states")
+STATE_EXTENSION = ".state"
+
+# Weight of the latest turn in the average prefill seconds per token
+PREFILL_AVERAGE_WEIGHT = 0.2
+
+# Process-wide cache shared by all runtimes
+shared_cache = None
+shared_lock = threading.Lock()
+
+def get_shared_cache(max_bytes, spill_max_bytes=0):
+    """Returns the process-wide cache of llama.cpp states, created on first use"""
+
+    global shared_cache
+    with shared_lock:
+        if shared_cache is None:
+            shared_cache = LlamaStateCache(max_bytes, spill_max_bytes)
+    return shared_cache
+
+def get_key(model_key, dialogue):
+    """Returns the key of a state by the loaded model and the dialogue prompted"""
+
+    return hashlib.sha256((repr(model_key) + "\n" + dialogue).encode('utf-8')).hexdigest()
+
+def get_state_tokens(state):
+    """Returns the tokens evaluated into a state"""
+
+    tokens = getattr(state, "input_ids", None)
+    if tokens is None:
+        tokens = getattr(state, "eval_tokens", [])
+    return list(tokens)
+
+def get_state_size(state):
+    """Returns the approximate size of a state in bytes: the llama.cpp state with the tokens and logits copied"""
+
+    size = getattr(state, "llama_state_size", 0)
+    for name in ["input_ids", "scores"]:
+        size += getattr(getattr(state, name, None), "nbytes", 0)
+    return size
+
+def get_common_prefix(tokens_a, tokens_b):
+    n = 0
+    for (a, b) in zip(tokens_a, tokens_b):
+        if a != b:
+            break
+        n += 1
+    return n
+
+class LlamaStateCache:
+    """
+    Keeps llama.cpp model states (KV cache, tokens and logits) after a response, keyed by the dialogue prompted,
+    so that the next turn of a conversation restores the state and only evaluates the new suffix of its prompt.
+    States are kept in memory up to a budget; least recently used states are spilled to disk up to another
+    budget, or dropped without one.
+    """
+
+    def __init__(self, max_bytes, spill_max_bytes=0, directory=STATE_DIRECTORY):
+        print("Load llama.cpp State Cache:", max_bytes // (1024 * 1024), "MB, spill", spill_max_bytes // (1024 * 1024), "MB")
+        self.max_bytes = max_bytes
+        self.spill_max_bytes = spill_max_bytes
+        self.directory = directory
+        self.states = OrderedDict()
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+        # totals for prefill metrics
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.prefill_s_saved = 0.0
+        self.prefill_s_per_token = None
+        if spill_max_bytes:
+            os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + STATE_EXTENSION)
+
+    def get(self, key):
+        """Returns the state for a key from memory or disk, or None"""
+
+        with self.lock:
+            entry = self.states.get(key)
+            if entry:
+                self.states.move_to_end(key)
+                return entry[0]
+        if not self.spill_max_bytes or not os.path.isfile(self.get_path(key)):
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print("llama.cpp state not loaded:", key[0:12], e)
+            return None
+        self.put(key, state)
+        return state
+
+    def put(self, key, state):
+        """Stores a state in memory, spilling or dropping least recently used states beyond the memory budget"""
+
+        size = get_state_size(state)
+        spilled = []
+        with self.lock:
+            if key in self.states:
+                self.size_bytes -= self.states.pop(key)[1]
+            self.states[key] = (state, size)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes and self.states:
+                (evicted_key, (evicted_state, evicted_size)) = self.states.popitem(last=False)
+                self.size_bytes -= evicted_size
+                spilled.append((evicted_key, evicted_state))
+        if self.spill_max_bytes:
+            for (evicted_key, evicted_state) in spilled:
+                self.spill(evicted_key, evicted_state)
+
+    def spill(self, key, state):
+        """Writes a state to disk, removing the oldest spilled states beyond the disk budget"""
+
+        path = self.get_path(key)
+        if not os.path.isfile(path):
+            try:
+                with open(path + ".new", 'wb') as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + ".new", path)
+            except (OSError, pickle.PicklingError, TypeError) as e:
+                print("llama.cpp state not spilled:", key[0:12], e)
+                return
+
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(STATE_EXTENSION)]
+        files.sort(key=os.path.getmtime)
+        size_bytes = sum(os.path.getsize(f) for f in files)
+        for f in files:
+            if size_bytes <= self.spill_max_bytes:
+                break
+            size_bytes -= os.path.getsize(f)
+            os.remove(f)
+
+    def add_turn(self, prompt_tokens, tokens_restored, prefill_s):
+        """
+        Adds the prefill of a turn to the metrics and returns the estimated seconds saved by the restored tokens,
+        based on the average prefill time per token of turns without a restored state
+        """
+
+        with self.lock:
+            if tokens_restored == 0:
+                self.misses += 1
+                if prompt_tokens > 0:
+                    s_per_token = prefill_s / prompt_tokens
+                    if self.prefill_s_per_token is None:
+                        self.prefill_s_per_token = s_per_token
+                    else:
+                        self.prefill_s_per_token += PREFILL_AVERAGE_WEIGHT * (s_per_token - self.prefill_s_per_token)
+                return 0.0
+            self.hits += 1
+            self.tokens_saved += tokens_restored
+            s_saved = tokens_restored * (self.prefill_s_per_token or 0.0)
+            self.prefill_s_saved += s_saved
+            return s_saved
@@ -5,9 +5,21 @@ import replicate
 import openai
 
 import requests
+import httpx
 import json
 import re
 
+import cmi_http.http_session_pool as http_session_pool
+import cmi_llm_local.ndjson_stream as ndjson_stream
+import cmi_llm_local.response_cache as response_cache
+import cmi_llm_local.llm_async_client as llm_async_client
+import cmi_llm_local.dialogue_builder as dialogue_builder
+import cmi_llm_local.context_window as context_window
+import cmi_llm_local.ollama_context as ollama_context
+import cmi_llm_local.llm_metrics as llm_metrics
+import cmi_llm_local.llm_resilience as llm_resilience
+import cmi_llm_local.ollama_pool as ollama_pool
+
 API_OPENAPI = "OpenAI"
 API_REPLICATE = "Replicate"
 API_OLLAMA = "Ollama"
@@ -37,6 +49,14 @@ LLM_BY_ID = {
     # TODO: Phi, Codestral
 }
 
+# Ollama APIs: generate continues from the context returned for the conversation, chat sends all messages
+OLLAMA_API_GENERATE = "generate"
+OLLAMA_API_CHAT = "chat"
+
+OLLAMA_API_IDS = [
+    OLLAMA_API_GENERATE, OLLAMA_API_CHAT
+]
+
 # Query the following models on startup (overwrites pre-defined models) 
 LLM_API_QUERY_AVAILABLE_MODELS = [
      API_OLLAMA
@@ -110,11 +130,39 @@ MSG_FORMAT_RESPONSE_INT = "re/int"
 class LLMApiClient:
     """Requests running a LLM through an API"""
 
-    def __init__(self):
+    def __init__(self, response_cache=None, async_streams=False, context_window=None, ollama_api=OLLAMA_API_GENERATE, ollama_keep_alive=None, resilience_policy=None):
         print("Load LLM API client ...")
+        # optional cache of complete responses, shared by all clients of the process
+        self.response_cache = response_cache
+        # optional token budget the dialogue is fitted into before it is sent
+        self.context_window = context_window
+        # optionally stream responses with the process-wide async client, consumed through a synchronous iterator
+        self.async_client = None
+        self.async_loop_thread = None
+        if async_streams:
+            (self.async_client, self.async_loop_thread) = llm_async_client.get_shared_client()
+        # dialogues in the format of each API, extended incrementally
+        self.dialogue_llama2 = dialogue_builder.DialogueBuilder(dialogue_builder.format_text_message("\\n\\n"), CTX_TEMPLATE + "\\n\\n")
+        self.dialogue_replicate = dialogue_builder.DialogueBuilder(dialogue_builder.format_text_message("\n\n"), CTX_TEMPLATE + "\n\n")
+        self.dialogue_chat = dialogue_builder.DialogueBuilder(dialogue_builder.format_chat_message, as_text=False)
+        self.dialogue_ollama = dialogue_builder.DialogueBuilder(dialogue_builder.format_text_message("\n\n"), CTX_TEMPLATE + "\n\n")
+        # Ollama API and how long Ollama keeps the model loaded after a request, e.g., "30m" or -1 (server default if None)
+        self.ollama_api = ollama_api
+        self.ollama_keep_alive = ollama_keep_alive
+        # contexts returned by Ollama per conversation, shared by all clients of the process
+        self.ollama_contexts = ollama_context.get_shared_store()
+        # metrics of the last request
+        self.request_metrics = None
+        # optional timeouts, retries and hedging of requests
+        self.resilience_policy = resilience_policy
 
     def query_available_models(self, api_keys, api_endpoints):
-        """Query available models from each API that was enabled by setting an API key or endpoint"""
+        """
+        Query available models from each API that was enabled by setting an API key or endpoint. Returns the 
+        queried models by id in addition to the pre-defined models, or None if a model listing failed.
+        """
+
+        queried_models = {}
 
         if API_OPENAPI in LLM_API_QUERY_AVAILABLE_MODELS:
             if API_OPENAPI in api_keys:
@@ -142,20 +190,19 @@ class LLMApiClient:
         if API_OLLAMA in LLM_API_QUERY_AVAILABLE_MODELS:
             if API_OLLAMA in api_endpoints:
                 print("Requesting available Ollama models ...")
-                repsponse = requests.get(api_endpoints[API_OLLAMA] + '/tags')
-                m_json = []
-                try:
-                    m_json = repsponse.json()
-                except requests.exceptions.JSONDecodeError:
-                    print("API JSON Decode Error, possibly the API address set using -a is incorrect")
-                if 'models' in m_json:
-                    # overwrite pre-defined models
-                    remove_models = []
-                    for id in LLM_BY_ID.keys():
-                        if id.startswith(API_OLLAMA):
-                            remove_models.append(id)
-                    for id in remove_models:
-                        del LLM_BY_ID[id]
+                # models of all endpoints of a pool, unless no endpoint responds
+                m_json = {}
+                for api_endpoint in ollama_pool.parse_endpoints(api_endpoints[API_OLLAMA]):
+                    try:
+                        repsponse = http_session_pool.get(api_endpoint + '/tags')
+                        m_json.setdefault('models', []).extend(repsponse.json()['models'])
+                    except requests.exceptions.JSONDecodeError:
+                        print("API JSON Decode Error, possibly the API address set using -a is incorrect:", api_endpoint)
+                    except (requests.exceptions.RequestException, KeyError) as e:
+                        print("Ollama endpoint not available:", api_endpoint, e)
+                if 'models' not in m_json:
+                    return None
+                else:
                     # update model list
                     for m in m_json['models']:
                         name = m['name']
@@ -169,10 +216,12 @@ class LLMApiClient:
                             if 'quantization_level' in m['details'].keys():
                                 quantization_level = m['details']['quantization_level']
                         id = "{}/{}, {}, {}, {})".format(API_OLLAMA, name.capitalize().replace(":", " ("), parameter_size, quantization_level, digest)
-                        LLM_BY_ID[id] = name
+                        queried_models[id] = name
                         #print("-", id, name)
                     print("Found", len(m_json['models']), "Ollama models")
 
+        return queried_models
+
     def initialize_llm(self, selected_llm, selected_llm_api_id, llm_parameters, api_key, api_endpoint):
         """Sets LLM and parameters with API keys"""
 
@@ -191,18 +240,20 @@ class LLMApiClient:
 
         self.llm_parameters = llm_parameters
 
-        # Set API endpoint
+        # Set API endpoint, or a pool of several endpoints
+        self.ollama_pool = None
         if selected_llm.startswith(API_OLLAMA) and api_endpoint:
-            self.api_endpoint = api_endpoint
+            urls = ollama_pool.parse_endpoints(api_endpoint)
+            self.api_endpoint = urls[0]
+            if len(urls) > 1:
+                self.ollama_pool = ollama_pool.get_shared_pool(urls)
         elif selected_llm.startswith(API_OLLAMA):
             self.api_endpoint = LLM_API_ENDPOINT_DEFAULTS[API_OLLAMA]
 
         # Context returned by some APIs
         self.llm_returned_context = []
 
-        # LLM response is streamed and not finished
-        self.llm_response_ongoing = False
-        self.llm_response_buffer = []
+        self.count_tokens = context_window.get_tokenizer(selected_llm, selected_llm_api_id)
 
     def run_llm_replicate(self, llm_id, dialogue):
         """Run LLM with the replicate API"""
@@ -217,6 +268,15 @@ class LLMApiClient:
         #print(self.llm_parameters)
         #print(api_parameters)
 
+        timeout = self.get_timeout()
+        if timeout:
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+
+        if self.async_client:
+            return self.async_loop_thread.iterate(self.async_client.stream_replicate(llm_id, api_parameters, self.api_key, timeout))
+
+        if timeout:
+            return replicate.Client(api_token=self.api_key, timeout=timeout).stream(llm_id, input=api_parameters)
         response = replicate.stream(llm_id, input=api_parameters)
         return response
 
@@ -238,13 +298,19 @@ class LLMApiClient:
         #print(self.llm_parameters)
         #print(api_parameters)
 
-        openai.api_key = self.api_key
+        # the (connect, read) timeouts apply to the synchronous and the async client
+        if self.get_timeout():
+            api_parameters["request_timeout"] = self.get_timeout()
 
+        if self.async_client:
+            return self.async_loop_thread.iterate(self.async_client.stream_openai(api_parameters, self.api_key))
+
+        openai.api_key = self.api_key
         result = openai.ChatCompletion.create(**api_parameters)
         return result
 
-    def run_llm_rest_ollama(self, llm_id, dialogue):
-        """Run LLM with the given Rest API"""
+    def run_llm_rest_ollama(self, llm_id, dialogue, returned_context=None):
+        """Run LLM with the given Rest API, continuing from a returned context, returns the streamed JSON objects"""
 
         # https://github.com/jmorganca/ollama/blob/main/docs/api.md
         # https://github.com/jmorganca/ollama/blob/main/docs/modelfile.md#valid-parameters-and-values
@@ -255,31 +321,63 @@ class LLMApiClient:
             'options': {}
         }
 
-        if len(self.llm_returned_context) > 0:
-            api_parameters['context'] = self.llm_returned_context
+        if returned_context:
+            api_parameters['context'] = returned_context
 
+        return self.run_llm_rest_ollama_api(OLLAMA_API_GENERATE, api_parameters)
+
+    def run_llm_rest_ollama_chat(self, llm_id, messages):
+        """Run LLM with the chat endpoint of the given Rest API, returns the streamed JSON objects"""
+
+        api_parameters = {
+            'model': llm_id, 
+            'messages': messages,
+            'stream': True,
+            'options': {}
+        }
+
+        return self.run_llm_rest_ollama_api(OLLAMA_API_CHAT, api_parameters)
+
+    def run_llm_rest_ollama_api(self, api, api_parameters):
         # add parameters
         for p in self.llm_parameters.keys():
             api_parameters['options'][p] = self.llm_parameters[p]
 
-        response = requests.post(self.api_endpoint + '/generate', json=api_parameters, stream=True)
-        return response
+        if self.ollama_keep_alive is not None:
+            api_parameters['keep_alive'] = self.ollama_keep_alive
+
+        if not self.ollama_pool:
+            return self.run_llm_rest_ollama_url(self.api_endpoint + '/' + api, api_parameters)
+
+        model = api_parameters['model']
+        endpoint = self.ollama_pool.acquire(model)
+        try:
+            items = self.run_llm_rest_ollama_url(endpoint.url + '/' + api, api_parameters)
+        except Exception:
+            self.ollama_pool.release(endpoint, model, failed=True)
+            raise
+        return self.ollama_pool.stream(endpoint, model, items)
+
+    def run_llm_rest_ollama_url(self, url, api_parameters):
+        timeout = self.get_timeout()
+        if self.async_client:
+            return self.async_loop_thread.iterate(self.async_client.stream_ollama(url, api_parameters, timeout))
+
+        if timeout:
+            response = http_session_pool.post(url, json=api_parameters, stream=True, timeout=timeout)
+        else:
+            response = http_session_pool.post(url, json=api_parameters, stream=True)
+        if response.status_code in llm_resilience.RETRY_STATUS_CODES:
+            # e.g., busy server, retried by the resilience policy
+            response.close()
+            response.raise_for_status()
+        return self.stream_ollama_response(response)
 
     # Function for generating LLaMA2 llm_response
     def request_run_llm_llama2(self, context):
         """Run the Llama 2 LLM with the provided context, including the prompt as last message, in a suitable dialogue format"""
 
-        dialogue = CTX_TEMPLATE + "\\n\\n"
-        for message in context:
-            if MSG_FORMAT in message.keys() and ROLE in message.keys():
-                if message[MSG_FORMAT] != MSG_FORMAT_RESPONSE_INT:
-                    role = message[ROLE]
-                    if role == ROLE_US or role == ROLE_AS:
-                        # include user and assistant messages in the prompt, 
-                        # including generated code, not including interpreter output
-                        dialogue += role + ": " + message[MSG] + "\\n\\n"
-                    #elif role == ROLE_INT:
-                        # do not include interpreter output
+        dialogue = self.dialogue_llama2.build(context)
 
         items = self.run_llm_replicate(self.selected_llm_api_id, dialogue)
         item_function = lambda item: str(item)
@@ -290,72 +388,82 @@ class LLMApiClient:
     def request_run_llm_replicate(self, context):
         """Run a Replicate LLM with the provided context, including the prompt as last message, in a suitable dialogue format"""
 
-        dialogue = CTX_TEMPLATE + "\n\n"
-        for message in context:
-            if MSG_FORMAT in message.keys() and ROLE in message.keys():
-                if message[MSG_FORMAT] != MSG_FORMAT_RESPONSE_INT:
-                    role = message[ROLE]
-                    if role == ROLE_US or role == ROLE_AS:
-                        # include user and assistant messages in the prompt, 
-                        # including generated code, not including interpreter output
-                        dialogue += role + ": " + message[MSG] + "\n\n"
-                    #elif role == ROLE_INT:
-                        # do not include interpreter output
+        dialogue = self.dialogue_replicate.build(context)
 
         items = self.run_llm_replicate(self.selected_llm_api_id, dialogue)
         item_function = lambda item: str(item)
         #result = [f"Echo: {prompt}"]
         return (items, item_function)
 
-    def request_run_llm_ollama_parse_response(self, response):
-        """Parses JSON responses from Ollama"""
-
-        # Check if the response is complete or still ongoing
-        response_last = response.decode('utf-8')
-        if response_last.endswith('}\n') or response_last.endswith('}'):
-            # response is complete
-            response_text = ""
-            for response_buffered in self.llm_response_buffer:
-                response_text += response_buffered
-            response_text += response_last
-
-            self.llm_response_ongoing = False
-            self.llm_response_buffer = []
-
-            try:
-                jsonr = json.loads(response_text)
-                for k in ['prompt_eval_duration', 'eval_duration']:
-                    if k in jsonr:
-                        print("{}: {}".format(k, jsonr[k]))
-                if 'context' in jsonr:
-                    self.llm_returned_context = jsonr['context']
-                if 'response' in jsonr:
-                    return jsonr['response']
-                if 'error' in jsonr:
-                    return "*LLM API returned error: {}*".format(jsonr['error'])
-            except json.decoder.JSONDecodeError:
-                return ''
-
-        elif not self.llm_response_ongoing and response_last.startswith('{'):
-            # response is beginning
-            self.llm_response_ongoing = True
-            self.llm_response_buffer.append(response_last)
-            return ''
-        elif self.llm_response_ongoing:
-            # response is ongoing
-            self.llm_response_ongoing = True
-            self.llm_response_buffer.append(response_last)
-            return ''
-
-        return ''
+    def request_run_llm_ollama_parse_response(self, jsonr, request=None):
+        """
+        Parses a JSON object of a response streamed from Ollama. For a request as dict with the conversation id 
+        and dialogue, the response is collected and the returned context stored for the dialogue with the response.
+        """
+
+        if 'eval_duration' in jsonr and self.request_metrics:
+            self.request_metrics.set_provider_metrics(jsonr.get('prompt_eval_count'), jsonr.get('eval_count'), 
+                                                      jsonr.get('prompt_eval_duration'), jsonr['eval_duration'])
+        response = ''
+        if 'response' in jsonr:
+            response = jsonr['response']
+        elif 'message' in jsonr:
+            response = jsonr['message'].get('content', '')
+        elif 'error' in jsonr:
+            return "*LLM API returned error: {}*".format(jsonr['error'])
+        if request:
+            request['response'] += response
+        if 'context' in jsonr:
+            self.llm_returned_context = jsonr['context']
+            if request:
+                self.put_ollama_context(request['conversation_id'], request['dialogue'], request['response'], jsonr['context'])
+        return response
+
+    def get_ollama_context_key(self, dialogue):
+        return ollama_context.get_key(self.selected_llm_api_id, dialogue)
+
+    def put_ollama_context(self, conversation_id, dialogue, response, returned_context):
+        """Stores the context returned for a dialogue and its response, continued by the next prompt"""
 
+        response_message = {ROLE: ROLE_AS, MSG: response, MSG_FORMAT: MSG_FORMAT_RESPONSE_LLM}
+        dialogue += self.dialogue_ollama.format_message(response_message)
+        self.ollama_contexts.put(conversation_id, self.get_ollama_context_key(dialogue), returned_context)
+
+    def stream_ollama_response(self, response):
+        """Yields the JSON objects of a streamed Ollama response, closing the response when done or closed early"""
+
+        decoder = ndjson_stream.NDJSONStreamDecoder()
+        try:
+            for o in decoder.iter_objects(response.iter_content(chunk_size=None)):
+                yield o
+        finally:
+            response.close()
 
     # Function for generating an llm_response using Ollama
-    def request_run_llm_ollama(self, prompt):
-        """Run an LLM with Ollama with the provided context, including the prompt as last message, in a suitable dialogue format"""
+    def request_run_llm_ollama(self, context, prompt, conversation_id=""):
+        """
+        Run an LLM with Ollama with the provided context, including the prompt as last message. With the generate API,
+        the prompt continues the context returned for the preceding dialogue of the conversation, so that Ollama 
+        reuses its evaluation. Without such a context, e.g., after a restart, the dialogue is sent.
+        """
+
+        if self.ollama_api == OLLAMA_API_CHAT:
+            items = self.run_llm_rest_ollama_chat(self.selected_llm_api_id, self.dialogue_chat.build(context))
+            item_function = lambda item: self.request_run_llm_ollama_parse_response(item)
+            return (items, item_function)
 
-        items = self.run_llm_rest_ollama(self.selected_llm_api_id, prompt)
-        item_function = lambda item: self.request_run_llm_ollama_parse_response(item)
+        self.llm_returned_context = []
+        key = self.get_ollama_context_key(self.dialogue_ollama.build(context[0:-1]))
+        returned_context = self.ollama_contexts.get(conversation_id, key)
+        dialogue = self.dialogue_ollama.build(context)
+        if returned_context is None:
+            returned_context = []
+            if any(dialogue_builder.include_message(m) and m[ROLE] == ROLE_US for m in context[0:-1]):
+                prompt = dialogue + ROLE_AS + ": "
+
+        request = {'conversation_id': conversation_id, 'dialogue': dialogue, 'response': ''}
+        items = self.run_llm_rest_ollama(self.selected_llm_api_id, prompt, returned_context)
+        item_function = lambda item: self.request_run_llm_ollama_parse_response(item, request)
 
         #result = [f"Echo: {prompt}"]
         return (items, item_function)
@@ -363,21 +471,77 @@ class LLMApiClient:
     def request_run_llm_chatgpt4(self, context):
         """Run a ChatGPT LLM with the provided context, including the prompt as last message, in a suitable dialogue format"""
 
-        dialogue = []
-        for message in context:
-            if MSG_FORMAT in message.keys() and ROLE in message.keys():
-                if message[MSG_FORMAT] != MSG_FORMAT_RESPONSE_INT:
-                    role = message[ROLE]
-                    if role == ROLE_US or role == ROLE_AS:
-                        dialogue.append({"role": message[ROLE], "content": message[MSG]})
+        dialogue = self.dialogue_chat.build(context)
 
         items = self.run_llm_openai(self.selected_llm_api_id, dialogue)
         item_function = lambda item: item.choices[0].delta.get("content", "")
         #result = [f"Echo: {prompt}"]
         return (items, item_function)
 
-    def request_run_prompt(self, context, prompt):
-        """Runs the provided prompt or a context that includes the prompt as last message"""
+    def get_cache_dialogue(self, context, prompt):
+        """Returns the dialogue sent for the provided prompt or context as identifying part of a cache key"""
+
+        if self.selected_llm.startswith(API_OLLAMA):
+            return {"api": self.ollama_api, "messages": [CTX_TEMPLATE] + self.dialogue_chat.build(context)}
+
+        return [CTX_TEMPLATE] + self.dialogue_chat.build(context)
+
+    def request_run_prompt(self, context, prompt, conversation_id="", t_submit=None):
+        """
+        Runs the provided prompt or a context that includes the prompt as last message. With a response cache, 
+        a cached response for the same model, parameters and dialogue is replayed. With a context window, the 
+        context is fitted into its token budget; for Ollama, a trimmed context is sent as dialogue. Metrics of 
+        the request are collected from the given submit time (perf_counter_ns) on.
+        """
+
+        self.request_metrics = llm_metrics.LLMRequestMetrics(t_submit)
+
+        if self.context_window:
+            context = self.context_window.fit(context, self.selected_llm, self.llm_parameters, self.count_tokens)
+
+        if not self.response_cache:
+            return self.request_run_prompt_uncached(context, prompt, conversation_id)
+
+        key = response_cache.get_key(self.selected_llm, self.llm_parameters, self.get_cache_dialogue(context, prompt))
+        entry = self.response_cache.get(key)
+        if entry:
+            print("LLM response cache hit:", key[0:12])
+            self.request_metrics.cached = True
+            self.request_metrics.mark_request()
+            if entry[response_cache.CACHE_STATE]:
+                self.llm_returned_context = entry[response_cache.CACHE_STATE]
+                self.put_ollama_context(conversation_id, self.dialogue_ollama.build(context), "".join(entry[response_cache.CACHE_ITEMS]), self.llm_returned_context)
+            return self.response_cache.replay(entry)
+
+        (items, item_function) = self.request_run_prompt_uncached(context, prompt, conversation_id)
+        get_state = None
+        if self.selected_llm.startswith(API_OLLAMA):
+            get_state = lambda: self.llm_returned_context
+        return self.response_cache.record(key, items, item_function, get_state)
+
+    def get_timeout(self):
+        """Returns the (connect, read) timeouts in seconds of the resilience policy, or None"""
+
+        if self.resilience_policy:
+            return self.resilience_policy.get_timeout()
+        return None
+
+    def request_run_prompt_uncached(self, context, prompt, conversation_id=""):
+        """
+        Runs the provided prompt or a context that includes the prompt as last message. With a resilience policy,
+        failed requests are retried and late requests hedged.
+        """
+
+        if self.request_metrics:
+            self.request_metrics.mark_request()
+
+        if self.resilience_policy:
+            start = lambda: self.request_run_prompt_api(context, prompt, conversation_id)
+            return self.resilience_policy.open_stream(start, self.selected_llm, self.request_metrics)
+        return self.request_run_prompt_api(context, prompt, conversation_id)
+
+    def request_run_prompt_api(self, context, prompt, conversation_id=""):
+        """Runs the provided prompt or a context that includes the prompt as last message with the API of the selected LLM"""
 
         if self.selected_llm.startswith(API_REPLICATE + '/Llama2'):
             return self.request_run_llm_llama2(context)
@@ -386,7 +550,11 @@ class LLMApiClient:
         elif self.selected_llm.startswith(API_OPENAPI):
             return self.request_run_llm_chatgpt4(context)
         elif self.selected_llm.startswith(API_OLLAMA):
-            return self.request_run_llm_ollama(prompt)
+            return self.request_run_llm_ollama(context, prompt, conversation_id)
+
+    def clear_returned_context(self, conversation_id=None):
+        """Clears the last returned context and the contexts stored for a conversation"""
 
-    def clear_returned_context(self):
         self.llm_returned_context = []
+        if conversation_id is not None:
+            self.ollama_contexts.remove(conversation_id)
@@ -0,0 +1,145 @@
+import os
+import asyncio
+import threading
+
+import httpx
+import openai
+import replicate
+
+import cmi_http.http_session_pool as http_session_pool
+import cmi_llm_local.ndjson_stream as ndjson_stream
+import cmi_llm_local.llm_resilience as llm_resilience
+
+API_OPENAPI = "OpenAI"
+API_REPLICATE = "Replicate"
+API_OLLAMA = "Ollama"
+
+# Maximum number of concurrent streams per backend, further streams wait for a free slot
+ASYNC_CONCURRENCY_LIMITS = {
+    API_OPENAPI: 16,
+    API_REPLICATE: 8,
+    API_OLLAMA: 4
+}
+
+class AsyncLLMClient:
+    """
+    Streams LLM responses from OpenAI, Replicate and Ollama as async generators on one event loop, with a
+    concurrency limit per backend. Streams are cancelled by closing the generator.
+    """
+
+    def __init__(self, concurrency_limits=ASYNC_CONCURRENCY_LIMITS):
+        print("Load async LLM API client ...")
+        self.concurrency_limits = concurrency_limits
+        self.semaphores = {}
+        self.http_client = None
+
+    def get_semaphore(self, api_id):
+        # created lazily on the loop the streams run on
+        if api_id not in self.semaphores:
+            self.semaphores[api_id] = asyncio.Semaphore(self.concurrency_limits[api_id])
+        return self.semaphores[api_id]
+
+    def get_http_client(self):
+        if self.http_client is None:
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=http_session_pool.HTTP_POOL_SIZE),
+                timeout=httpx.Timeout(http_session_pool.HTTP_READ_TIMEOUT_S, connect=http_session_pool.HTTP_CONNECT_TIMEOUT_S))
+        return self.http_client
+
+    async def stream_openai(self, api_parameters, api_key):
+        """Yields chunks of a streamed OpenAI chat completion"""
+
+        async with self.get_semaphore(API_OPENAPI):
+            response = await openai.ChatCompletion.acreate(api_key=api_key, **api_parameters)
+            async for chunk in response:
+                yield chunk
+
+    async def stream_replicate(self, llm_id, api_parameters, api_key, timeout=None):
+        """Yields events of a streamed Replicate prediction, with the given httpx.Timeout or the default timeouts"""
+
+        async with self.get_semaphore(API_REPLICATE):
+            kwargs = {"timeout": timeout} if timeout else {}
+            client = replicate.Client(api_token=api_key or os.environ.get("REPLICATE_API_TOKEN"), **kwargs)
+            async for event in await client.async_stream(llm_id, input=api_parameters):
+                yield event
+
+    async def stream_ollama(self, url, api_parameters, timeout=None):
+        """Yields the JSON objects of a streamed Ollama response, with the given (connect, read) timeouts in seconds"""
+
+        async with self.get_semaphore(API_OLLAMA):
+            decoder = ndjson_stream.NDJSONStreamDecoder()
+            kwargs = {"timeout": httpx.Timeout(timeout[1], connect=timeout[0])} if timeout else {}
+            async with self.get_http_client().stream('POST', url, json=api_parameters, **kwargs) as response:
+                if response.status_code in llm_resilience.RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                async for chunk in response.aiter_bytes():
+                    for o in decoder.feed(chunk):
+                        yield o
+            for o in decoder.finish():
+                yield o
+
+class AsyncLoopThread:
+    """Runs an event loop in a background thread for async streams consumed by synchronous code"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="cmi-async-llm-client", daemon=True)
+        self.thread.start()
+
+    def iterate(self, async_generator):
+        """Returns a synchronous iterator over the async generator, see SyncStream"""
+        return SyncStream(self.loop, async_generator)
+
+class SyncStream:
+    """
+    Iterates synchronously over an async generator running on an event loop in another thread. Closing the
+    iterator, e.g., when the consumer stops early, cancels the stream.
+    """
+
+    def __init__(self, loop, async_generator):
+        self.loop = loop
+        self.async_generator = async_generator
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        future = asyncio.run_coroutine_threadsafe(self.async_generator.__anext__(), self.loop)
+        try:
+            return future.result()
+        except StopAsyncIteration:
+            self.closed = True
+            raise StopIteration
+        except BaseException:
+            future.cancel()
+            self.close()
+            raise
+
+    def close(self):
+        """Cancels the stream"""
+
+        if not self.closed:
+            self.closed = True
+            asyncio.run_coroutine_threadsafe(self.async_generator.aclose(), self.loop).result()
+
+    def __del__(self):
+        if not self.closed and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.async_generator.aclose(), self.loop)
+
+# Process-wide async client and loop shared by all sessions
+shared_client = None
+shared_loop_thread = None
+shared_lock = threading.Lock()
+
+def get_shared_client():
+    """Returns the process-wide async client with its event loop thread, created on first use"""
+
+    global shared_client, shared_loop_thread
+    with shared_lock:
+        if shared_client is None:
+            shared_client = AsyncLLMClient()
+            shared_loop_thread = AsyncLoopThread()
+    return (shared_client, shared_loop_thread)
@@ -0,0 +1,166 @@
+import math
+from time import perf_counter_ns
+
+# Metrics of one LLM request, durations in seconds
+LLM = "llm"
+CACHED = "cached"
+QUEUE_S = "queue_s"
+FIRST_TOKEN_S = "first_token_s"
+DURATION_S = "duration_s"
+INTER_TOKEN_P50_S = "inter_token_p50_s"
+INTER_TOKEN_P90_S = "inter_token_p90_s"
+INTER_TOKEN_P99_S = "inter_token_p99_s"
+OUTPUT_TOKENS = "output_tokens"
+TOKENS_PER_S = "tokens_per_s"
+ATTEMPTS = "attempts"
+# reported by the provider, e.g., Ollama
+PROMPT_TOKENS = "prompt_tokens"
+PREFILL_S = "prefill_s"
+DECODE_S = "decode_s"
+# output constrained by an interpreter grammar, runs of the same prompt including this one, whether the response
+# contained the source for the interpreter, whether it rendered, and seconds from the first run until it rendered
+GRAMMAR = "grammar"
+LLM_RUNS = "llm_runs"
+SOURCE_FOUND = "source_found"
+DIAGRAM_VALID = "diagram_valid"
+DIAGRAM_S = "diagram_s"
+
+# Metrics aggregated over requests
+AGGREGATED_METRICS = [
+    QUEUE_S, FIRST_TOKEN_S, DURATION_S, INTER_TOKEN_P50_S, INTER_TOKEN_P90_S, INTER_TOKEN_P99_S,
+    OUTPUT_TOKENS, TOKENS_PER_S, PROMPT_TOKENS, PREFILL_S, DECODE_S, ATTEMPTS,
+    LLM_RUNS, SOURCE_FOUND, DIAGRAM_VALID, DIAGRAM_S
+]
+# suffix of the LLM of requests with a grammar, aggregated separately
+GRAMMAR_SUFFIX = " +grammar"
+REQUESTS = "requests"
+CACHED_REQUESTS = "cached_requests"
+MEAN = "mean"
+P50 = "p50"
+P90 = "p90"
+P99 = "p99"
+
+def get_percentile(values, p):
+    """Returns the p-th percentile (0-100) of sorted values by nearest rank, or None for no values"""
+
+    if not values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(values)))
+    return values[rank - 1]
+
+def aggregate_metrics(records):
+    """
+    Returns statistics of request metrics by LLM as dict {llm: {"requests": n, "cached_requests": n, metric: 
+    {"mean", "p50", "p90", "p99"}}}, for metrics present in at least one request. Responses replayed from the 
+    response cache are counted, but not included in the statistics. Requests with a grammar are aggregated by 
+    the LLM with GRAMMAR_SUFFIX; the mean of a flag, e.g., diagram_valid, is its rate.
+    """
+
+    values_by_llm = {}
+    for record in records:
+        llm = record.get(LLM)
+        if record.get(GRAMMAR):
+            llm = str(llm) + GRAMMAR_SUFFIX
+        values = values_by_llm.setdefault(llm, {REQUESTS: [], CACHED_REQUESTS: []})
+        if record.get(CACHED):
+            values[CACHED_REQUESTS].append(record)
+            continue
+        values[REQUESTS].append(record)
+        for metric in AGGREGATED_METRICS:
+            if record.get(metric) is not None:
+                values.setdefault(metric, []).append(record[metric])
+
+    aggregated = {}
+    for (llm, values) in values_by_llm.items():
+        a = {REQUESTS: len(values.pop(REQUESTS)), CACHED_REQUESTS: len(values.pop(CACHED_REQUESTS))}
+        for (metric, v) in values.items():
+            v.sort()
+            a[metric] = {
+                MEAN: sum(v) / len(v),
+                P50: get_percentile(v, 50),
+                P90: get_percentile(v, 90),
+                P99: get_percentile(v, 99)
+            }
+        aggregated[llm] = a
+    return aggregated
+
+class LLMRequestMetrics:
+    """
+    Collects the latency of one LLM request: the time queued until the request is sent, the time to the first
+    streamed token, latencies between tokens and token rates, and durations reported by the provider.
+    Streamed items are counted as tokens unless the provider reports the number of tokens.
+    """
+
+    def __init__(self, t_submit=None):
+        self.t_submit = t_submit if t_submit is not None else perf_counter_ns()
+        self.t_request = None
+        self.token_times = []
+        self.cached = False
+        # requests sent, including retries and hedged requests
+        self.attempts = 1
+        self.prompt_tokens = None
+        self.output_tokens = None
+        self.prefill_ns = None
+        self.decode_ns = None
+        # diagram outcome, set once the response was processed
+        self.grammar = False
+        self.llm_runs = None
+        self.source_found = None
+        self.diagram_valid = None
+        self.diagram_ns = None
+
+    def mark_request(self):
+        """Marks the request as sent to the LLM"""
+
+        self.t_request = perf_counter_ns()
+
+    def add_token(self):
+        """Marks a streamed token as received"""
+
+        self.token_times.append(perf_counter_ns())
+
+    def set_provider_metrics(self, prompt_tokens=None, output_tokens=None, prefill_ns=None, decode_ns=None):
+        """Sets the token counts and durations in nanoseconds of prompt evaluation and generation reported by the provider"""
+
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+        self.prefill_ns = prefill_ns
+        self.decode_ns = decode_ns
+
+    def get_record(self):
+        """Returns the metrics as dict of numbers, None if unknown"""
+
+        t_request = self.t_request if self.t_request is not None else self.t_submit
+        t_end = self.token_times[-1] if self.token_times else perf_counter_ns()
+        gaps = sorted(t - t_previous for (t_previous, t) in zip(self.token_times, self.token_times[1:]))
+
+        output_tokens = self.output_tokens if self.output_tokens is not None else len(self.token_times)
+        tokens_per_s = None
+        if self.decode_ns:
+            tokens_per_s = output_tokens / (self.decode_ns / 1e+9)
+        elif len(self.token_times) > 1 and self.token_times[-1] > self.token_times[0]:
+            tokens_per_s = (len(self.token_times) - 1) / ((self.token_times[-1] - self.token_times[0]) / 1e+9)
+
+        def seconds(ns):
+            return round(ns / 1e+9, 6) if ns is not None else None
+
+        return {
+            CACHED: self.cached,
+            QUEUE_S: seconds(t_request - self.t_submit),
+            FIRST_TOKEN_S: seconds(self.token_times[0] - t_request) if self.token_times else None,
+            DURATION_S: seconds(t_end - t_request),
+            INTER_TOKEN_P50_S: seconds(get_percentile(gaps, 50)),
+            INTER_TOKEN_P90_S: seconds(get_percentile(gaps, 90)),
+            INTER_TOKEN_P99_S: seconds(get_percentile(gaps, 99)),
+            OUTPUT_TOKENS: output_tokens,
+            TOKENS_PER_S: round(tokens_per_s, 2) if tokens_per_s is not None else None,
+            ATTEMPTS: self.attempts,
+            PROMPT_TOKENS: self.prompt_tokens,
+            PREFILL_S: seconds(self.prefill_ns),
+            DECODE_S: seconds(self.decode_ns),
+            GRAMMAR: self.grammar,
+            LLM_RUNS: self.llm_runs,
+            SOURCE_FOUND: self.source_found,
+            DIAGRAM_VALID: self.diagram_valid,
+            DIAGRAM_S: seconds(self.diagram_ns)
+        }
@@ -0,0 +1,268 @@
+import time
+import queue
+import random
+import threading
+
+import requests
+import httpx
+import openai
+
+API_OPENAPI = "OpenAI"
+API_REPLICATE = "Replicate"
+API_OLLAMA = "Ollama"
+
+# Retries of a request failing transiently before its first response item
+RESILIENCE_RETRIES = 2
+
+# Timeouts in seconds for establishing a connection and between received response items, including the first one
+RESILIENCE_CONNECT_TIMEOUT_S = 10.0
+RESILIENCE_READ_TIMEOUT_S = 120.0
+
+# Exponential backoff in seconds before a retry, with full jitter
+RESILIENCE_BACKOFF_S = 1.0
+RESILIENCE_BACKOFF_MAX_S = 30.0
+
+# APIs that may be sent a duplicate request when the first item is late; paid APIs are billed for both prompts
+HEDGE_API_IDS = [API_OLLAMA]
+
+# HTTP status codes of transient failures
+RETRY_STATUS_CODES = [408, 409, 429, 500, 502, 503, 504]
+
+# Queue entries of a resilient stream
+ATTEMPT_FAILED = "failed"
+STREAM_ITEM = "item"
+STREAM_END = "end"
+STREAM_ERROR = "error"
+
+class LLMStreamError(Exception):
+    """Raised when an LLM request failed transiently on all attempts or its stream stalled"""
+
+def is_retryable(e):
+    """Returns whether an exception raised by an LLM API is transient, e.g., a timeout or an overloaded server"""
+
+    if isinstance(e, requests.exceptions.HTTPError):
+        return e.response is not None and e.response.status_code in RETRY_STATUS_CODES
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in RETRY_STATUS_CODES
+    if isinstance(e, httpx.TransportError):
+        return True
+    if isinstance(e, (openai.error.Timeout, openai.error.APIConnectionError, openai.error.RateLimitError,
+                      openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+        return True
+    if isinstance(e, openai.error.APIError):
+        return e.http_status is not None and e.http_status in RETRY_STATUS_CODES
+    # e.g., replicate.exceptions.ReplicateError
+    status = getattr(e, "status", None)
+    return isinstance(status, int) and status in RETRY_STATUS_CODES
+
+def close_items(items):
+    close = getattr(items, "close", None)
+    if close:
+        close()
+
+class ResiliencePolicy:
+    """
+    Timeouts, retries and hedging of LLM requests. A request is retried only before its first response item
+    arrived, so that no partial response is repeated. With a hedging threshold, a duplicate request is sent
+    when the first item is late, and the request that responds first is streamed.
+    """
+
+    def __init__(self, retries=RESILIENCE_RETRIES, connect_timeout_s=RESILIENCE_CONNECT_TIMEOUT_S, read_timeout_s=RESILIENCE_READ_TIMEOUT_S,
+                 backoff_s=RESILIENCE_BACKOFF_S, backoff_max_s=RESILIENCE_BACKOFF_MAX_S, hedge_after_s=None, hedge_api_ids=HEDGE_API_IDS):
+        print("Load LLM Resilience Policy:", retries, "retries, timeouts", connect_timeout_s, read_timeout_s, "s, hedge after", hedge_after_s, "s")
+        self.retries = retries
+        self.connect_timeout_s = connect_timeout_s
+        self.read_timeout_s = read_timeout_s
+        self.backoff_s = backoff_s
+        self.backoff_max_s = backoff_max_s
+        self.hedge_after_s = hedge_after_s
+        self.hedge_api_ids = hedge_api_ids
+
+    def get_timeout(self):
+        """Returns the timeouts as (connect, read) tuple in seconds"""
+
+        return (self.connect_timeout_s, self.read_timeout_s)
+
+    def get_backoff(self, retry):
+        """Returns the seconds to wait before the given retry, counting from 0"""
+
+        return random.uniform(0, min(self.backoff_max_s, self.backoff_s * 2 ** retry))
+
+    def is_hedged(self, llm_id):
+        return self.hedge_after_s is not None and any(llm_id.startswith(api_id) for api_id in self.hedge_api_ids)
+
+    def open_stream(self, start, llm_id, metrics=None):
+        """
+        Starts a request by calling start, which returns the streamed items with a function extracting the text of
+        an item, and returns them as a resilient stream. Without retries and hedging, the items are returned as
+        they are, limited by the timeouts of the request only.
+        """
+
+        hedge = self.is_hedged(llm_id)
+        if self.retries == 0 and not hedge:
+            return start()
+        stream = ResilientStream(start, self, hedge, metrics)
+        return (stream, lambda item: stream.item_function(item))
+
+class ResilientStream:
+    """
+    Iterates over the items of an LLM response, retrying the request until its first item arrived. Items are
+    received in a background thread, so that a request waiting longer than the read timeout is abandoned and
+    a stalled stream raises LLMStreamError instead of blocking the session. Closing the stream, e.g., when the
+    consumer stops early, or losing a hedged race cancels the request once its next item arrives.
+    """
+
+    def __init__(self, start, policy, hedge=False, metrics=None):
+        self.start = start
+        self.policy = policy
+        self.hedge = hedge
+        self.metrics = metrics
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.item_function = None
+        self.winner = None
+        self.abandoned = set()
+        self.closed = False
+        self.done = False
+        self.attempts = 0
+        self.retries = 0
+        self.hedged = False
+        # start times of the attempts waiting for their first item, each timing out on its own
+        self.pending = {}
+
+    def start_attempt(self):
+        self.attempts += 1
+        self.pending[self.attempts] = time.monotonic()
+        if self.metrics:
+            self.metrics.attempts = self.attempts
+        threading.Thread(target=self.run_attempt, args=(self.attempts,), name="cmi-llm-attempt", daemon=True).start()
+
+    def run_attempt(self, attempt):
+        """Sends the request and waits for its first item; the first attempt to receive one streams its items"""
+
+        items = None
+        try:
+            (items, item_function) = self.start()
+            first = [next(items)]
+        except StopIteration:
+            first = []
+        except Exception as e:
+            close_items(items)
+            self.queue.put((ATTEMPT_FAILED, (attempt, e)))
+            return
+
+        with self.lock:
+            won = self.winner is None and not self.closed and attempt not in self.abandoned
+            if won:
+                self.winner = attempt
+                self.item_function = item_function
+        if not won:
+            print("LLM request attempt", attempt, "cancelled")
+            close_items(items)
+            return
+
+        try:
+            for item in first:
+                self.queue.put((STREAM_ITEM, item))
+            for item in items:
+                if self.closed:
+                    break
+                self.queue.put((STREAM_ITEM, item))
+            self.queue.put((STREAM_END, None))
+        except Exception as e:
+            self.queue.put((STREAM_ERROR, e))
+        finally:
+            if self.closed:
+                close_items(items)
+
+    def get_wait(self):
+        """
+        Returns the seconds to wait for the next queue entry, and whether a hedged request is due then or
+        otherwise the attempt timing out then, if any
+        """
+
+        if self.winner is not None:
+            return (self.policy.read_timeout_s, False, None)
+        now = time.monotonic()
+        (attempt, t_start) = min(self.pending.items(), key=lambda p: p[1])
+        wait = t_start + self.policy.read_timeout_s - now
+        if self.hedge and not self.hedged:
+            # not hedged yet, the only pending attempt is the latest one
+            hedge_wait = self.pending[self.attempts] + self.policy.hedge_after_s - now
+            if hedge_wait < wait:
+                return (max(hedge_wait, 0), True, None)
+        return (max(wait, 0), False, attempt)
+
+    def retry(self, reason):
+        """Starts the next attempt after a backoff, or raises LLMStreamError once the retries are exhausted"""
+
+        if self.retries >= self.policy.retries:
+            self.close()
+            raise LLMStreamError("LLM request failed after {} attempts: {}".format(self.attempts, reason))
+        backoff = self.policy.get_backoff(self.retries)
+        self.retries += 1
+        print("LLM request attempt", self.attempts, "failed:", reason, "- retrying in {:.2f} s".format(backoff))
+        time.sleep(backoff)
+        self.hedged = False
+        self.start_attempt()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        if self.attempts == 0:
+            self.start_attempt()
+
+        while True:
+            (wait, hedge_due, attempt_due) = self.get_wait()
+            try:
+                (kind, value) = self.queue.get(timeout=wait)
+            except queue.Empty:
+                if hedge_due:
+                    print("LLM request attempt", self.attempts, "late, sending hedged request")
+                    self.hedged = True
+                    self.start_attempt()
+                    continue
+                if self.winner is not None:
+                    self.close()
+                    raise LLMStreamError("LLM stream stalled for {} s".format(self.policy.read_timeout_s))
+                # abandon the attempt, cancelled once it responds
+                with self.lock:
+                    self.abandoned.add(attempt_due)
+                del self.pending[attempt_due]
+                if not self.pending:
+                    self.retry("no response within {} s".format(self.policy.read_timeout_s))
+                continue
+
+            if kind == STREAM_ITEM:
+                return value
+            if kind == STREAM_END:
+                self.done = True
+                raise StopIteration
+            if kind == STREAM_ERROR:
+                self.done = True
+                if is_retryable(value):
+                    raise LLMStreamError("LLM stream failed: {}".format(value)) from value
+                raise value
+            # ATTEMPT_FAILED
+            (attempt, value) = value
+            if attempt in self.abandoned or self.winner is not None:
+                continue
+            del self.pending[attempt]
+            if self.pending:
+                continue
+            if not is_retryable(value):
+                self.close()
+                raise value
+            self.retry(value)
+
+    def close(self):
+        """Cancels the request"""
+
+        with self.lock:
+            self.closed = True
+        self.done = True
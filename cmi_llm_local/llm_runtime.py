@@ -1,6 +1,9 @@
 import sys
+from time import perf_counter
 
-from llama_cpp import Llama
+import cmi_llm_local.dialogue_builder as dialogue_builder
+import cmi_llm_local.llama_model_pool as llama_model_pool
+import cmi_llm_local.llama_state_cache as llama_state_cache
 
 RUNTIME_LLAMA_CPP = "Llama.cpp"
 
@@ -40,16 +43,24 @@ MSG_FORMAT_RESPONSE_INT = "re/int"
 class LLMRuntime:
     """Runs locally a LLM runtime such as llama.cpp"""
 
-    def __init__(self):
+    def __init__(self, context_window=None, model_pool=None, state_cache=None):
         print("Load LLM Runtime ...")
+        # optional token budget the dialogue is fitted into before it is evaluated
+        self.context_window = context_window
+        # loaded models shared by all runtimes of the process
+        self.model_pool = model_pool or llama_model_pool.get_shared_pool()
+        # optional model states by evaluated dialogue, restored to evaluate only the new part of a prompt
+        self.state_cache = state_cache
         self.selected_llm = None
         self.llm_parameters = None
         self.llm_files = None
+        self.llama_model = None
         self.llama_cpp = None
         self.llm_returned_context = []
+        self.dialogue = dialogue_builder.DialogueBuilder(dialogue_builder.format_text_message("\\n\\n"), CTX_TEMPLATE + "\\n\\n")
 
     def load_llm_files(self, selected_llm, llm_parameters):
-        """Load LLM files and initialize with runtime"""
+        """Load LLM files and initialize with runtime, reusing a model loaded with the same parameters by any session"""
 
         if selected_llm in LLM_BY_ID:
             print("Load LLM Files ...")
@@ -59,39 +70,104 @@ class LLMRuntime:
 
             self.llm_files = LLM_BY_ID[selected_llm]
             print(self.llm_files)
-            self.llama_cpp = Llama(
-                model_path=self.llm_files, 
-                n_ctx=self.llm_parameters["n_ctx"]
-                )
-
-    def run_llm_llama_cpp(self, context, prompt):
-        """Run llama.cpp with the given context as message array. The prompt is assumed as last message of the context."""
-
-        dialogue = CTX_TEMPLATE + "\\n\\n"
-        for message in context:
-            if MSG_FORMAT in message.keys() and ROLE in message.keys():
-                if message[MSG_FORMAT] != MSG_FORMAT_RESPONSE_INT:
-                    role = message[ROLE]
-                    if role == ROLE_US or role == ROLE_AS:
-                        dialogue += role + ": " + message[MSG] + "\\n\\n"
-
-        response = self.llama_cpp(f"{dialogue} {ROLE_AS}: ", 
-                                  max_tokens=self.llm_parameters["n_tokens_max"], 
-                                  stop=[ROLE_US + ":", "\n"], 
-                                  echo=True
-                                  )
+            previous_model = self.llama_model
+            self.llama_model = self.model_pool.acquire(self.llm_files, int(self.llm_parameters["n_ctx"]), self.llm_parameters.get("n_threads"))
+            self.llama_cpp = self.llama_model.llama
+            if previous_model:
+                self.model_pool.release(previous_model)
+            print("llama.cpp model pool:", self.model_pool.get_metrics())
+
+    def release_llm(self):
+        """Releases the loaded model to the pool"""
+
+        if getattr(self, "llama_model", None):
+            self.model_pool.release(self.llama_model)
+            self.llama_model = None
+            self.llama_cpp = None
+
+    def __del__(self):
+        # e.g., when the session holding the runtime ends
+        self.release_llm()
+
+    def run_llm_llama_cpp(self, context, prompt, grammar=None):
+        """
+        Run llama.cpp with the given context as message array, streaming the generated tokens. The prompt is assumed 
+        as last message of the context. The prompt is evaluated when the first item is requested. With a grammar 
+        (GBNF), only tokens continuing output valid in the grammar are sampled.
+        """
+
+        if self.context_window:
+            count_tokens = lambda text: len(self.llama_cpp.tokenize(text.encode('utf-8'), add_bos=False))
+            context = self.context_window.fit(context, self.selected_llm, self.llm_parameters, count_tokens)
+        # the dialogue up to the preceding prompt, whose state includes the response generated for it
+        preceding_dialogue = None
+        preceding_prompts = [i for i in range(len(context) - 1) if dialogue_builder.include_message(context[i]) and context[i][ROLE] == ROLE_US]
+        if self.state_cache and preceding_prompts:
+            preceding_dialogue = self.dialogue.build(context[0:preceding_prompts[-1] + 1])
+        dialogue = self.dialogue.build(context)
+
+        # the model is shared, sessions generate one after another
+        llama_model = self.llama_model
+        items = llama_model.stream(lambda: self.stream_llama_cpp(llama_model, preceding_dialogue, dialogue, grammar))
         
-        items = [response]
         item_function = lambda item: item["choices"][0]["text"]
         return (items, item_function)
 
-    def run_prompt(self, prompt):
+    def stream_llama_cpp(self, llama_model, preceding_dialogue, dialogue, grammar=None):
+        """
+        Yields the completion chunks of the dialogue. With a state cache, the state stored for the dialogue up to
+        the preceding prompt is restored, so that llama.cpp evaluates only the tokens following the restored ones, 
+        i.e., the tokens following the longest common prefix including as much of the preceding response as matches. 
+        The state after the response is stored for the next turn.
+        """
+
+        llama = llama_model.llama
+        text = f"{dialogue}{ROLE_AS}: "
+        prompt_tokens = []
+        tokens_restored = 0
+        if self.state_cache:
+            prompt_tokens = llama.tokenize(text.encode('utf-8'))
+            state = None
+            if preceding_dialogue is not None:
+                state = self.state_cache.get(llama_state_cache.get_key(llama_model.key, preceding_dialogue))
+            if state is not None:
+                llama.load_state(state)
+                tokens_restored = llama_state_cache.get_common_prefix(llama_state_cache.get_state_tokens(state), prompt_tokens)
+
+        llama_grammar = llama_model.get_grammar(grammar) if grammar else None
+
+        t_start = perf_counter()
+        t_first = None
+        for item in llama(text, 
+                          max_tokens=self.llm_parameters["n_tokens_max"], 
+                          temperature=self.llm_parameters["temperature"],
+                          top_p=self.llm_parameters["top_p"],
+                          top_k=self.llm_parameters["top_k"],
+                          stop=[ROLE_US + ":"], 
+                          grammar=llama_grammar,
+                          stream=True
+                          ):
+            if t_first is None:
+                t_first = perf_counter()
+                if self.state_cache:
+                    s_saved = self.state_cache.add_turn(len(prompt_tokens), tokens_restored, t_first - t_start)
+                    print("llama.cpp prefill: {} prompt tokens, {} restored from cached state, {:.2f} s, ~{:.2f} s saved".format(
+                        len(prompt_tokens), tokens_restored, t_first - t_start, s_saved))
+            yield item
+
+        if self.state_cache:
+            self.state_cache.put(llama_state_cache.get_key(llama_model.key, dialogue), llama.save_state())
+
+    def run_prompt(self, context, prompt, request_metrics=None, grammar=None):
         """
-        Executes the prompt. Returns the response as tuple (items_wrapped, item_function) where item_function is a 
-        lambda function extracting the wrapped response items.
+        Executes the prompt, the last message of the context. Returns the response as tuple (items_wrapped, 
+        item_function) where item_function is a lambda function extracting the wrapped response items. The request 
+        is marked in the given metrics. The output is constrained by the grammar (GBNF), if given.
         """
         
-        (items_wrapped, item_function) = self.run_llm_llama_cpp(prompt)
+        if request_metrics:
+            request_metrics.mark_request()
+        (items_wrapped, item_function) = self.run_llm_llama_cpp(context, prompt, grammar)
         return (items_wrapped, item_function)
 
     def clear_returned_context(self):
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import threading
+from types import MappingProxyType
+
+CATALOG_FILE = os.path.join("cmi_cache", "model_catalog.json")
+
+# Time in seconds after which the catalog is refreshed in the background
+CATALOG_TTL_S = 10 * 60
+
+# Time in seconds before a failed refresh is retried
+CATALOG_RETRY_S = 30
+
+CATALOG_UPDATED = "updated"
+CATALOG_SOURCE = "source"
+CATALOG_MODELS = "models"
+
+# Process-wide catalog shared by all sessions
+shared_catalog = None
+shared_lock = threading.Lock()
+
+def get_shared_catalog(query_models, source="", ttl_s=CATALOG_TTL_S):
+    """Returns the process-wide model catalog, created on first use"""
+
+    global shared_catalog
+    with shared_lock:
+        if shared_catalog is None:
+            shared_catalog = ModelCatalog(query_models, source, ttl_s=ttl_s)
+    return shared_catalog
+
+class ModelCatalog:
+    """
+    Serves the models available from the APIs without waiting for remote model listings. The last known models
+    are loaded from disk and refreshed in a background thread once they are older than the time to live. Models
+    are served as immutable snapshots, replaced on each refresh, so sessions never see a list being changed.
+    """
+
+    def __init__(self, query_models, source="", path=CATALOG_FILE, ttl_s=CATALOG_TTL_S):
+        print("Load Model Catalog ...")
+        # function returning the queried models by id, or None if no API could be queried
+        self.query_models = query_models
+        # identifies the queried APIs, e.g., by endpoints; a catalog stored for another source is not used
+        self.source = source
+        self.path = path
+        self.ttl_s = ttl_s
+        self.lock = threading.Lock()
+        self.refreshing = False
+        self.updated = 0
+        self.attempted = 0
+        self.version = 0
+        self.models = MappingProxyType({})
+        self.load()
+
+    def load(self):
+        """Loads the last known models from disk"""
+
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                catalog = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            return
+        if catalog.get(CATALOG_SOURCE) != self.source:
+            return
+        self.set_models(catalog[CATALOG_MODELS], catalog[CATALOG_UPDATED])
+        print("Loaded", len(self.models), "models from", self.path)
+
+    def store(self):
+        catalog = {
+            CATALOG_UPDATED: self.updated,
+            CATALOG_SOURCE: self.source,
+            CATALOG_MODELS: dict(self.models)
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        path_new = self.path + ".new"
+        with open(path_new, 'w') as f:
+            json.dump(catalog, f)
+        os.replace(path_new, self.path)
+
+    def set_models(self, models, updated):
+        with self.lock:
+            self.models = MappingProxyType(dict(models))
+            self.updated = updated
+            self.version += 1
+
+    def is_expired(self):
+        now = time.time()
+        return now > self.updated + self.ttl_s and now > self.attempted + CATALOG_RETRY_S
+
+    def snapshot(self):
+        """
+        Returns the current models as immutable mapping with its version. Expired models are returned while a
+        refresh is started in the background.
+        """
+
+        if self.is_expired():
+            self.refresh_async()
+        with self.lock:
+            return (self.models, self.version)
+
+    def refresh_async(self):
+        """Starts a refresh in a background thread unless one is running"""
+
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+            self.attempted = time.time()
+        threading.Thread(target=self.refresh, name="cmi-model-catalog", daemon=True).start()
+
+    def refresh(self):
+        """Queries the available models and stores them; on failure, the last known models are kept"""
+
+        try:
+            t_start = time.perf_counter()
+            models = self.query_models()
+            if models is not None:
+                self.set_models(models, time.time())
+                self.store()
+                print("Refreshed model catalog with", len(models), "models in {:.2f} s".format(time.perf_counter() - t_start))
+        except Exception as e:
+            print("Model catalog refresh failed:", e)
+        finally:
+            with self.lock:
+                self.refreshing = False
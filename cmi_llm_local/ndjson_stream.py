@@ -0,0 +1,59 @@
+import json
+
+NEWLINE = b"\n"
+
+class NDJSONStreamDecoder:
+    """
+    Decodes a stream of newline-delimited JSON objects, e.g., streamed by Ollama, from chunks of any size.
+    Objects may span several chunks and a chunk may contain several objects. Each stream needs its own decoder.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        # position up to which the buffer has been searched for a newline
+        self.scan_position = 0
+
+    def feed(self, chunk):
+        """Adds a chunk of bytes and returns the list of objects completed by it"""
+
+        objects = []
+        self.buffer += chunk
+        start = 0
+        end = self.buffer.find(NEWLINE, self.scan_position)
+        while end > -1:
+            self.decode_line(self.buffer[start:end], objects)
+            start = end + 1
+            end = self.buffer.find(NEWLINE, start)
+
+        if start > 0:
+            del self.buffer[:start]
+        self.scan_position = len(self.buffer)
+        return objects
+
+    def finish(self):
+        """Returns the list of objects in remaining data not terminated by a newline"""
+
+        objects = []
+        self.decode_line(self.buffer, objects)
+        self.buffer = bytearray()
+        self.scan_position = 0
+        return objects
+
+    def decode_line(self, line, objects):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            objects.append(json.loads(line))
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            print("Skipping invalid JSON line in stream:", bytes(line[:40]))
+
+    def iter_objects(self, chunks):
+        """Returns a generator of the objects decoded from the given iterable of chunks"""
+
+        for chunk in chunks:
+            if chunk:
+                for o in self.feed(chunk):
+                    yield o
+        for o in self.finish():
+            yield o
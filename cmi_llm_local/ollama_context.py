@@ -0,0 +1,71 @@
+import array
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Conversations with contexts kept, least recently used conversations are evicted first
+OLLAMA_CONTEXT_MAX_CONVERSATIONS = 16
+
+# Contexts kept per conversation, e.g., of turns before a removed message or re-run
+OLLAMA_CONTEXT_MAX_TURNS = 4
+
+# Process-wide store shared by all clients
+shared_store = None
+shared_lock = threading.Lock()
+
+def get_shared_store():
+    """Returns the process-wide store of Ollama contexts, created on first use"""
+
+    global shared_store
+    with shared_lock:
+        if shared_store is None:
+            shared_store = OllamaContextStore()
+    return shared_store
+
+def get_key(model_id, dialogue):
+    """Returns the key of a context by the model and the dialogue it encodes"""
+
+    return hashlib.sha256((model_id + "\n" + dialogue).encode('utf-8')).hexdigest()
+
+class OllamaContextStore:
+    """
+    Keeps the contexts returned by Ollama per conversation, keyed by the dialogue they encode. A turn continues
+    from the context of exactly the preceding dialogue, so conversations never share a context and contexts of
+    earlier turns remain valid after a message was removed or a response re-run.
+    """
+
+    def __init__(self, max_conversations=OLLAMA_CONTEXT_MAX_CONVERSATIONS, max_turns=OLLAMA_CONTEXT_MAX_TURNS):
+        self.max_conversations = max_conversations
+        self.max_turns = max_turns
+        self.conversations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, conversation_id, key):
+        """Returns the context of a conversation by key as list of tokens, or None"""
+
+        with self.lock:
+            contexts = self.conversations.get(conversation_id)
+            if contexts is None or key not in contexts:
+                return None
+            self.conversations.move_to_end(conversation_id)
+            contexts.move_to_end(key)
+            return contexts[key].tolist()
+
+    def put(self, conversation_id, key, context):
+        """Stores a context of a conversation, compactly as array of 32-bit tokens"""
+
+        with self.lock:
+            contexts = self.conversations.setdefault(conversation_id, OrderedDict())
+            contexts[key] = array.array('i', context)
+            contexts.move_to_end(key)
+            while len(contexts) > self.max_turns:
+                contexts.popitem(last=False)
+            self.conversations.move_to_end(conversation_id)
+            while len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+
+    def remove(self, conversation_id):
+        """Removes all contexts of a conversation"""
+
+        with self.lock:
+            self.conversations.pop(conversation_id, None)
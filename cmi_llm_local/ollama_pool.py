@@ -0,0 +1,143 @@
+import time
+import threading
+
+import cmi_http.http_session_pool as http_session_pool
+
+# Separator of the endpoints of a pool, e.g., -a Ollama::'http://host1:11434/api,http://host2:11434/api'
+ENDPOINT_SEPARATOR = ","
+
+# Seconds between health checks of all endpoints, and timeouts of a health check
+HEALTH_CHECK_INTERVAL_S = 15.0
+HEALTH_CHECK_TIMEOUT_S = 2.0
+
+# Outstanding requests an endpoint with the model loaded may have in excess of the least busy endpoint, before a
+# request is routed to an endpoint that has to load the model first
+AFFINITY_MAX_EXTRA_REQUESTS = 2
+
+# Process-wide pools by endpoints, shared by all clients
+shared_pools = {}
+shared_lock = threading.Lock()
+
+def parse_endpoints(api_endpoint):
+    """Returns the list of endpoint URLs of an API endpoint option"""
+
+    return [e.strip().strip("\'").rstrip("/") for e in api_endpoint.split(ENDPOINT_SEPARATOR) if e.strip()]
+
+def get_shared_pool(urls):
+    """Returns the process-wide pool of the given endpoint URLs, created on first use"""
+
+    with shared_lock:
+        key = tuple(urls)
+        if key not in shared_pools:
+            shared_pools[key] = OllamaEndpointPool(urls)
+        return shared_pools[key]
+
+class OllamaEndpoint:
+    """State of one Ollama endpoint of a pool"""
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        # models available and loaded into memory, None if unknown
+        self.models = None
+        self.loaded = set()
+
+class OllamaEndpointPool:
+    """
+    Routes requests across several Ollama endpoints. A request goes to a healthy endpoint that serves the model,
+    preferring endpoints that already have the model loaded, and otherwise the endpoint with the least
+    outstanding requests. An endpoint failing a request is taken out of rotation until a background health check
+    succeeds again, so that retried requests fail over to the other endpoints.
+    """
+
+    def __init__(self, urls, interval_s=HEALTH_CHECK_INTERVAL_S):
+        print("Load Ollama Endpoint Pool:", ", ".join(urls))
+        self.endpoints = [OllamaEndpoint(url) for url in urls]
+        self.interval_s = interval_s
+        self.lock = threading.Lock()
+        # endpoints start healthy with unknown models until the first health check, run by the background thread
+        # right away so that creating the pool, e.g., under the lock of the shared pools, does not block
+        threading.Thread(target=self.run_health_checks, name="cmi-ollama-pool", daemon=True).start()
+
+    def run_health_checks(self):
+        while True:
+            self.check_health()
+            time.sleep(self.interval_s)
+
+    def check_health(self):
+        """Checks each endpoint by listing its available and loaded models"""
+
+        timeout = (HEALTH_CHECK_TIMEOUT_S, HEALTH_CHECK_TIMEOUT_S)
+        for endpoint in self.endpoints:
+            try:
+                response = http_session_pool.get(endpoint.url + '/tags', timeout=timeout)
+                response.raise_for_status()
+                models = set(m['name'] for m in response.json().get('models', []))
+                loaded = None
+                # listing loaded models requires Ollama 0.1.38 or later
+                response = http_session_pool.get(endpoint.url + '/ps', timeout=timeout)
+                if response.ok:
+                    loaded = set(m['name'] for m in response.json().get('models', []))
+            except Exception as e:
+                with self.lock:
+                    if endpoint.healthy:
+                        print("Ollama endpoint unhealthy:", endpoint.url, e)
+                    endpoint.healthy = False
+                continue
+            with self.lock:
+                if not endpoint.healthy:
+                    print("Ollama endpoint healthy:", endpoint.url)
+                endpoint.healthy = True
+                endpoint.models = models
+                if loaded is not None:
+                    endpoint.loaded = loaded
+
+    def acquire(self, model):
+        """Selects the endpoint for a request running the given model and counts the request as outstanding"""
+
+        with self.lock:
+            # with no healthy endpoint, all endpoints are tried, e.g., before a health check noticed a restart
+            candidates = [e for e in self.endpoints if e.healthy] or self.endpoints
+            serving = [e for e in candidates if e.models is None or model in e.models]
+            if serving:
+                candidates = serving
+            least = min(e.outstanding for e in candidates)
+            loaded = [e for e in candidates if model in e.loaded and e.outstanding <= least + AFFINITY_MAX_EXTRA_REQUESTS]
+            if loaded:
+                candidates = loaded
+            endpoint = min(candidates, key=lambda e: (e.outstanding, e.requests))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, model, failed=False):
+        """Counts a request as completed; a failed endpoint is not routed to until it passes a health check"""
+
+        with self.lock:
+            endpoint.outstanding -= 1
+            if failed:
+                endpoint.failures += 1
+                if endpoint.healthy:
+                    print("Ollama endpoint failed, failing over:", endpoint.url)
+                endpoint.healthy = False
+            else:
+                endpoint.loaded.add(model)
+
+    def stream(self, endpoint, model, items):
+        """Yields the streamed items of a request to an endpoint, releasing the endpoint when done or closed early"""
+
+        failed = False
+        try:
+            for item in items:
+                yield item
+        except Exception:
+            failed = True
+            raise
+        finally:
+            close = getattr(items, "close", None)
+            if close:
+                close()
+            self.release(endpoint, model, failed)
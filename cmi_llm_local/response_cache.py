@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+CACHE_DIRECTORY = os.path.join("cmi_cache", "llm_responses")
+
+# Entries kept in memory, least recently used entries are evicted first
+CACHE_MAX_ENTRIES = 256
+
+# Default time to live of an entry in seconds
+CACHE_TTL_S = 24 * 60 * 60
+
+# Bytes the entries on disk may take, least recently written entries are removed first
+CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024
+
+# Seconds between sweeps of the entries on disk, removing expired entries and entries beyond the disk budget
+CACHE_SWEEP_INTERVAL_S = 10 * 60
+
+CACHE_CREATED = "created"
+CACHE_TTL = "ttl_s"
+CACHE_ITEMS = "items"
+CACHE_STATE = "state"
+
+# Process-wide cache shared by all sessions
+shared_cache = None
+shared_lock = threading.Lock()
+
+def get_shared_cache(ttl_s=CACHE_TTL_S):
+    """Returns the process-wide response cache, created on first use"""
+
+    global shared_cache
+    with shared_lock:
+        if shared_cache is None:
+            shared_cache = ResponseCache(ttl_s=ttl_s)
+    return shared_cache
+
+def normalize_parameters(llm_parameters):
+    """Returns LLM parameters with sorted keys and numbers in one representation, e.g., 1 and 1.0 are equal"""
+
+    normalized = {}
+    for p in sorted((llm_parameters or {}).keys()):
+        v = llm_parameters[p]
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            v = round(float(v), 6)
+        normalized[p] = v
+    return normalized
+
+def get_key(model_id, llm_parameters, dialogue):
+    """Returns the cache key of a request by model id, normalized parameters and the rendered dialogue"""
+
+    request = {
+        "model": model_id,
+        "parameters": normalize_parameters(llm_parameters),
+        "dialogue": dialogue
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """
+    Caches complete LLM responses as list of streamed text items by exact request. Entries are kept in memory
+    up to a maximum number (LRU) and on disk up to a budget, each with a time to live. Entries on disk are swept
+    periodically when entries are stored.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, directory=CACHE_DIRECTORY, ttl_s=CACHE_TTL_S, disk_max_bytes=CACHE_DISK_MAX_BYTES):
+        print("Load LLM Response Cache ...")
+        self.max_entries = max_entries
+        self.directory = directory
+        self.ttl_s = ttl_s
+        self.disk_max_bytes = disk_max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.t_sweep = 0
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key[0:2], key + ".json")
+
+    def is_expired(self, entry):
+        return entry[CACHE_TTL] is not None and time.time() > entry[CACHE_CREATED] + entry[CACHE_TTL]
+
+    def get(self, key):
+        """Returns the cached entry with text items and state, or None if there is no valid entry"""
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None:
+            path = self.get_path(key)
+            if os.path.isfile(path):
+                try:
+                    with open(path, 'r') as f:
+                        entry = json.load(f)
+                except (OSError, json.decoder.JSONDecodeError):
+                    entry = None
+                if entry is not None:
+                    self.put_memory(key, entry)
+
+        if entry is not None and self.is_expired(entry):
+            self.remove(key)
+            entry = None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def put(self, key, items, state=None, ttl_s=None):
+        """Stores the text items of a complete response and optional client state, e.g., a returned context"""
+
+        entry = {
+            CACHE_CREATED: time.time(),
+            CACHE_TTL: ttl_s if ttl_s is not None else self.ttl_s,
+            CACHE_ITEMS: items,
+            CACHE_STATE: state
+        }
+        self.put_memory(key, entry)
+
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        path_new = path + ".new"
+        with open(path_new, 'w') as f:
+            json.dump(entry, f)
+        os.replace(path_new, path)
+
+        with self.lock:
+            sweep = time.time() - self.t_sweep > CACHE_SWEEP_INTERVAL_S
+            if sweep:
+                self.t_sweep = time.time()
+        if sweep:
+            self.sweep()
+
+    def sweep(self):
+        """Removes expired entries from disk, then the least recently written ones beyond the disk budget"""
+
+        files = []
+        for (root, _, filenames) in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".json"):
+                    files.append(os.path.join(root, filename))
+
+        kept = []
+        (removed, size_bytes) = (0, 0)
+        for path in files:
+            try:
+                with open(path, 'r') as f:
+                    entry = json.load(f)
+                expired = self.is_expired(entry)
+            except (OSError, json.decoder.JSONDecodeError, KeyError, TypeError):
+                expired = True
+            try:
+                if expired:
+                    os.remove(path)
+                    removed += 1
+                else:
+                    kept.append((os.path.getmtime(path), os.path.getsize(path), path))
+                    size_bytes += kept[-1][1]
+            except OSError:
+                pass
+
+        kept.sort()
+        for (_, size, path) in kept:
+            if size_bytes <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size_bytes -= size
+            removed += 1
+        if removed:
+            print("LLM response cache sweep removed", removed, "entries, on disk", size_bytes // 1024, "KB")
+
+    def put_memory(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        path = self.get_path(key)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def replay(self, entry):
+        """Returns a cached response through the streaming interface as tuple (items, item_function)"""
+
+        items = iter(entry[CACHE_ITEMS])
+        item_function = lambda item: item
+        return (items, item_function)
+
+    def record(self, key, items, item_function, get_state=None):
+        """
+        Returns a response through the streaming interface as tuple (items, item_function) that stores the
+        response in the cache once the stream has been consumed completely.
+        """
+
+        def stream():
+            texts = []
+            try:
+                for item in items:
+                    text = item_function(item)
+                    texts.append(text)
+                    yield text
+            finally:
+                # a response not consumed completely is closed upstream and not stored
+                close = getattr(items, "close", None)
+                if close:
+                    close()
+            if any(text.startswith("*LLM API returned error") for text in texts):
+                return
+            self.put(key, texts, get_state() if get_state else None)
+
+        return (stream(), lambda item: item)
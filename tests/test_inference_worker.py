@@ -0,0 +1,55 @@
+import os
+import sys
+import tempfile
+import unittest
+import subprocess
+import importlib.util
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CMI_PATH = os.path.join(REPOSITORY, "cmi.py")
+
+# Seconds a worker process is given to start, i.e., to import the main module and the worker code
+WORKER_START_S = 5
+
+# Run in a separate process: with cmi.py as main module, as run by Streamlit, a worker is spawned and checked
+WORKER_START_SCRIPT = """
+import sys, time, types
+import cmi_llm_local.inference_worker as inference_worker
+main = types.ModuleType("__main__")
+main.__file__ = {cmi_path!r}
+sys.modules["__main__"] = main
+pool = inference_worker.InferenceWorkerPool(1)
+time.sleep({wait_s})
+print("alive" if pool.processes[0].is_alive() and pool.restarted == 0 else "died")
+"""
+
+class InferenceWorkerStartTest(unittest.TestCase):
+    """Worker processes re-import cmi.py as __mp_main__ without importing Streamlit or starting the app"""
+
+    def setUp(self):
+        # a streamlit package failing on import, found before an installed one
+        self.directory = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self.directory.name, "streamlit"))
+        with open(os.path.join(self.directory.name, "streamlit", "__init__.py"), "w") as file:
+            file.write("raise ImportError('streamlit imported')\n")
+        self.env = dict(os.environ)
+        self.env["PYTHONPATH"] = os.pathsep.join([self.directory.name, REPOSITORY, os.environ.get("PYTHONPATH", "")])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_script(self, script):
+        return subprocess.run([sys.executable, "-c", script], env=self.env, cwd=self.directory.name, capture_output=True, text=True, timeout=60)
+
+    def test_main_module_import(self):
+        result = self.run_script("import runpy; runpy.run_path({!r}, run_name='__mp_main__'); print('imported')".format(CMI_PATH))
+        self.assertEqual(result.stdout.strip().splitlines()[-1:], ["imported"], result.stderr)
+
+    @unittest.skipIf(importlib.util.find_spec("llama_cpp") is None, "llama_cpp is not installed")
+    def test_worker_start(self):
+        result = self.run_script(WORKER_START_SCRIPT.format(cmi_path=CMI_PATH, wait_s=WORKER_START_S))
+        # the worker may print after the result, once the pool is shut down on exit
+        self.assertIn("alive", result.stdout.splitlines(), result.stderr)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import re
+import unittest
+
+import cmi_interpreter.source_matcher as source_matcher
+import cmi_interpreter.interpreter_runtime as interpreter_runtime
+
+RESPONSES = {
+    interpreter_runtime.INT_PLANTWEB_PLANTUML: "Sure:\n```plantuml\n@startuml\nA -> B\n@enduml\n```\nThe diagram relates A and B.",
+    interpreter_runtime.INT_PLANTWEB_GRAPHVIZ: "Sure:\n```dot\ndigraph G {\n  a -> b [label=\"}\"];\n  subgraph { c }\n}\n```\nThe graph relates a and b.",
+    interpreter_runtime.INT_BPMN_XML: "Sure:\n```xml\n<bpmn:definitions id=\"d\">\n<bpmn:process/>\n</bpmn:definitions>\n```\nThe process is empty.",
+    interpreter_runtime.INT_PLANTWEB_DITAA: "Sure:\n```\n+--+\n|ab|\n+--+\n```\nThe box is labeled."
+}
+
+class SourceMatcherTest(unittest.TestCase):
+    """The source found complete in a streamed response is the source matched by interpreter_runtime.SYNTAX_MATCH"""
+
+    def feed(self, matcher, text, size):
+        for i in range(0, len(text), size):
+            if matcher.feed(text[i:i + size]):
+                return True
+        return False
+
+    def test_syntax_match(self):
+        for (int_id, response) in RESPONSES.items():
+            source = re.search(interpreter_runtime.SYNTAX_MATCH[int_id], response, flags=re.DOTALL).group(1)
+            for size in [1, 3, len(response)]:
+                matcher = source_matcher.get_source_matcher(int_id)
+                self.assertTrue(self.feed(matcher, response, size), (int_id, size))
+                match = re.search(interpreter_runtime.SYNTAX_MATCH[int_id], response[0:matcher.end], flags=re.DOTALL)
+                self.assertEqual(match.group(1) if match else None, source, (int_id, size))
+
+    def test_long_start_marker(self):
+        response = "Here:\ndigraph " + "SomeLongGraphName" * 5 + " {\n  a -> b\n}\nThe graph relates a and b."
+        matcher = source_matcher.BraceMatcher(r'digraph\s[^{]*\{')
+        self.assertTrue(self.feed(matcher, response, 1))
+        self.assertEqual(response[matcher.start:matcher.end], response[6:response.index("}") + 1])
+
+if __name__ == "__main__":
+    unittest.main()